@@ -0,0 +1,283 @@
+"""
+Adaptive baud-rate negotiation for the COBS UART link.
+
+Both ends start at the base rate. The initiator then tries each higher rate
+in turn and keeps the fastest one that carries probe frames without errors.
+If frame errors pile up later on, it steps back down.
+
+Control frames share the link with data frames. A control frame is a COBS
+frame whose decoded payload starts with MAGIC, followed by an op byte, the
+op's body and a CRC-16 over everything before it. So that no data frame can
+be taken for one, a data frame whose first byte is 0xFF, like MAGIC's, is
+sent with that byte doubled, and the receiver drops the extra one; both
+ends of the link must do this while negotiation is in use.
+
+  SWITCH      rate (u32)     please change to rate
+  SWITCH_ACK  rate (u32)     changing to rate
+  PROBE       data           echo this back
+  PROBE_ECHO  data           echoed probe
+  COMMIT      rate (u32)     keep rate
+  COMMIT_ACK  rate (u32)     keeping rate
+
+Trying a rate goes like this:
+  1. At the current rate the initiator sends SWITCH. The responder answers
+     with SWITCH_ACK, waits for it to be sent and changes rate. The
+     initiator changes rate when it gets the ack.
+  2. The initiator sends PROBE frames of random data, and the responder
+     echoes each one. A probe that isn't echoed in time, or comes back
+     corrupted, counts as an error.
+  3. If the error rate is acceptable the initiator sends COMMIT and waits
+     for COMMIT_ACK. Otherwise, or without an ack, it goes back to the old
+     rate. A responder that goes revert_ms without a probe or COMMIT after
+     switching goes back to the old rate too.
+
+BaudNegotiator implements both roles, so the host side can run the same
+code: one end calls run() and the other run(initiate=False), which only
+answers and falls back to the base rate by itself when frame errors pile up.
+"""
+
+import struct, os
+import uasyncio as asyncio
+from time import ticks_ms, ticks_diff
+from crc16 import crc16
+
+MAGIC = b'\xffBN'
+
+OP_SWITCH = 1
+OP_SWITCH_ACK = 2
+OP_PROBE = 3
+OP_PROBE_ECHO = 4
+OP_COMMIT = 5
+OP_COMMIT_ACK = 6
+
+
+class RateStats:
+    """Counters for one baud rate."""
+    def __init__(self):
+        self.tries = 0          # times the rate was negotiated
+        self.probes = 0         # probe frames sent
+        self.probe_errors = 0   # probes lost or echoed corrupted
+        self.frames = 0         # data frames received while at this rate
+        self.frame_errors = 0   # bad data frames received while at this rate
+        self.fallbacks = 0      # times errors forced a step down from this rate
+
+    def __repr__(self):
+        return 'tries=%d probes=%d/%d frames=%d/%d fallbacks=%d' % (self.tries,
+            self.probe_errors, self.probes, self.frame_errors, self.frames,
+            self.fallbacks)
+
+
+class BaudNegotiator:
+    """Negotiate the baud rate of uart with the other end of the link.
+
+    rates lists the usable rates in increasing order, the first one being the
+    base rate both ends start at. Control frames are sent with sender, a
+    uartcobs.FrameSender, and received ones must be passed to handle() (use
+    is_control() to pick them out). Data frames must be sent with send() and
+    received ones passed through unescape(), which keep them apart from
+    control frames. They should be reported with frame_ok() and
+    frame_error(), which drive the fall-back, and held back while self.ready
+    is clear.
+    """
+
+    def __init__(self, uart, sender, rates, probes=16, probe_size=64,
+            max_errors=0, timeout_ms=200, revert_ms=1000, fallback_errors=8,
+            window_ms=10000, retry_ms=600000):
+        self._uart = uart
+        self._sender = sender
+        self.rates = rates
+        self._probes = probes
+        self._probe_size = probe_size
+        self._max_errors = max_errors       # probe errors allowed per try
+        self._timeout_ms = timeout_ms       # to wait for an ack or echo
+        self._revert_ms = revert_ms         # responder's wait for COMMIT
+        self._fallback_errors = fallback_errors # frame errors per window to step down
+        self._window_ms = window_ms
+        self._retry_ms = retry_ms           # wait before stepping up again
+        self.rate = rates[0]
+        self.stats = {}
+        for r in rates:
+            self.stats[r] = RateStats()
+        self.ready = asyncio.Event()  # clear while the rate is being changed
+        self.ready.set()
+        self._reply = None            # (op, body) awaited by the initiator
+        self._reply_ev = asyncio.Event()
+        self._commit_ev = asyncio.Event() # set by COMMIT for the responder
+        self._probed = False          # responder got a probe since the last check
+        self._errors = 0              # frame errors in the current window
+
+    # ===== frame handling
+
+    @staticmethod
+    def is_control(frame):
+        """Return True if the decoded frame is a negotiation frame."""
+        return len(frame) >= len(MAGIC) + 3 and bytes(frame[:len(MAGIC)]) == MAGIC
+
+    @staticmethod
+    def unescape(frame):
+        """Return the data frame received as frame, without the escape byte."""
+        if len(frame) >= 2 and frame[0] == 0xFF and frame[1] == 0xFF:
+            return memoryview(frame)[1:]
+        return frame
+
+    async def send(self, frame, flush=True):
+        """Send a data frame through sender, escaping a leading 0xFF."""
+        if len(frame) and frame[0] == 0xFF:
+            frame = b'\xff' + bytes(frame)
+        await self._sender.send(frame, flush)
+
+    async def _send(self, op, body=b''):
+        frame = bytearray(MAGIC)
+        frame.append(op)
+        frame += body
+        frame += struct.pack('>H', crc16(frame))
+        await self._sender.send(frame)
+
+    def handle(self, frame):
+        """Process a received control frame.
+
+        Frames that are too short, fail the CRC or carry a body of the wrong
+        length for their op are counted as frame errors and ignored."""
+        n = len(frame)
+        if n < len(MAGIC) + 3 or \
+                crc16(memoryview(frame)[:n-2]) != struct.unpack('>H', frame[n-2:n])[0]:
+            self.frame_error()
+            return
+        op = frame[len(MAGIC)]
+        body = bytes(frame[len(MAGIC)+1:n-2])
+        if op == OP_SWITCH:
+            if len(body) != 4:
+                self.frame_error()
+                return
+            asyncio.create_task(self._respond_switch(struct.unpack('>I', body)[0]))
+        elif op == OP_PROBE:
+            self._probed = True
+            asyncio.create_task(self._send(OP_PROBE_ECHO, body))
+        elif op == OP_COMMIT:
+            self._commit_ev.set()
+            asyncio.create_task(self._send(OP_COMMIT_ACK, body))
+        else:
+            self._reply = (op, body)
+            self._reply_ev.set()
+
+    def frame_ok(self):
+        self.stats[self.rate].frames += 1
+
+    def frame_error(self):
+        if self.ready.is_set():
+            self.stats[self.rate].frame_errors += 1
+            self._errors += 1
+
+    # ===== switching
+
+    async def _set_rate(self, rate):
+        # let the last frame leave the TX FIFO before changing the rate
+        if hasattr(self._uart, 'flush'):
+            self._uart.flush()
+        await asyncio.sleep_ms(5)
+        self._uart.init(baudrate=rate)
+        self.rate = rate
+        await asyncio.sleep_ms(20) # give the other end time to follow
+
+    async def _request(self, op, body, want):
+        """Send a control frame and return the body of the reply with op
+        want, or None on time-out."""
+        self._reply = None
+        self._reply_ev.clear()
+        await self._send(op, body)
+        try:
+            await asyncio.wait_for_ms(self._reply_ev.wait(), self._timeout_ms)
+        except asyncio.TimeoutError:
+            return None
+        if self._reply[0] != want:
+            return None
+        return self._reply[1]
+
+    async def _respond_switch(self, rate):
+        if rate not in self.stats:
+            return # not a rate we support, let the initiator time out
+        old = self.rate
+        self.ready.clear()
+        self._commit_ev.clear()
+        await self._send(OP_SWITCH_ACK, struct.pack('>I', rate))
+        await self._set_rate(rate)
+        self.stats[rate].tries += 1
+        # wait for COMMIT for as long as probes keep coming in
+        self._probed = False
+        while True:
+            try:
+                await asyncio.wait_for_ms(self._commit_ev.wait(), self._revert_ms)
+                break
+            except asyncio.TimeoutError:
+                if not self._probed:
+                    await self._set_rate(old)
+                    break
+                self._probed = False
+        self._errors = 0
+        self.ready.set()
+
+    async def _try_rate(self, rate):
+        """Switch to rate and verify it, going back to the current rate if it
+        doesn't work. Returns True if the rate was adopted."""
+        old = self.rate
+        body = struct.pack('>I', rate)
+        self.ready.clear()
+        try:
+            if await self._request(OP_SWITCH, body, OP_SWITCH_ACK) != body:
+                return False
+            await self._set_rate(rate)
+            st = self.stats[rate]
+            st.tries += 1
+            errors = 0
+            for seq in range(self._probes):
+                probe = struct.pack('>H', seq) + os.urandom(self._probe_size)
+                st.probes += 1
+                if await self._request(OP_PROBE, probe, OP_PROBE_ECHO) != probe:
+                    st.probe_errors += 1
+                    errors += 1
+                    if errors > self._max_errors:
+                        break
+            if errors <= self._max_errors:
+                for _ in range(3):
+                    if await self._request(OP_COMMIT, body, OP_COMMIT_ACK) == body:
+                        return True
+            await self._set_rate(old)
+            # make sure the responder has given up on the new rate as well
+            await asyncio.sleep_ms(2 * self._revert_ms)
+            return False
+        finally:
+            self._errors = 0
+            self.ready.set()
+
+    async def negotiate(self):
+        """Step up through the rates above the current one until one fails."""
+        for rate in self.rates:
+            if rate > self.rate and not await self._try_rate(rate):
+                break
+        return self.rate
+
+    async def run(self, initiate=True):
+        """Negotiate, then keep an eye on the frame error count: when it
+        reaches fallback_errors within one window, step down a rate, and after
+        retry_ms try stepping up again.
+
+        With initiate=False only the responder role is played, and too many
+        errors make this end fall back to the base rate straight away."""
+        if initiate:
+            await self.negotiate()
+        t_down = None
+        while True:
+            await asyncio.sleep_ms(self._window_ms)
+            if self._errors >= self._fallback_errors and self.rate != self.rates[0]:
+                self.stats[self.rate].fallbacks += 1
+                lower = self.rates[self.rates.index(self.rate) - 1]
+                if not initiate or not await self._try_rate(lower):
+                    # no answer at this rate, the other end is expected to
+                    # fall back to the base rate after errors of its own
+                    await self._set_rate(self.rates[0])
+                t_down = ticks_ms()
+            elif (initiate and t_down is not None and
+                    ticks_diff(ticks_ms(), t_down) >= self._retry_ms):
+                t_down = None
+                await self.negotiate()
+            self._errors = 0
@@ -0,0 +1,214 @@
+"""
+Consistent Overhead Byte Stuffing (COBS)
+
+Shared COBS codec for the UART bridges. encode_into() and decode_into() write
+into caller-supplied buffers and return the number of bytes written, so a
+steady stream of frames can be processed without allocating. encode() and
+decode() are convenience wrappers that return new bytes objects.
+
+The encoding is the same as the python-cobs package: an empty string encodes
+to b'\\x01' and no trailing code byte is emitted after a full 254-byte block.
+
+On MicroPython builds with the native emitter a @micropython.viper version of
+each codec loop is used; elsewhere (including CPython) runs of non-zero bytes
+are moved with slice copies. find_zero(), the delimiter scan, is shared with
+the UART frame receiver.
+"""
+
+try:
+    import micropython
+    _use_viper = hasattr(micropython, 'viper')
+except ImportError:
+    _use_viper = False
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def max_encoded_length(n):
+    """Return the worst-case encoded size of n bytes of input."""
+    return n + n // 254 + 1
+
+
+def _get_buffer_view(in_bytes):
+    if isinstance(in_bytes, str):
+        raise TypeError('Unicode-objects must be encoded as bytes first')
+    mv = memoryview(in_bytes)
+    try:
+        if mv.format != 'B':
+            mv = mv.cast('B')
+    except AttributeError:
+        pass
+    return mv
+
+
+if _use_viper:
+    @micropython.viper
+    def find_zero(buf: ptr8, start: int, end: int) -> int:
+        """Return the index of the first zero byte in buf[start:end], or -1."""
+        while start < end:
+            if buf[start] == 0:
+                return start
+            start += 1
+        return -1
+else:
+    def find_zero(buf, start, end):
+        """Return the index of the first zero byte in buf[start:end], or -1."""
+        try:
+            return buf.find(b'\x00', start, end)
+        except AttributeError:  # a memoryview
+            i = bytes(buf[start:end]).find(b'\x00')
+            return i + start if i >= 0 else -1
+
+
+if _use_viper:
+    @micropython.viper
+    def _encode_viper(src: ptr8, n: int, dst: ptr8) -> int:
+        code_idx = 0
+        code = 1
+        o = 1
+        i = 0
+        while i < n:
+            b = src[i]
+            i += 1
+            if b == 0:
+                dst[code_idx] = code
+                code_idx = o
+                o += 1
+                code = 1
+            else:
+                dst[o] = b
+                o += 1
+                code += 1
+                if code == 0xFF:
+                    dst[code_idx] = code
+                    if i == n:
+                        return o
+                    code_idx = o
+                    o += 1
+                    code = 1
+        dst[code_idx] = code
+        return o
+
+    # Returns the decoded length, -1 for a zero byte in the input or -2 for a
+    # truncated block.
+    @micropython.viper
+    def _decode_viper(src: ptr8, n: int, dst: ptr8) -> int:
+        i = 0
+        o = 0
+        while i < n:
+            code = src[i]
+            if code == 0:
+                return -1
+            end = i + code
+            if end > n:
+                return -2
+            i += 1
+            while i < end:
+                b = src[i]
+                if b == 0:
+                    return -1
+                dst[o] = b
+                o += 1
+                i += 1
+            if i < n and code < 0xFF:
+                dst[o] = 0
+                o += 1
+        return o
+
+
+def encode_into(src, dst):
+    """COBS-encode src into dst and return the encoded length.
+
+    dst must be a writable buffer of at least max_encoded_length(len(src))
+    bytes. No frame delimiter is appended."""
+    src = _get_buffer_view(src)
+    n = len(src)
+    if len(dst) < max_encoded_length(n):
+        raise ValueError('output buffer too small')
+    if _use_viper:
+        return _encode_viper(src, n, dst)
+    dst = memoryview(dst)
+    o = 0
+    start = 0
+    while True:
+        limit = start + 254
+        if limit > n:
+            limit = n
+        z = find_zero(src, start, limit)
+        if z >= 0:
+            # block terminated by a zero byte
+            run = z - start
+            dst[o] = run + 1
+            dst[o+1:o+1+run] = src[start:z]
+            o += run + 1
+            start = z + 1
+        elif limit - start == 254:
+            # full block without a zero
+            dst[o] = 0xFF
+            dst[o+1:o+255] = src[start:limit]
+            o += 255
+            start = limit
+            if start == n:
+                return o
+        else:
+            # final block
+            run = n - start
+            dst[o] = run + 1
+            dst[o+1:o+1+run] = src[start:n]
+            return o + run + 1
+
+
+def decode_into(src, dst):
+    """Decode the COBS-encoded src into dst and return the decoded length.
+
+    src must not include the frame delimiter. dst must be a writable buffer
+    at least as long as src. A DecodeError is raised if src is invalid."""
+    src = _get_buffer_view(src)
+    n = len(src)
+    if len(dst) < n:
+        raise ValueError('output buffer too small')
+    if _use_viper:
+        o = _decode_viper(src, n, dst)
+        if o == -1:
+            raise DecodeError("zero byte found in input")
+        if o == -2:
+            raise DecodeError("not enough input bytes for length code")
+        return o
+    dst = memoryview(dst)
+    i = 0
+    o = 0
+    while i < n:
+        code = src[i]
+        if code == 0:
+            raise DecodeError("zero byte found in input")
+        end = i + code
+        if end > n:
+            raise DecodeError("not enough input bytes for length code")
+        if find_zero(src, i + 1, end) >= 0:
+            raise DecodeError("zero byte found in input")
+        run = code - 1
+        dst[o:o+run] = src[i+1:end]
+        o += run
+        i = end
+        if i < n and code < 0xFF:
+            dst[o] = 0
+            o += 1
+    return o
+
+
+def encode(in_bytes):
+    """Encode a byte string using COBS and return the result as bytes."""
+    buf = bytearray(max_encoded_length(len(in_bytes)))
+    n = encode_into(in_bytes, buf)
+    return bytes(memoryview(buf)[:n])
+
+
+def decode(in_bytes):
+    """Decode a COBS-encoded byte string and return the result as bytes.
+
+    A DecodeError is raised if the encoded data is invalid."""
+    buf = bytearray(len(in_bytes))
+    n = decode_into(in_bytes, buf)
+    return bytes(memoryview(buf)[:n])
@@ -0,0 +1,198 @@
+# cobs_bench.py host-side round-trip fuzz test and benchmark for cobs.
+#
+# Checks encode_into()/decode_into() against the two COBS codecs they replaced, copied below as
+# they were: the one from main.py (the python-cobs algorithm, which cobs must match byte for byte,
+# including which corrupt frames it rejects) and the one from lte_mqtt-pico.py (which appended the
+# frame delimiter, encoded an empty payload as an empty frame and lost a zero byte at the end of
+# the payload or right after a full 254-byte block, so its frames are compared only for payloads
+# it could round-trip, and its decoder must read cobs frames). Payloads of random length and zero
+# density, plus the lengths around each 254-byte block, are round-tripped, and random garbage is
+# fed to both decoders. Then it reports bytes/s per frame size for each codec. Exits with status 1
+# on any mismatch.
+#
+# Usage: python3 cobs_bench.py [-n COUNT] [--seed N] [-t SECONDS]
+
+import sys, time, random, argparse
+import cobs
+
+# ===== main.py codec, before cobs.py
+
+def _main_encode(in_bytes):
+    in_bytes_mv = memoryview(in_bytes)
+    final_zero = True
+    out_bytes = bytearray()
+    idx = 0
+    search_start_idx = 0
+    for in_char in in_bytes_mv:
+        if in_char == 0:
+            final_zero = True
+            out_bytes.append(idx - search_start_idx + 1)
+            out_bytes += in_bytes_mv[search_start_idx:idx]
+            search_start_idx = idx + 1
+        else:
+            if idx - search_start_idx == 0xFD:
+                final_zero = False
+                out_bytes.append(0xFF)
+                out_bytes += in_bytes_mv[search_start_idx:idx+1]
+                search_start_idx = idx + 1
+        idx += 1
+    if idx != search_start_idx or final_zero:
+        out_bytes.append(idx - search_start_idx + 1)
+        out_bytes += in_bytes_mv[search_start_idx:idx]
+    return bytes(out_bytes)
+
+def _main_decode(in_bytes):
+    in_bytes_mv = memoryview(in_bytes)
+    out_bytes = bytearray()
+    idx = 0
+    if len(in_bytes_mv) > 0:
+        while True:
+            length = in_bytes_mv[idx]
+            if length == 0:
+                raise cobs.DecodeError("zero byte found in input")
+            idx += 1
+            end = idx + length - 1
+            copy_mv = in_bytes_mv[idx:end]
+            for b in copy_mv:
+                if b == 0:
+                    raise cobs.DecodeError("zero byte found in input")
+            out_bytes += copy_mv
+            idx = end
+            if idx > len(in_bytes_mv):
+                raise cobs.DecodeError("not enough input bytes for length code")
+            if idx < len(in_bytes_mv):
+                if length < 0xFF:
+                    out_bytes.append(0)
+            else:
+                break
+    return bytes(out_bytes)
+
+# ===== lte_mqtt-pico.py codec, before cobs.py
+
+def _lte_encode(data):
+    output = bytearray()
+    idx = 0
+    while idx < len(data):
+        block_start = len(output)
+        code = 1
+        output.append(0)  # placeholder
+        while idx < len(data) and data[idx] != 0 and code < 0xFF:
+            output.append(data[idx])
+            idx += 1
+            code += 1
+        output[block_start] = code
+        if idx < len(data) and data[idx] == 0:
+            idx += 1  # skip zero byte
+    output.append(0)  # frame delimiter
+    return bytes(output)
+
+def _lte_decode(frame):
+    output = bytearray()
+    idx = 0
+    while idx < len(frame):
+        code = frame[idx]
+        if code == 0 or idx + code > len(frame):
+            raise ValueError("Invalid COBS frame")
+        idx += 1
+        output.extend(frame[idx:idx + code - 1])
+        idx += code - 1
+        if code < 0xFF and idx < len(frame):
+            output.append(0)
+    return bytes(output)
+
+# ===== fuzz
+
+def _payload(rand, n):
+    # a payload of n bytes with a random share of zeros, from none to all
+    p = rand.choice((0, 0.001, 0.01, 0.1, 0.5, 1))
+    return bytes(0 if rand.random() < p else rand.randint(1, 255) for _ in range(n))
+
+def _decoded(fn, frame):
+    # fn(frame), or None if it rejects the frame
+    try:
+        return fn(frame)
+    except ValueError:
+        return None
+
+def _cobs_decode(frame):
+    out = bytearray(len(frame))
+    return bytes(out[:cobs.decode_into(frame, out)])
+
+def fuzz(count, seed):
+    rand = random.Random(seed)
+    enc = bytearray(cobs.max_encoded_length(2048))
+    dec = bytearray(2048)
+    sizes = [0, 1, 2] + [k * 254 + d for k in range(1, 5) for d in (-2, -1, 0, 1, 2)]
+    errors = {"round trip": 0, "main.py": 0, "lte": 0, "garbage": 0}
+    lte_lost = 0
+    for i in range(count):
+        data = _payload(rand, sizes[i] if i < len(sizes) else rand.randint(0, 1500))
+        n = cobs.encode_into(data, enc)
+        frame = bytes(enc[:n])
+        if 0 in frame or n > cobs.max_encoded_length(len(data)):
+            errors["round trip"] += 1
+        elif bytes(dec[:cobs.decode_into(frame, dec)]) != data:
+            errors["round trip"] += 1
+        if frame != _main_encode(data) or _main_decode(frame) != data:
+            errors["main.py"] += 1
+        if _lte_decode(frame) != data:
+            errors["lte"] += 1
+        lte = _lte_encode(data)
+        if _lte_decode(lte[:-1]) != data:
+            lte_lost += 1
+        elif data and lte != frame + b"\x00":
+            errors["lte"] += 1
+        # garbage, and frames with a byte corrupted or cut short, must be rejected or accepted
+        # exactly as main.py did
+        junk = [rand.randbytes(rand.randint(1, 40)), frame[:rand.randint(0, n)]]
+        if n:
+            b = bytearray(frame)
+            b[rand.randrange(n)] = rand.randrange(256)
+            junk.append(bytes(b))
+        for j in junk:
+            if _decoded(_cobs_decode, j) != _decoded(_main_decode, j):
+                errors["garbage"] += 1
+    return errors, lte_lost
+
+# ===== benchmark
+
+def _rate(fn, data, secs):
+    # bytes of data per second through fn
+    n = 0
+    t0 = time.perf_counter()
+    while True:
+        for _ in range(20):
+            fn(data)
+        n += 20
+        t = time.perf_counter() - t0
+        if t >= secs:
+            return n * len(data) / t
+
+def bench(secs, seed):
+    rand = random.Random(seed)
+    enc = bytearray(cobs.max_encoded_length(4096))
+    dec = bytearray(len(enc))
+    print("%6s %12s %12s %12s %12s %12s %12s  (MB/s)" % ("size", "enc main", "enc lte",
+        "encode_into", "dec main", "dec lte", "decode_into"))
+    for size in (16, 64, 256, 1024, 4096):
+        data = bytes(rand.randint(0, 255) for _ in range(size)) # about one zero in 256
+        frame = cobs.encode(data)
+        r = [_rate(_main_encode, data, secs), _rate(_lte_encode, data, secs),
+             _rate(lambda d: cobs.encode_into(d, enc), data, secs),
+             _rate(_main_decode, frame, secs), _rate(_lte_decode, frame, secs),
+             _rate(lambda f: cobs.decode_into(f, dec), frame, secs)]
+        print("%6d" % size + "".join(" %12.2f" % (x / 1e6) for x in r))
+
+def main(args):
+    errors, lte_lost = fuzz(args.count, args.seed)
+    print("%d payloads: %s" % (args.count, ", ".join("%s %d" % e for e in errors.items())))
+    print("the lte_mqtt-pico.py encoder lost a zero byte from %d payloads" % lte_lost)
+    bench(args.time, args.seed)
+    return any(errors.values())
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="cobs fuzz test and benchmark")
+    p.add_argument("-n", "--count", type=int, default=5000, help="payloads to round-trip")
+    p.add_argument("--seed", type=int, default=1, help="random seed")
+    p.add_argument("-t", "--time", type=float, default=0.2, help="seconds per benchmark")
+    sys.exit(1 if main(p.parse_args()) else 0)
@@ -0,0 +1,230 @@
+# cpy_fix.py CPython stand-ins for the MicroPython features used by mqtt_async, so it can be run
+# and benchmarked on a PC. It is imported by mqtt_async when the MicroPython imports fail and is not
+# needed on the Pico.
+#
+# Besides the names mqtt_async imports from here, it also registers minimal machine and uasyncio
+# modules (uasyncio's streams wrap non-blocking objects such as a fake UART) and adds
+# ticks_ms/ticks_diff/ticks_add to time, so the modules mqtt_async pulls in (dns_async, mqtt_tls,
+# ...) can use their usual MicroPython imports. The exception is const, which
+# those modules import from here when there is no micropython module: registering one would make
+# mqtt_async take its MicroPython import path.
+
+import sys, time, types, inspect, ssl
+import asyncio
+
+def const(x): return x
+
+# --- time
+
+_T0 = time.monotonic_ns()
+_TICKS_PERIOD = 1 << 30 # same as MicroPython's ticks on most ports
+_TICKS_HALF = _TICKS_PERIOD // 2
+
+def ticks_ms(): return ((time.monotonic_ns() - _T0) // 1000000) & (_TICKS_PERIOD - 1)
+
+def ticks_diff(a, b): return ((a - b + _TICKS_HALF) & (_TICKS_PERIOD - 1)) - _TICKS_HALF
+
+def ticks_add(t, delta): return (t + delta) & (_TICKS_PERIOD - 1)
+
+time.ticks_ms = ticks_ms
+time.ticks_diff = ticks_diff
+time.ticks_add = ticks_add
+
+# --- machine
+
+def unique_id(): return b"\xc0\xff\xee\x00\x00\x01"
+
+machine = types.ModuleType("machine")
+machine.unique_id = unique_id
+sys.modules.setdefault("machine", machine)
+
+# --- uasyncio: the standard asyncio plus the _ms variants MicroPython adds
+
+def _sleep_ms(ms): return asyncio.sleep(ms / 1000)
+
+def _wait_for_ms(aw, ms): return asyncio.wait_for(aw, ms / 1000)
+
+# ThreadSafeFlag is set from interrupt handlers on MicroPython; here only from the same thread.
+class _ThreadSafeFlag:
+
+    def __init__(self):
+        self._ev = asyncio.Event()
+
+    def set(self):
+        self._ev.set()
+
+    def clear(self):
+        self._ev.clear()
+
+    async def wait(self):
+        await self._ev.wait()
+        self._ev.clear()
+
+# _PollStream is uasyncio's StreamReader/StreamWriter for a non-blocking stream such as a
+# machine.UART, whose readinto() returns None when there is no data and write() how much it took,
+# or a non-blocking socket, which raises BlockingIOError instead. uasyncio waits in the scheduler's
+# poll, this yields to the other tasks until the stream is ready.
+class _PollStream:
+
+    def __init__(self, s, e=None):
+        self.s = s
+        self._out = bytearray()
+
+    async def readinto(self, buf):
+        while True:
+            n = self.s.readinto(buf)
+            if n:
+                return n
+            await asyncio.sleep(0)
+
+    async def read(self, n):
+        while True:
+            try:
+                r = self.s.read(n) if hasattr(self.s, "read") else self.s.recv(n)
+            except BlockingIOError:
+                r = None
+            if r is not None:
+                return r
+            await asyncio.sleep(0)
+
+    def write(self, buf):
+        self._out += buf
+
+    async def drain(self):
+        while self._out:
+            n = self.s.write(self._out)
+            if n:
+                del self._out[:n]
+            else:
+                await asyncio.sleep(0)
+
+asyncio.sleep_ms = _sleep_ms
+asyncio.wait_for_ms = _wait_for_ms
+asyncio.ThreadSafeFlag = _ThreadSafeFlag
+
+# uasyncio is asyncio with its own stream classes: asyncio's own StreamReader and StreamWriter
+# must stay as they are for asyncio.open_connection and start_server
+uasyncio = types.ModuleType("uasyncio")
+uasyncio.__dict__.update((k, v) for k, v in vars(asyncio).items() if not k.startswith("__"))
+uasyncio.StreamReader = uasyncio.StreamWriter = uasyncio.Stream = _PollStream
+sys.modules.setdefault("uasyncio", uasyncio)
+
+# _Stream combines the reader and writer returned by asyncio.open_connection into the single
+# bidirectional stream that MicroPython's open_connection returns (twice).
+# MicroPython wraps TLS around a connected stream by swapping its socket (stream.s), which asyncio's
+# streams can't do, so _Stream does TLS itself over memory BIOs once start_tls() has been called:
+# written data is encrypted by drain() and the handshake takes place on the first drain() or
+# readinto(), as it does on MicroPython. rx and tx count the bytes on the connection, encrypted.
+class _Stream:
+
+    def __init__(self, reader, writer):
+        self._r = reader
+        self._w = writer
+        self._tls = None # ssl.SSLObject once start_tls() has been called
+        self._shaken = False
+        self._plain = bytearray() # written, to be encrypted by drain()
+        self.rx = 0
+        self.tx = 0
+
+    # start_tls switches to TLS and returns the ssl.SSLObject, whose session attributes can be
+    # used once the handshake is done. session is a previous ssl.SSLSession to offer the server.
+    def start_tls(self, ctx, server_hostname=None, session=None):
+        self._in = ssl.MemoryBIO()
+        self._out = ssl.MemoryBIO()
+        self._tls = ctx.wrap_bio(self._in, self._out, server_hostname=server_hostname,
+            session=session)
+        return self._tls
+
+    async def readinto(self, buf):
+        if self._tls is None:
+            data = await self._r.read(len(buf))
+            self.rx += len(data)
+        else:
+            data = await self._tls_read(len(buf))
+        n = len(data)
+        buf[:n] = data
+        return n
+
+    def write(self, buf):
+        if self._tls is None:
+            self.tx += len(buf)
+            self._w.write(bytes(buf)) # copy, the caller reuses its buffers
+        else:
+            self._plain += buf
+
+    async def drain(self):
+        if self._tls is not None:
+            await self._handshake()
+            if self._plain:
+                self._tls.write(self._plain)
+                self._plain = bytearray()
+            self._flush()
+        await self._w.drain()
+
+    def close(self):
+        self._w.close()
+
+    async def wait_closed(self):
+        try:
+            await self._w.wait_closed()
+        except OSError:
+            pass
+
+    # _flush sends what the TLS object has produced
+    def _flush(self):
+        data = self._out.read()
+        if data:
+            self.tx += len(data)
+            self._w.write(data)
+
+    # _feed flushes and passes the TLS object what comes back, it returns False on EOF
+    async def _feed(self):
+        self._flush()
+        await self._w.drain()
+        data = await self._r.read(4096)
+        if not data:
+            return False
+        self.rx += len(data)
+        self._in.write(data)
+        return True
+
+    async def _handshake(self):
+        while not self._shaken:
+            try:
+                self._tls.do_handshake()
+                self._shaken = True
+            except ssl.SSLWantReadError:
+                if not await self._feed():
+                    raise ConnectionResetError("connection closed during TLS handshake")
+        self._flush()
+
+    async def _tls_read(self, n):
+        await self._handshake()
+        while True:
+            try:
+                return self._tls.read(n)
+            except ssl.SSLZeroReturnError:
+                return b""
+            except ssl.SSLWantReadError:
+                if not await self._feed():
+                    return b""
+
+async def open_connection(addr):
+    return _Stream(*await asyncio.open_connection(addr[0], addr[1]))
+
+# --- network interface
+
+class DummyInterface:
+    def isconnected(self):
+        return True
+    def active(self, val=None):
+        pass
+    def disconnect(self):
+        pass
+
+STA_IF = DummyInterface()
+
+def is_awaitable(f): return inspect.isawaitable(f)
+
+__all__ = ["const", "ticks_ms", "ticks_diff", "ticks_add", "asyncio", "open_connection",
+    "unique_id", "DummyInterface", "STA_IF", "is_awaitable"]
@@ -0,0 +1,53 @@
+"""
+CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF, no reflection,
+no final XOR) for checking frames on the UART link.
+
+The 256-entry lookup table is computed once at import, so checking a frame
+costs one table lookup per byte.
+"""
+
+try:
+    import micropython
+    _use_viper = hasattr(micropython, 'viper')
+except ImportError:
+    _use_viper = False
+
+
+def _make_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        table.append(crc & 0xFFFF)
+    return table
+
+# kept as a bytearray of big-endian pairs, which viper can index directly
+_TABLE = bytearray(512)
+for _i, _v in enumerate(_make_table()):
+    _TABLE[2*_i] = _v >> 8
+    _TABLE[2*_i+1] = _v & 0xFF
+
+
+if _use_viper:
+    @micropython.viper
+    def _crc_viper(buf: ptr8, n: int, crc: int) -> int:
+        table = ptr8(_TABLE)
+        i = 0
+        while i < n:
+            j = ((crc >> 8) ^ buf[i]) & 0xFF
+            crc = ((crc << 8) & 0xFF00) ^ (table[2*j] << 8) ^ table[2*j+1]
+            i += 1
+        return crc
+
+
+def crc16(buf, crc=0xFFFF):
+    """Return the CRC of buf. Pass the result back in as crc to continue a
+    calculation over several buffers."""
+    if _use_viper:
+        return _crc_viper(buf, len(buf), crc)
+    table = _TABLE
+    for b in buf:
+        j = ((crc >> 8) ^ b) & 0xFF
+        crc = ((crc << 8) & 0xFF00) ^ (table[2*j] << 8) ^ table[2*j+1]
+    return crc
@@ -0,0 +1,166 @@
+# dns_async.py non-blocking DNS resolver with a persistent cache, for use with uasyncio.
+#
+# socket.getaddrinfo blocks the whole event loop while it waits for the DNS server, which over PPP
+# can take seconds. Resolver instead sends a single A-record query over UDP and waits for the
+# answer in the uasyncio scheduler's poll, so other tasks keep running and the loop isn't woken
+# until the answer arrives or the time-out expires.
+#
+# Answers are cached for their TTL (but at least min_ttl seconds) and the cache is saved to a
+# small JSON file whenever an address changes, so the flash isn't rewritten on every refresh.
+# Entries loaded from the file after a reboot are treated as stale: they are returned straight away
+# so a connection can be made without waiting, and the caller is expected to refresh them in the
+# background.
+
+import socket, struct, json
+try:
+    from micropython import const
+except ImportError:
+    from cpy_fix import const
+from time import ticks_ms, ticks_diff, ticks_add
+import uasyncio as asyncio
+
+_QTYPE_A = const(1)
+_QCLASS_IN = const(1)
+
+# is_ip_addr returns True if host is a dotted-quad IPv4 address
+def is_ip_addr(host):
+    parts = host.split(".")
+    if len(parts) != 4:
+        return False
+    for p in parts:
+        if not p.isdigit() or int(p) > 255:
+            return False
+    return True
+
+# _skip_name returns the index after the (possibly compressed) domain name at buf[i]
+def _skip_name(buf, i):
+    while True:
+        n = buf[i]
+        if n == 0:
+            return i + 1
+        if n & 0xC0 == 0xC0: # compression pointer
+            return i + 2
+        i += 1 + n
+
+class Resolver:
+
+    def __init__(self, server=None, path="dns_cache.json", timeout_ms=2000, retries=2,
+            min_ttl=60):
+        self.server = server # DNS server IP address, None to ask the network stack
+        self._path = path
+        self._timeout_ms = timeout_ms
+        self._retries = retries
+        self._min_ttl = min_ttl
+        self._cache = {}     # host -> [ip, ticks_ms expiry or None if stale]
+        self._id = 0
+        self.queries = 0     # number of DNS queries sent
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._path) as f:
+                for host, ip in json.load(f).items():
+                    self._cache[host] = [ip, None]
+        except (OSError, ValueError):
+            pass
+
+    def _save(self):
+        try:
+            with open(self._path, "w") as f:
+                json.dump(dict((h, e[0]) for h, e in self._cache.items()), f)
+        except OSError:
+            pass # the cache is only an optimization
+
+    # _server returns the DNS server to use, or None if there is none
+    def _server(self):
+        if self.server is not None:
+            return self.server
+        try:
+            import network
+            return network.ipconfig("dns")
+        except Exception:
+            return None
+
+    # cached returns the cached address for host and whether it is still fresh, or (None, False)
+    def cached(self, host):
+        e = self._cache.get(host)
+        if e is None:
+            return None, False
+        return e[0], e[1] is not None and ticks_diff(e[1], ticks_ms()) > 0
+
+    # resolve returns the IPv4 address of host as a string. Unless force is set a fresh cached
+    # answer is returned without querying. It raises an OSError if the name can't be resolved.
+    async def resolve(self, host, force=False):
+        if is_ip_addr(host):
+            return host
+        ip, fresh = self.cached(host)
+        if fresh and not force:
+            return ip
+        server = self._server()
+        if server is None:
+            # no DNS server known, fall back to the (blocking) system resolver
+            ip = socket.getaddrinfo(host, 0)[0][-1][0]
+            ttl = self._min_ttl
+        else:
+            ip, ttl = await self._query(server, host)
+        e = self._cache.get(host)
+        self._cache[host] = [ip, ticks_add(ticks_ms(), max(ttl, self._min_ttl) * 1000)]
+        if e is None or e[0] != ip:
+            self._save()
+        return ip
+
+    async def _query(self, server, host):
+        self._id = (self._id + 1) & 0xFFFF
+        q = bytearray(struct.pack("!HHHHHH", self._id, 0x0100, 1, 0, 0, 0)) # recursion desired
+        for label in host.split("."):
+            q.append(len(label))
+            q += label.encode()
+        q += struct.pack("!BHH", 0, _QTYPE_A, _QCLASS_IN)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.setblocking(False)
+            sr = asyncio.StreamReader(s)
+            addr = socket.getaddrinfo(server, 53)[0][-1]
+            for _ in range(self._retries + 1):
+                self.queries += 1
+                s.sendto(q, addr)
+                t0 = ticks_ms()
+                while True:
+                    left = self._timeout_ms - ticks_diff(ticks_ms(), t0)
+                    if left <= 0:
+                        break
+                    try:
+                        resp = await asyncio.wait_for_ms(sr.read(512), left)
+                    except asyncio.TimeoutError:
+                        break
+                    res = self._parse(resp)
+                    if res is not None:
+                        return res
+        finally:
+            s.close()
+        raise OSError(-1, "DNS lookup failed", host)
+
+    # _parse returns (ip, ttl) from a response to our current query, or None if it isn't one.
+    # It raises an OSError if the server says the name doesn't resolve.
+    def _parse(self, resp):
+        if len(resp) < 12:
+            return None
+        rid, flags, qd, an, _, _ = struct.unpack_from("!HHHHHH", resp)
+        if rid != self._id or not flags & 0x8000:
+            return None
+        if flags & 0xF:
+            raise OSError(-1, "DNS error", flags & 0xF)
+        i = 12
+        for _ in range(qd):
+            i = _skip_name(resp, i) + 4
+        ttl = None
+        for _ in range(an):
+            i = _skip_name(resp, i)
+            rtype, rclass, rttl, rlen = struct.unpack_from("!HHIH", resp, i)
+            i += 10
+            # follow CNAME chains implicitly: the TTL is the smallest along the way
+            ttl = rttl if ttl is None else min(ttl, rttl)
+            if rtype == _QTYPE_A and rclass == _QCLASS_IN and rlen == 4:
+                return "%d.%d.%d.%d" % tuple(resp[i:i+4]), ttl
+            i += rlen
+        raise OSError(-1, "DNS no address")
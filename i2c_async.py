@@ -0,0 +1,95 @@
+import uasyncio as asyncio
+from i2c_responder import I2CResponder
+
+
+class Transaction:
+    """One I2C transaction, as yielded by AsyncI2CResponder.
+
+    Attributes:
+        data: The I2C WRITE data, empty if there was none: bytes with irq=True, a memoryview
+            into the receive buffer when polling, which is only valid until the next
+            transaction is fetched.
+        read (bool): True while the Controller is waiting for I2C READ data, which must be
+            sent with respond().
+    """
+
+    def __init__(self, responder):
+        self._responder = responder
+        self.data = b""
+        self.read = False
+
+    def respond(self, data):
+        """Send the I2C READ data the Controller is waiting for."""
+        self._responder.put_read_bytes(data)
+        self.read = False
+
+
+class AsyncI2CResponder:
+    """uasyncio front end to an I2CResponder.
+
+    Serve transactions with `async for transaction in responder:`; a WRITE of a register number
+    and the READ that follows come as one transaction. Between transactions the loop yields to
+    the other tasks: by default it uses the responder's interrupt-driven mode and sleeps until a
+    transaction arrives, with irq=False it polls the FIFOs every poll_ms instead. A READ that is
+    left unanswered when the next transaction is fetched gets a single zero byte, so the
+    Controller isn't held up.
+
+    Polling is only safe with Controllers that leave more than poll_ms between WRITEs: the Rx
+    FIFO doesn't show where one WRITE ends and the next begins, so WRITEs that arrive between
+    two polls come as one transaction, and a WRITE still arriving may be split. The
+    interrupt-driven mode records the end of each WRITE and yields them separately.
+
+    Args:
+        responder (I2CResponder): The responder to serve.
+        poll_ms (int, optional): How often to check for transactions when polling.
+        irq (bool, optional): Use the responder's interrupt-driven mode; False to poll.
+        bufsize (int, optional): The longest WRITE expected, in bytes.
+    """
+
+    def __init__(self, responder, poll_ms=1, irq=True, bufsize=32):
+        self.responder = responder
+        self._poll_ms = poll_ms
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._t = Transaction(responder)
+        self._flag = None
+        if irq:
+            self._pending = []  # (WRITE data, READ pending) copied by the irq() handler
+            self._flag = asyncio.ThreadSafeFlag()
+            responder.irq(self._irq_handler)
+
+    def _irq_handler(self, responder, events):
+        # Scheduled, not hard, interrupt context: each WRITE that has ended is copied out as a
+        # transaction of its own; a READ belongs with the last one
+        n = responder.readinto(self._buf) if events & I2CResponder.IRQ_WRITE else 0
+        while n:
+            data = bytes(self._view[:n])
+            n = responder.readinto(self._buf)
+            self._pending.append((data, not n and bool(events & I2CResponder.IRQ_READ)))
+        if events & I2CResponder.IRQ_READ and not (self._pending and self._pending[-1][1]):
+            self._pending.append((b"", True))
+        self._flag.set()
+
+    def close(self):
+        """Stop serving; with irq=True the responder goes back to polled mode."""
+        if self._flag is not None:
+            self.responder.irq(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        t = self._t
+        if t.read:
+            t.respond(b"\x00")  # the previous READ was left unanswered
+        r = self.responder
+        if self._flag is None:
+            while not (r.write_data_is_available() or r.read_is_pending()):
+                await asyncio.sleep_ms(self._poll_ms)
+            t.data = self._view[:r.readinto(self._buf)]
+            t.read = r.read_is_pending()
+        else:
+            while not self._pending:
+                await self._flag.wait()
+            t.data, t.read = self._pending.pop(0)
+        return t
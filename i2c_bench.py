@@ -0,0 +1,124 @@
+# i2c_bench.py host-side benchmark of the I2CResponder FIFO paths, on the i2c_fake registers.
+#
+# Moves COUNT transactions of SIZE bytes each way through the fake FIFOs, once with the
+# byte-at-a-time loops (get_write_data(), and the Tx loop put_read_bytes() used to have) and once
+# with readinto()/write_from(), and reports register accesses per byte, which is what limits the
+# Pico, and the host time per byte for what it's worth. Then it moves a BLOCK-byte READ and WRITE,
+# larger than the FIFOs, once with write_from()/readinto() polled as the Controller clocks bytes
+# and once by DMA, and reports the CPU's register accesses per block. The blocks hold every byte
+# value, and an AssertionError is raised if one arrives corrupted or a READ is aborted.
+#
+# Usage: python3 i2c_bench.py [-n COUNT] [-s SIZE] [-b BLOCK]
+
+import time, argparse
+from cpy_fix import asyncio
+import i2c_fake
+
+mem32 = i2c_fake.install()
+from i2c_responder import I2CResponder
+
+
+def _legacy_put(r, data):
+    # put_read_bytes() before readinto()/write_from(): the address is rebuilt for every byte
+    for byte in data:
+        mem32[r.i2c_base | r.IC_DATA_CMD] = byte & 0xFF
+
+
+def _run(name, count, size, rx, tx):
+    r = I2CResponder(1, sda_gpio=26, scl_gpio=27)
+    dev = mem32.i2c[r.i2c_base]
+    size = min(size, i2c_fake.FIFO_DEPTH)
+    data = bytes(range(size))
+    buf = bytearray(size)
+    got = 0
+    rx_ns = tx_ns = 0
+    rx_acc = tx_acc = 0
+    for _ in range(count):
+        dev.controller_write(data)
+        a = mem32.reads + mem32.writes
+        t = time.perf_counter_ns()
+        got += rx(r, buf)
+        rx_ns += time.perf_counter_ns() - t
+        rx_acc += mem32.reads + mem32.writes - a
+        a = mem32.reads + mem32.writes
+        t = time.perf_counter_ns()
+        tx(r, data)
+        tx_ns += time.perf_counter_ns() - t
+        tx_acc += mem32.reads + mem32.writes - a
+        if dev.controller_read(size) != data:
+            raise AssertionError("READ data corrupted")
+    if got != count * size:
+        raise AssertionError("WRITE data lost")
+    n = count * size
+    print("%-12s Rx %5.2f acc/B %7.0f ns/B   Tx %5.2f acc/B %7.0f ns/B   overruns %d/%d" % (name,
+        rx_acc / n, rx_ns / n, tx_acc / n, tx_ns / n, r.rx_overruns, r.tx_overruns))
+
+
+def _block(name, size, dma):
+    r = I2CResponder(1, sda_gpio=26, scl_gpio=27)
+    dev = mem32.i2c[r.i2c_base]
+    data = bytes(i & 0xFF for i in range(size))
+    buf = bytearray(size)
+    r.set_reg(r.IC_CON, r.IC_CON__RX_FIFO_FULL_HLD_CTRL)
+    if dma:
+        r.dma_init()
+    # READ: the Controller clocks the block out a FIFO's worth at a time
+    dev.controller_request_read()
+    a = mem32.reads + mem32.writes
+    got = bytearray()
+    if dma:
+        t = r.put_read_dma(data)
+    else:
+        pos = r.write_from(data)
+        mem32[r.i2c_base | r.IC_CLR_RD_REQ]
+    while len(got) < size:
+        chunk = dev.controller_read(i2c_fake.FIFO_DEPTH, stop=False)
+        if not chunk:
+            break
+        got += chunk
+        if not dma:
+            pos += r.write_from(data, pos)
+    if dev.raw() & i2c_fake.TX_ABRT:
+        raise AssertionError("READ aborted")
+    if dma and asyncio.run(t.wait()) != size:
+        raise AssertionError("READ DMA incomplete")
+    tx_acc = mem32.reads + mem32.writes - a
+    if bytes(got) != data:
+        raise AssertionError("READ data corrupted")
+    dev.controller_read(0)
+    # WRITE: the Controller sends the block, the Rx FIFO holds the bus when it's full
+    a = mem32.reads + mem32.writes
+    if dma:
+        t = r.readinto_dma(buf)
+    sent = n = 0
+    while sent < size:
+        sent += dev.controller_write(data[sent:], stop=sent + i2c_fake.FIFO_DEPTH >= size,
+            start=not sent)
+        if not dma:
+            n += r.readinto(memoryview(buf)[n:])
+    if dma:
+        n = asyncio.run(t.wait())
+        r.dma_deinit()
+    rx_acc = mem32.reads + mem32.writes - a
+    if n != size or bytes(buf) != data:
+        raise AssertionError("WRITE data lost")
+    print("%-12s READ %5d acc   WRITE %5d acc" % (name, tx_acc, rx_acc))
+
+
+def main(args):
+    print("%d x %dB transactions each way" % (args.count, args.size))
+    _run("byte loops", args.count, args.size, lambda r, buf: len(r.get_write_data(len(buf))),
+         _legacy_put)
+    _run("burst", args.count, args.size, lambda r, buf: r.readinto(buf),
+         lambda r, data: r.write_from(data))
+    print("%dB block each way" % args.block)
+    _block("polled", args.block, False)
+    _block("DMA", args.block, True)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="I2CResponder FIFO benchmark")
+    p.add_argument("-n", "--count", type=int, default=2000, help="transactions")
+    p.add_argument("-s", "--size", type=int, default=16, help="bytes per transaction, at most 16")
+    p.add_argument("-b", "--block", type=int, default=512, help="bytes per block transfer")
+    main(p.parse_args())
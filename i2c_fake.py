@@ -0,0 +1,321 @@
+# i2c_fake.py register-level stand-in for the RP2040 I2C block, so i2c_responder can be run and
+# benchmarked on a PC. install() puts a fake mem32 (plus the few other machine names i2c_responder
+# imports) in the machine module; it must be called before i2c_responder is imported.
+#
+# The fake decodes the I2C0 and I2C1 register blocks: the Rx and Tx FIFOs with their level
+# registers, the raw and masked interrupt status (RX_OVER, RX_FULL, TX_OVER, TX_EMPTY, RD_REQ,
+# TX_ABRT, STOP_DET, START_DET), the IC_CLR_* registers and the atomic SET/CLR/XOR register aliases.
+# Everything else is plain memory. Rx FIFO entries carry IC_DATA_CMD's FIRST_DATA_BYTE flag. The
+# controller_* methods play the other end of the bus, and every register access the CPU makes is
+# counted, which is the figure that carries over to the Pico.
+#
+# Writing IC_DATA_CMD with CMD (bit 8) set, which a responder must not do, raises TX_ABRT and
+# flushes the Tx FIFO, which then drops data until IC_CLR_TX_ABRT is accessed.
+#
+# install() also provides rp2.DMA channels that move bytes or words between buffers and the FIFOs
+# as the I2C DREQs (IC_DMA_CR, IC_DMA_TDLR, IC_DMA_RDLR) allow, while the Controller reads and
+# writes; as on the RP2040, a byte or halfword a channel writes to a register is copied into every
+# byte lane of the word. And it provides a machine.Pin whose irq() handler fall() calls, as a
+# falling edge on the pin would; the fake doesn't tie the pins to the bus, so it's up to the
+# caller to call it for each START.
+
+import sys, types
+
+I2C0_BASE = 0x40044000
+I2C1_BASE = 0x40048000
+
+FIFO_DEPTH = 16
+
+RX_OVER = 0x02
+RX_FULL = 0x04
+TX_OVER = 0x08
+TX_EMPTY = 0x10
+RD_REQ = 0x20
+TX_ABRT = 0x40
+STOP_DET = 0x200
+START_DET = 0x400
+_LEVEL = RX_FULL | TX_EMPTY # follow the FIFO levels, can't be cleared
+
+RX_FIFO_FULL_HLD_CTRL = 0x200
+FIRST_DATA_BYTE = 0x800 # IC_DATA_CMD flag of the first byte of a WRITE
+CMD = 0x100 # IC_DATA_CMD read command, controller mode only
+
+
+class FakeI2C:
+    """One I2C block, with the Controller's side of the bus."""
+
+    def __init__(self, pump):
+        self.regs = {}
+        self.rx = [] # Controller -> responder
+        self.tx = [] # responder -> Controller
+        self._raw = 0
+        self._pump = pump # runs the DMA channels
+
+    def dreq(self, tx):
+        """Return True if the Tx (or Rx) FIFO is asking for DMA."""
+        cr = self.regs.get(0x88, 0) # IC_DMA_CR
+        if tx:
+            return bool(cr & 2) and len(self.tx) <= self.regs.get(0x8C, 0) # IC_DMA_TDLR
+        return bool(cr & 1) and len(self.rx) > self.regs.get(0x90, 0) # IC_DMA_RDLR
+
+    def raw(self):
+        r = self._raw
+        if len(self.rx) > self.regs.get(0x38, 0): # IC_RX_TL
+            r |= RX_FULL
+        if len(self.tx) <= self.regs.get(0x3C, 0): # IC_TX_TL
+            r |= TX_EMPTY
+        return r
+
+    def read(self, off):
+        if off == 0x10: # IC_DATA_CMD
+            return self.rx.pop(0) if self.rx else 0
+        if off == 0x2C: # IC_INTR_STAT
+            return self.raw() & self.regs.get(0x30, 0)
+        if off == 0x34: # IC_RAW_INTR_STAT
+            return self.raw()
+        if off == 0x40: # IC_CLR_INTR
+            self._raw &= _LEVEL
+            return 0
+        clr = {0x48: RX_OVER, 0x4C: TX_OVER, 0x50: RD_REQ, 0x54: TX_ABRT, 0x60: STOP_DET,
+               0x64: START_DET}.get(off)
+        if clr is not None:
+            self._raw &= ~clr
+            return 0
+        if off == 0x74: # IC_TX_FLR
+            return len(self.tx)
+        if off == 0x78: # IC_RX_FLR
+            return len(self.rx)
+        return self.regs.get(off, 0)
+
+    def write(self, off, value):
+        if off == 0x10:
+            if value & CMD:
+                self._raw |= TX_ABRT
+                self.tx.clear()
+            elif self._raw & TX_ABRT:
+                pass # the Tx FIFO is held flushed
+            elif len(self.tx) < FIFO_DEPTH:
+                self.tx.append(value & 0xFF)
+            else:
+                self._raw |= TX_OVER
+        elif off == 0x54: # IC_CLR_TX_ABRT, through an atomic alias
+            self._raw &= ~TX_ABRT
+        else:
+            self.regs[off] = value
+
+    # ===== the Controller's side
+
+    def controller_write(self, data, stop=True, start=True):
+        """WRITE data to the responder. Returns the number of bytes taken: less than len(data)
+        if the Rx FIFO filled up and holds the bus. start=False carries on with the WRITE the
+        last call left off, rather than starting one (after a START or RESTART)."""
+        for n, byte in enumerate(data):
+            if len(self.rx) >= FIFO_DEPTH:
+                if self.regs.get(0, 0) & RX_FIFO_FULL_HLD_CTRL:
+                    return n
+                self._raw |= RX_OVER
+                continue
+            if start and not n:
+                self._raw |= START_DET
+            self.rx.append(byte | (FIRST_DATA_BYTE if start and not n else 0))
+            self._pump()
+        if stop:
+            self._raw |= STOP_DET
+        return len(data)
+
+    def controller_request_read(self):
+        """Start a READ: raises RD_REQ, which the responder answers by filling the Tx FIFO."""
+        self._raw |= RD_REQ | START_DET # after a RESTART
+
+    def controller_read(self, n, stop=True):
+        """Clock out up to n bytes from the Tx FIFO."""
+        data = bytearray()
+        self._pump()
+        while len(data) < n and self.tx:
+            data.append(self.tx.pop(0))
+            self._pump()
+        if stop:
+            self._raw |= STOP_DET
+        return data
+
+
+class Mem32:
+    """Fake machine.mem32 covering the I2C blocks."""
+
+    def __init__(self):
+        self.i2c = {I2C0_BASE: FakeI2C(self.pump), I2C1_BASE: FakeI2C(self.pump)}
+        self.mem = {}
+        self.dma = [] # FakeDMA channels
+        self.reads = 0
+        self.writes = 0
+
+    def _decode(self, addr):
+        method = addr & 0x3000
+        base = addr & ~0x3FFF
+        return self.i2c.get(base), addr & 0xFFF, method
+
+    def __getitem__(self, addr):
+        self.reads += 1
+        return self.read(addr)
+
+    def __setitem__(self, addr, value):
+        self.writes += 1
+        self.write(addr, value)
+        self.pump()
+
+    # uncounted accesses, as made by DMA
+
+    def read(self, addr):
+        dev, off, method = self._decode(addr)
+        if dev is None:
+            return self.mem.get(addr & ~0x3000, 0)
+        return dev.read(off)
+
+    def write(self, addr, value):
+        dev, off, method = self._decode(addr)
+        old = self.mem.get(addr & ~0x3000, 0) if dev is None else dev.regs.get(off, 0)
+        if method == 0x1000:
+            value ^= old
+        elif method == 0x2000:
+            value |= old
+        elif method == 0x3000:
+            value = old & ~value
+        if dev is None:
+            self.mem[addr & ~0x3000] = value
+        else:
+            dev.write(off, value)
+
+    def pump(self):
+        """Let the DMA channels move what their DREQs allow."""
+        moved = True
+        while moved:
+            moved = False
+            for ch in self.dma:
+                if ch.step():
+                    moved = True
+
+
+# DREQ numbers of the I2C FIFOs, and which block and direction they belong to
+_DREQ = {32: (I2C0_BASE, True), 33: (I2C0_BASE, False), 34: (I2C1_BASE, True), 35: (I2C1_BASE, False)}
+
+
+class FakeDMA:
+    """The part of rp2.DMA that i2c_responder uses: transfers paced by an I2C DREQ."""
+
+    def __init__(self):
+        self._mem = _mem32
+        self._mem.dma.append(self)
+        self._active = False
+        self.count = 0
+        self._handler = None
+
+    def pack_ctrl(self, size=2, inc_read=True, inc_write=True, treq_sel=0x3F, irq_quiet=True, **kw):
+        return {"size": size, "inc_read": inc_read, "inc_write": inc_write, "treq_sel": treq_sel,
+                "irq_quiet": irq_quiet}
+
+    def config(self, read=None, write=None, count=None, ctrl=None, trigger=False):
+        if ctrl["size"] not in (0, 1, 2):
+            raise ValueError("invalid transfer size")
+        self._read, self._write, self._ctrl = read, write, ctrl
+        self._ri = self._wi = 0
+        self.count = count
+        if trigger:
+            self.active(True)
+
+    def active(self, value=None):
+        if value is None:
+            return self._active
+        self._active = bool(value) and self.count > 0
+        self._mem.pump()
+
+    def irq(self, handler=None, hard=False):
+        self._handler = handler
+
+    def close(self):
+        self._active = False
+        self._mem.dma.remove(self)
+
+    def step(self):
+        # Move one byte if active and the DREQ allows it
+        if not self._active:
+            return False
+        base, tx = _DREQ[self._ctrl["treq_sel"]]
+        if not self._mem.i2c[base].dreq(tx):
+            return False
+        ctrl = self._ctrl
+        width = 1 << ctrl["size"]
+        mask = (1 << 8 * width) - 1
+        if isinstance(self._read, int):
+            value = self._mem.read(self._read + self._ri) & mask
+        else:
+            value = int.from_bytes(self._read[self._ri:self._ri+width], "little")
+        if isinstance(self._write, int):
+            # a narrow write is copied into every byte lane
+            self._mem.write(self._write + self._wi, value * (0xFFFFFFFF // mask))
+        else:
+            self._write[self._wi:self._wi+width] = value.to_bytes(width, "little")
+        self._ri += width * ctrl["inc_read"]
+        self._wi += width * ctrl["inc_write"]
+        self.count -= 1
+        if not self.count:
+            self._active = False
+            if not ctrl["irq_quiet"] and self._handler is not None:
+                self._handler(self)
+        return True
+
+
+_mem32 = None
+
+
+class _Timer:
+    PERIODIC = 1
+    ONE_SHOT = 0
+
+    def __init__(self, *args, **kwargs):
+        self.init(**kwargs)
+
+    def init(self, **kwargs):
+        self.callback = kwargs.get("callback")
+
+    def deinit(self):
+        self.callback = None
+
+
+class _Pin:
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, *args, **kwargs):
+        self.id = id
+        self._handler = None
+        self._trigger = 0
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self._handler = handler
+        self._trigger = trigger
+
+    def fall(self):
+        """Call the irq() handler as a falling edge would."""
+        if self._handler is not None and self._trigger & self.IRQ_FALLING:
+            self._handler(self)
+
+
+def install():
+    """Install the fake mem32 in the machine module, and rp2.DMA, and return the mem32."""
+    global _mem32
+    machine = sys.modules.get("machine")
+    if machine is None:
+        machine = types.ModuleType("machine")
+        sys.modules["machine"] = machine
+    mem32 = _mem32 = Mem32()
+    machine.mem32 = mem32
+    machine.Timer = _Timer
+    machine.Pin = _Pin
+    machine.disable_irq = lambda: 0
+    machine.enable_irq = lambda state: None
+    rp2 = sys.modules.get("rp2")
+    if rp2 is None:
+        rp2 = types.ModuleType("rp2")
+        sys.modules["rp2"] = rp2
+    rp2.DMA = FakeDMA
+    return mem32
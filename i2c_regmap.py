@@ -0,0 +1,209 @@
+import struct
+
+class Register:
+    """Declaration of one register served by a RegisterMap.
+
+    The register's value is kept packed in the map's register image, so a READ of a plain
+    register is served straight from it. A register with a read callback is refreshed from it
+    just before each READ instead; one with a write callback is passed the new value after each
+    WRITE, unpacked.
+
+    Args:
+        addr (int): The register number, 0..255.
+        fmt (str): The struct format of the register's value, e.g. '<H'.
+        access (str, optional): 'r', 'w' or 'rw'.
+        read (callable, optional): Returns the value to read, a tuple if fmt has several fields.
+        write (callable, optional): Called with the field(s) of a written value.
+        clear_on_read (bool, optional): Zero the stored value after it has been read.
+        value (optional): Initial value, a tuple if fmt has several fields.
+    """
+
+    def __init__(self, addr, fmt, access="rw", read=None, write=None, clear_on_read=False, value=None):
+        if not 0 <= addr <= 255:
+            raise ValueError("register address out of range")
+        if access not in ("r", "w", "rw"):
+            raise ValueError("bad access " + access)
+        self.addr = addr
+        self.fmt = fmt
+        self.size = struct.calcsize(fmt)
+        self.access = access
+        self.read = read
+        self.write = write
+        self.clear_on_read = clear_on_read
+        self.value = value
+        self.single = _nfields(fmt) == 1
+        self.off = 0  # offset in the register image, set by RegisterMap
+        self.run = ()  # registers served by a READ starting here, set by RegisterMap
+        self.view = None  # the image bytes of the run, set by RegisterMap
+
+
+def _nfields(fmt):
+    # Count the values a struct format packs ('10s' is one, '3B' three)
+    n = 0
+    count = ""
+    for c in fmt:
+        if c in "0123456789":
+            count += c
+        elif c not in "<>!=@ ":
+            n += 1 if c in "sp" or not count else int(count)
+            count = ""
+    return n
+
+
+class RegisterMap:
+    """Register file served over an I2CResponder.
+
+    A transaction that WRITEs a register number and nothing else selects the register for the
+    READ that follows. A WRITE with data stores it in that register and, if there is more, the
+    registers at the following addresses, in turn. A READ returns the selected register and,
+    for Controllers that read on, the following registers (auto-increment): a burst READ runs
+    up to a gap in the register numbers, a write-only register, a clear-on-read register or
+    max_burst bytes, whichever comes first. Unknown registers read as a single zero byte.
+
+    Dispatch is a lookup in a 256-entry table and each run of registers is a precomputed
+    memoryview into one preallocated register image, so a READ of plain registers costs no
+    packing and no allocation.
+
+    Use handle() as the responder's irq() handler, call poll() in a polled loop, or pass the
+    transactions of an AsyncI2CResponder to serve().
+
+    Args:
+        responder (I2CResponder): The responder to serve the registers over.
+        registers (list): The Register declarations.
+        max_burst (int, optional): Longest READ in bytes; without irq() the whole READ has
+            to fit in the Tx FIFO.
+    """
+
+    def __init__(self, responder, registers, max_burst=16):
+        self.responder = responder
+        self._table = [None] * 256
+        for reg in registers:
+            if self._table[reg.addr] is not None:
+                raise ValueError("register %d declared twice" % reg.addr)
+            self._table[reg.addr] = reg
+        regs = sorted(registers, key=lambda reg: reg.addr)
+        off = 0
+        for reg in regs:
+            reg.off = off
+            off += reg.size
+        self._image = bytearray(off)
+        view = memoryview(self._image)
+        for i, reg in enumerate(regs):
+            if reg.value is not None:
+                self._pack(reg, reg.value)
+            run = [reg]
+            end = reg.off + reg.size
+            for nxt in regs[i + 1:]:
+                if (nxt.addr != run[-1].addr + 1 or nxt.access == "w" or nxt.clear_on_read
+                        or end + nxt.size - reg.off > max_burst):
+                    break
+                run.append(nxt)
+                end += nxt.size
+            reg.run = tuple(run)
+            reg.view = view[reg.off:end]
+        self._zero = b"\x00"
+        self._wbuf = bytearray(1 + off)  # a register number and data for all the registers
+        self._wview = memoryview(self._wbuf)
+        self._prefix = 0  # register selected for the next READ
+        self._cleared = None  # clear-on-read register to zero once its READ is over
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0  # WRITEs to read-only registers, or of the wrong length
+
+    def _pack(self, reg, value):
+        if reg.single:
+            struct.pack_into(reg.fmt, self._image, reg.off, value)
+        else:
+            struct.pack_into(reg.fmt, self._image, reg.off, *value)
+
+    def _clear_pending(self):
+        reg = self._cleared
+        if reg is not None:
+            self._cleared = None
+            for i in range(reg.off, reg.off + reg.size):
+                self._image[i] = 0
+
+    def get(self, addr):
+        """Return the stored value of register addr, a tuple if it has several fields."""
+        self._clear_pending()
+        reg = self._table[addr]
+        value = struct.unpack_from(reg.fmt, self._image, reg.off)
+        return value[0] if reg.single else value
+
+    def set(self, addr, value):
+        """Store a new value in register addr, e.g. from the main loop."""
+        self._clear_pending()
+        self._pack(self._table[addr], value)
+
+    # ===== transactions
+
+    def handle(self, responder, events):
+        """irq() handler: serve pending WRITEs and READs."""
+        if events & responder.IRQ_WRITE:
+            self._on_write()
+        if events & responder.IRQ_READ:
+            self._on_read()
+
+    def poll(self):
+        """Serve a pending WRITE and READ, if any, in polled mode."""
+        if self.responder.write_data_is_available():
+            self._on_write()
+        if self.responder.read_is_pending():
+            self._on_read()
+
+    def serve(self, transaction):
+        """Serve a transaction from an AsyncI2CResponder."""
+        if transaction.data:
+            self._clear_pending()
+            self._write(transaction.data, len(transaction.data))
+        if transaction.read:
+            transaction.respond(self._read_data())
+
+    def _on_write(self):
+        # one WRITE per readinto() in interrupt-driven mode, there may be several
+        self._clear_pending()
+        n = self.responder.readinto(self._wbuf)
+        while n:
+            self._write(self._wview, n)
+            n = self.responder.readinto(self._wbuf)
+
+    def _write(self, data, n):
+        self._prefix = data[0]
+        if n == 1:
+            return  # just a register selection, a READ should follow
+        self._prefix = 0
+        pos = 1
+        addr = data[0]
+        while pos < n:
+            reg = self._table[addr & 0xFF]
+            if reg is None or reg.access == "r" or n - pos < reg.size:
+                self.errors += 1
+                return
+            self._image[reg.off:reg.off + reg.size] = data[pos:pos + reg.size]
+            pos += reg.size
+            addr += 1
+            self.writes += 1
+            if reg.write is not None:
+                value = struct.unpack_from(reg.fmt, self._image, reg.off)
+                if reg.single:
+                    reg.write(value[0])
+                else:
+                    reg.write(*value)
+
+    def _on_read(self):
+        self.responder.put_read_bytes(self._read_data())
+
+    def _read_data(self):
+        # Return the bytes to answer a READ of the selected register with
+        self._clear_pending()
+        reg = self._table[self._prefix]
+        self._prefix = 0  # don't retain the selection
+        if reg is None or reg.access == "w":
+            return self._zero
+        for r in reg.run:
+            if r.read is not None:
+                self._pack(r, r.read())
+        self.reads += 1
+        if reg.clear_on_read:
+            self._cleared = reg
+        return reg.view
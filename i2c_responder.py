@@ -1,14 +1,50 @@
-from machine import mem32
+from machine import mem32, Pin, Timer, disable_irq, enable_irq
+try:
+    import micropython
+    _use_viper = hasattr(micropython, 'viper')
+except ImportError:  # e.g. on a host, with i2c_fake standing in for the registers
+    micropython = None
+    _use_viper = False
+
+if _use_viper:
+    @micropython.viper
+    def _fifo_read(data_cmd: uint, buf: ptr8, n: int):
+        reg = ptr32(data_cmd)
+        i = 0
+        while i < n:
+            buf[i] = reg[0]
+            i += 1
+
+    @micropython.viper
+    def _fifo_write(data_cmd: uint, buf: ptr8, start: int, n: int):
+        reg = ptr32(data_cmd)
+        i = start
+        end = start + n
+        while i < end:
+            reg[0] = buf[i]
+            i += 1
+
+    @micropython.viper
+    def _widen(buf: ptr8, words: ptr8, n: int):
+        i = 0
+        while i < n:
+            words[i << 2] = buf[i]
+            i += 1
+else:
+    def _widen(buf, words, n):
+        for i in range(n):
+            words[i << 2] = buf[i]
 
 class I2CResponder:
-    """Implementation of a (polled) Raspberry Pico I2C Responder.
+    """Implementation of a (polled or interrupt-driven) Raspberry Pico I2C Responder.
 
     NOTE: This module uses I2C Controller/Responder nomenclature per
           https://www.eetimes.com/its-time-for-ieee-to-retire-master-slave/
 
     I2C Responder support is not yet present in Pico micropython (as of MicroPython v1.14).
 
-    This class implements a polled I2C responder by accessing the Pico registers directly.
+    This class implements an I2C responder by accessing the Pico registers directly. It is
+    polled by default; irq() switches it to interrupt-driven operation.
     The implementation is largely built upon the work of danjperron as posted in:
         https://www.raspberrypi.org/forums/viewtopic.php?f=146&t=302978&sid=164b1038e60b43a22d1af6b6ba69f6ae
 
@@ -33,16 +69,24 @@ class I2CResponder:
     IC_TAR = 4
     IC_SAR = 8
     IC_DATA_CMD = 0x10
+    IC_INTR_STAT = 0x2C
+    IC_INTR_MASK = 0x30
     IC_RAW_INTR_STAT = 0x34
     IC_RX_TL = 0x38
     IC_TX_TL = 0x3C
     IC_CLR_INTR = 0x40
+    IC_CLR_RX_OVER = 0x48
     IC_CLR_RD_REQ = 0x50
     IC_CLR_TX_ABRT = 0x54
+    IC_CLR_STOP_DET = 0x60
+    IC_CLR_START_DET = 0x64
     IC_ENABLE = 0x6C
     IC_STATUS = 0x70
     IC_TX_FLR = 0x74
     IC_RX_FLR = 0x78
+    IC_DMA_CR = 0x88
+    IC_DMA_TDLR = 0x8C
+    IC_DMA_RDLR = 0x90
 
     # GPIO Register block size (i.e.) per GPIO
     GPIO_REGISTER_BLOCK_SIZE = 8
@@ -52,6 +96,8 @@ class I2CResponder:
 
     # Register bit definitions
     IC_STATUS__RFNE = 0x08  # Receive FIFO Not Empty
+    IC_STATUS__SLV_ACTIVITY = 0x40  # Responder busy with a transaction
+    IC_DATA_CMD__FIRST_DATA_BYTE = 0x800  # first byte of a WRITE, after the address
     IC_ENABLE__ENABLE = 0x01
     IC_SAR__IC_SAR = 0x1FF  # Responder address
     IC_CLR_TX_ABRT__CLR_TX_ABRT = 0x01
@@ -59,8 +105,31 @@ class I2CResponder:
     IC_CON__CONTROLLER_MODE = 0x01
     IC_CON__IC_10BITADDR_RESPONDER = 0x08
     IC_CON__IC_RESPONDER_DISABLE = 0x40
+    IC_CON__STOP_DET_IFADDRESSED = 0x80
+    IC_CON__RX_FIFO_FULL_HLD_CTRL = 0x200
+    IC_INTR__RX_OVER = 0x02  # same bits in IC_INTR_STAT, IC_INTR_MASK and IC_RAW_INTR_STAT
+    IC_INTR__RX_FULL = 0x04
+    IC_INTR__TX_EMPTY = 0x10
+    IC_INTR__RD_REQ = 0x20
+    IC_INTR__STOP_DET = 0x200
+    IC_INTR__START_DET = 0x400
     GPIOxCTRL__FUNCSEL = 0x1F
     GPIOxCTRL__FUNCSEL__I2C = 3
+    IC_DMA_CR__RDMAE = 0x01
+    IC_DMA_CR__TDMAE = 0x02
+
+    # DMA request (DREQ) numbers of the I2C FIFOs
+    DREQ_I2C0_TX = 32
+    DREQ_I2C0_RX = 33
+    DREQ_I2C1_TX = 34
+    DREQ_I2C1_RX = 35
+
+    # Depth of the Tx and Rx FIFOs
+    FIFO_DEPTH = 16
+
+    # Events passed to the irq() handler
+    IRQ_WRITE = 0x01  # an I2C WRITE has been received
+    IRQ_READ = 0x02  # the Controller is waiting for I2C READ data
 
     def write_reg(self, register_offset, data, method=0):
         """Write Pico register."""
@@ -88,6 +157,19 @@ class I2CResponder:
         self.responder_address = responder_address
         self.i2c_device_id = i2c_device_id
         self.i2c_base = self.I2C0_BASE if i2c_device_id == 0 else self.I2C1_BASE
+        # Register addresses used in the FIFO loops, computed once
+        self._data_cmd = self.i2c_base | self.IC_DATA_CMD
+        self._rx_flr = self.i2c_base | self.IC_RX_FLR
+        self._tx_flr = self.i2c_base | self.IC_TX_FLR
+        self.rx_overruns = 0  # times I2C WRITE data was lost
+        self.tx_overruns = 0  # times I2C READ data didn't fit in the Tx FIFO
+        self._timer = None  # set in interrupt-driven mode
+        self._sda = None  # Pin whose falling edge restarts the stopped timer
+        self.wakeups = 0  # times the timer was restarted by a START
+        self._rx = None  # ring buffer filled from the FIFO in interrupt-driven mode
+        self._dma_tx = None  # DMATransfers, set by dma_init()
+        self._dma_rx = None
+        self._dma_words = None  # put_read_dma() data, zero-extended to one word per byte
         # Disable I2C engine while initializing it
         self.clr_reg(self.IC_ENABLE, self.IC_ENABLE__ENABLE)
         # Clear Responder address bits
@@ -158,23 +240,55 @@ class I2CResponder:
         """Issue requested I2C READ data to the requesting Controller.
 
         This function should be called to return the requested I2C READ
-        data when read_is_pending() returns True.
+        data when read_is_pending() returns True. In polled mode the data
+        must fit in the Tx FIFO; if it doesn't, the rest is dropped and
+        tx_overruns is incremented.
 
         Args:
-            data (int): A byte value to send.
+            data (bytes): The bytes to send.
         """
         # reset flag
         self.clr_reg(self.IC_CLR_TX_ABRT, self.IC_CLR_TX_ABRT__CLR_TX_ABRT)
-        for byte in data:
-            mem32[self.i2c_base | self.IC_DATA_CMD] = byte & 0xFF
+        if self._timer is not None:
+            self._put_read_irq(data)
+            return
+        if self.write_from(data) < len(data):
+            self.tx_overruns += 1
         status = mem32[self.i2c_base | self.IC_CLR_RD_REQ]
 
+    def write_from(self, buf, start=0):
+        """Put I2C READ data in the Tx FIFO, as much of it as fits.
+
+        The Tx FIFO level is read once, then buf[start:] is copied until the
+        FIFO is full.
+
+        Args:
+            buf: The bytes to send (bytes, bytearray or memoryview).
+            start (int, optional): The offset in buf to start at.
+        Returns:
+            The number of bytes put in the FIFO.
+        """
+        n = self.FIFO_DEPTH - (mem32[self._tx_flr] & 0x1F)
+        if n > len(buf) - start:
+            n = len(buf) - start
+        if _use_viper:
+            _fifo_write(self._data_cmd, buf, start, n)
+        else:
+            data_cmd = self._data_cmd
+            for i in range(start, start + n):
+                mem32[data_cmd] = buf[i] & 0xFF
+        return n
+
     def write_data_is_available(self):
         """Check whether incoming (I2C WRITE) data is available.
 
         Returns:
             True if data is available, False otherwise.
         """
+        if self._rx is not None:
+            if self._ends_out == self._ends_in:
+                return 0
+            return self._ends[self._ends_out & self._ends_mask] - self._rx_out
         # get IC_STATUS
         return mem32[self.i2c_base | self.IC_RX_FLR] & 0x1F
     
@@ -198,7 +312,7 @@ class I2CResponder:
         """
         data = []
         while len(data) < max_size and self.write_data_is_available():
-            data.append(mem32[self.i2c_base | self.IC_DATA_CMD] & 0xFF)
+            data.append(self._get_byte())
         return data
 
 
@@ -212,8 +326,401 @@ class I2CResponder:
         Returns:
             A list containing 0 to max_size bytes.
         """
-        data = bytearray()
-        while len(data) < max_size and self.write_data_is_available():
-            data.append(mem32[self.i2c_base | self.IC_DATA_CMD] & 0xFF)
-        return data
+        data = bytearray(max_size)
+        n = self.readinto(data)
+        return data if n == max_size else data[:n]
+
+    def readinto(self, buf):
+        """Read incoming (I2C WRITE) data into buf.
+
+        The Rx FIFO level is read once, then as many bytes as are waiting
+        are copied, up to len(buf). A lost byte, because the FIFO was full,
+        increments rx_overruns.
+
+        In interrupt-driven mode the bytes come from the ring buffer instead,
+        one WRITE at a time: a call returns no more than the rest of the
+        oldest WRITE that has ended, so back-to-back WRITEs are read
+        separately, and nothing of a WRITE still in progress.
+
+        Args:
+            buf: A bytearray or memoryview to fill.
+        Returns:
+            The number of bytes read, possibly 0.
+        """
+        if self._rx is not None:
+            if self._ends_out == self._ends_in:
+                return 0
+            end = self._ends[self._ends_out & self._ends_mask]
+            n = 0
+            while n < len(buf) and self._rx_out != end:
+                buf[n] = self._rx[self._rx_out & self._rx_mask]
+                self._rx_out += 1
+                n += 1
+            if self._rx_out == end:
+                self._ends_out += 1
+            return n
+        n = mem32[self._rx_flr] & 0x1F
+        if n > len(buf):
+            n = len(buf)
+        if _use_viper:
+            _fifo_read(self._data_cmd, buf, n)
+        else:
+            data_cmd = self._data_cmd
+            for i in range(n):
+                buf[i] = mem32[data_cmd] & 0xFF
+        if mem32[self.i2c_base | self.IC_RAW_INTR_STAT] & self.IC_INTR__RX_OVER:
+            mem32[self.i2c_base | self.IC_CLR_RX_OVER]  # reading clears it
+            self.rx_overruns += 1
+        return n
+
+    def _get_byte(self):
+        if self._rx is None:
+            return mem32[self.i2c_base | self.IC_DATA_CMD] & 0xFF
+        byte = self._rx[self._rx_out & self._rx_mask]
+        self._rx_out += 1
+        if self._rx_out == self._ends[self._ends_out & self._ends_mask]:
+            self._ends_out += 1
+        return byte
+
+    # ===== interrupt-driven operation
+
+    def irq(self, handler, freq=2000, rx_threshold=8, tx_threshold=4, rx_size=64, idle_ms=10):
+        """Switch to interrupt-driven operation.
+
+        The I2C interrupt status is polled by a hard timer interrupt, freq times a second,
+        which empties the Rx FIFO into a ring buffer, keeps the Tx FIFO topped up during long
+        READs and schedules handler(responder, events) with micropython.schedule(). events is a
+        combination of IRQ_WRITE, raised once a WRITE has ended with a STOP or is followed by a
+        READ or another WRITE, and IRQ_READ. The handler fetches the WRITE data with
+        get_write_bytes() or readinto(), one WRITE per call while write_data_is_available(),
+        and answers a READ with put_read_bytes(), as in polled mode; it should handle the WRITE
+        data first, since a READ normally follows a register number write. The end of each
+        WRITE is recorded in the ring buffer (from STOP_DET, RD_REQ and the FIRST_DATA_BYTE flag
+        of the next WRITE's first byte), so WRITEs that arrive before the handler runs aren't
+        run together. The rest of the program is free to sleep (e.g. in machine.idle())
+        meanwhile.
+
+        MicroPython can't attach a Python handler to the I2C interrupt line itself, hence the
+        timer: this is polling, only off the main loop. The FIFO thresholds keep the work per
+        tick down: the Rx FIFO is only emptied when it holds rx_threshold bytes, when a READ
+        is requested or when a transaction ends, and the Tx FIFO is refilled when it's down to
+        tx_threshold bytes. The Rx FIFO holds the bus when it is full, and the Controller is
+        held while it waits for READ data, so nothing is lost if a tick comes late.
+
+        So that an idle bus doesn't wake the CPU freq times a second, the timer is stopped
+        once idle_ms have passed without an I2C interrupt and there is nothing left to do,
+        and a Pin interrupt on the falling edge of SDA, which begins every START, restarts
+        it. The first tick of a transaction then comes up to 1/freq seconds after its START,
+        while the Controller sends the address.
+
+        Args:
+            handler: The function to schedule on I2C events, or None to go back to polling.
+            freq (int, optional): How often the interrupt status is checked, in Hz.
+            rx_threshold (int, optional): Rx FIFO level at which to empty it, 1..16.
+            tx_threshold (int, optional): Tx FIFO level at which to refill it, 0..15.
+            rx_size (int, optional): Ring buffer size, a power of 2.
+            idle_ms (int, optional): Quiet time after which the timer is stopped, 0 to keep
+                it running.
+        """
+        if self._timer is not None:
+            self._timer.deinit()
+            self._timer = None
+        if self._sda is not None:
+            self._sda.irq(None, 0)
+        self.write_reg(self.IC_INTR_MASK, 0)
+        if handler is None:
+            self._rx = None
+            return
+        if micropython is None:
+            raise OSError("interrupt-driven mode needs micropython.schedule")
+        if not 1 <= rx_threshold <= self.FIFO_DEPTH or not 0 <= tx_threshold < self.FIFO_DEPTH:
+            raise ValueError("bad FIFO threshold")
+        if rx_size & (rx_size - 1):
+            raise ValueError("rx_size must be a power of 2")
+        self._handler = handler
+        self._dispatch_ref = self._dispatch  # bound once, so the ISR doesn't allocate
+        self._isr_ref = self._isr
+        self._wake_ref = self._wake
+        self._sleep_ref = self._sleep
+        self._freq = freq
+        self._idle_ticks = idle_ms * freq // 1000  # quiet ticks before the timer is stopped
+        self._idle = 0  # quiet ticks so far
+        self._sleep_scheduled = False
+        if self._sda is None:
+            self._sda = Pin(self.sda_gpio)  # no mode given, so the pin stays an I2C pin
+        self._events = 0  # events for the handler, set by the ISR
+        self._scheduled = False
+        self._rx = bytearray(rx_size)
+        self._rx_mask = rx_size - 1
+        self._rx_in = 0  # ring buffer indices, free-running
+        self._rx_out = 0
+        self._ends = [0] * 8  # ring of _rx_in values at which WRITEs ended
+        self._ends_mask = 7
+        self._ends_in = 0
+        self._ends_out = 0
+        self._rx_last = 0  # _rx_in at the last recorded end
+        self._tx = None  # READ data waiting for room in the Tx FIFO
+        self._tx_pos = 0
+        self._tx_end = 0
+        # The thresholds can only be changed while the I2C engine is disabled
+        self.clr_reg(self.IC_ENABLE, self.IC_ENABLE__ENABLE)
+        self.write_reg(self.IC_RX_TL, rx_threshold - 1)  # RX_FULL is raised above IC_RX_TL
+        self.write_reg(self.IC_TX_TL, tx_threshold)  # TX_EMPTY is raised at or below IC_TX_TL
+        self.set_reg(self.IC_CON, self.IC_CON__STOP_DET_IFADDRESSED | self.IC_CON__RX_FIFO_FULL_HLD_CTRL)
+        self.set_reg(self.IC_ENABLE, self.IC_ENABLE__ENABLE)
+        mem32[self.i2c_base | self.IC_CLR_INTR]  # reading clears the interrupts
+        self.write_reg(self.IC_INTR_MASK, self.IC_INTR__RX_FULL | self.IC_INTR__RD_REQ | self.IC_INTR__STOP_DET)
+        self._timer = Timer(freq=freq, mode=Timer.PERIODIC, callback=self._isr_ref, hard=True)
+
+    def _isr(self, timer):
+        # Hard interrupt context: no allocation allowed
+        base = self.i2c_base
+        stat = mem32[base | self.IC_INTR_STAT]
+        if not stat:
+            if self._idle_ticks and not self._sleep_scheduled:
+                self._idle += 1
+                if self._idle >= self._idle_ticks:
+                    try:
+                        micropython.schedule(self._sleep_ref, 0)
+                        self._sleep_scheduled = True
+                    except RuntimeError:
+                        pass  # try again on the next tick
+            return
+        self._idle = 0
+        rx_dma = self._dma_rx is not None and self._dma_rx.active()
+        n = 0 if rx_dma else mem32[self._rx_flr] & 0x1F  # DMA empties the Rx FIFO itself
+        while n:
+            data = mem32[self._data_cmd]
+            if data & self.IC_DATA_CMD__FIRST_DATA_BYTE:
+                self._end_write()  # a new WRITE, after a RESTART
+            if self._rx_in - self._rx_out <= self._rx_mask:
+                self._rx[self._rx_in & self._rx_mask] = data & 0xFF
+                self._rx_in += 1
+            else:
+                self.rx_overruns += 1
+            n -= 1
+        # A WRITE is complete when it is followed by a STOP or a READ
+        if stat & (self.IC_INTR__STOP_DET | self.IC_INTR__RD_REQ):
+            self._end_write()
+        if stat & self.IC_INTR__STOP_DET:
+            mem32[base | self.IC_CLR_STOP_DET]
+            if self._tx is not None:
+                # the Controller read less than we had for it, drop the rest
+                self._tx = None
+                self._tx_end = self._tx_pos
+                mem32[base | self.REG_ACCESS_METHOD_CLR | self.IC_INTR_MASK] = self.IC_INTR__TX_EMPTY
+            # DMA transfers end with the transaction too
+            if rx_dma:
+                self._dma_rx.stop()
+            if self._dma_tx is not None and self._dma_tx.active():
+                self._dma_tx.stop()
+        if stat & self.IC_INTR__TX_EMPTY and self._tx is not None:
+            self._fill_tx()
+        if stat & self.IC_INTR__RD_REQ:
+            # RD_REQ stays raised until the READ is answered, so mask it until then
+            mem32[base | self.REG_ACCESS_METHOD_CLR | self.IC_INTR_MASK] = self.IC_INTR__RD_REQ
+            self._events |= self.IRQ_READ
+        if self._events and not self._scheduled:
+            try:
+                micropython.schedule(self._dispatch_ref, 0)
+                self._scheduled = True
+            except RuntimeError:
+                pass  # the schedule queue is full, try again on the next tick
+
+    def _sleep(self, _):
+        # Scheduled after idle_ms without an interrupt: stop the timer until the next START,
+        # unless something is still going on
+        self._sleep_scheduled = False
+        base = self.i2c_base
+        state = disable_irq()
+        if (self._timer is not None and self._idle >= self._idle_ticks and not self._events
+                and self._tx is None
+                and not mem32[base | self.IC_STATUS] & self.IC_STATUS__SLV_ACTIVITY
+                and not (self._dma_rx is not None and self._dma_rx.active())
+                and not (self._dma_tx is not None and self._dma_tx.active())):
+            self._timer.deinit()
+            # Arming the Pin interrupt discards earlier edges, so a START between clearing
+            # START_DET and arming it shows in START_DET instead
+            mem32[base | self.IC_CLR_START_DET]
+            self._sda.irq(self._wake_ref, Pin.IRQ_FALLING, True)
+            if mem32[base | self.IC_RAW_INTR_STAT] & self.IC_INTR__START_DET:
+                self._wake(None)
+        else:
+            self._idle = 0  # wait another idle_ms
+        enable_irq(state)
+
+    def _wake(self, pin):
+        # Hard interrupt on the falling edge of SDA while the timer is stopped
+        self._sda.irq(None, 0)
+        self._idle = 0
+        self.wakeups += 1
+        self._timer.init(freq=self._freq, mode=Timer.PERIODIC, callback=self._isr_ref, hard=True)
+
+    def _end_write(self):
+        # Record the end of the WRITE in the ring buffer, if there was one; with no room left
+        # for the record it runs into the next
+        if self._rx_in != self._rx_last and self._ends_in - self._ends_out <= self._ends_mask:
+            self._ends[self._ends_in & self._ends_mask] = self._rx_in
+            self._ends_in += 1
+            self._rx_last = self._rx_in
+            self._events |= self.IRQ_WRITE
+
+    def _dispatch(self, _):
+        state = disable_irq()
+        events = self._events
+        self._events = 0
+        self._scheduled = False
+        enable_irq(state)
+        self._handler(self, events)
+
+    def _fill_tx(self):
+        # Move pending READ data into the Tx FIFO, as much as fits
+        self._tx_pos += self.write_from(self._tx, self._tx_pos)
+        if self._tx_pos >= self._tx_end:
+            self._tx = None
+            mem32[self.i2c_base | self.REG_ACCESS_METHOD_CLR | self.IC_INTR_MASK] = self.IC_INTR__TX_EMPTY
+
+    def _put_read_irq(self, data):
+        state = disable_irq()
+        self._tx = data
+        self._tx_pos = 0
+        self._tx_end = len(data)
+        self._fill_tx()
+        if self._tx is not None:
+            # the rest goes in from the ISR as the Controller reads
+            self.set_reg(self.IC_INTR_MASK, self.IC_INTR__TX_EMPTY)
+        mem32[self.i2c_base | self.IC_CLR_RD_REQ]
+        self.set_reg(self.IC_INTR_MASK, self.IC_INTR__RD_REQ)
+        enable_irq(state)
+
+    # ===== DMA transfers
+
+    def dma_init(self, tx_level=4, rx_level=0):
+        """Claim two DMA channels, for put_read_dma() and readinto_dma().
+
+        The channels are paced by the I2C block's DREQs, so once started a transfer moves
+        bytes between memory and the FIFOs without the CPU. Completion is signalled through
+        a uasyncio ThreadSafeFlag, so a task can await it. Needs a firmware with rp2.DMA.
+
+        The Tx channel writes whole words: a byte write to IC_DATA_CMD would be copied into
+        all four byte lanes, setting CMD (bit 8) whenever bit 0 of the data is set, which
+        aborts the READ.
+
+        Args:
+            tx_level (int, optional): Tx FIFO level at or below which DMA tops it up, 0..15.
+            rx_level (int, optional): Rx FIFO level above which DMA empties it, 0..15.
+        """
+        import rp2
+        import uasyncio as asyncio
+        if self.i2c_device_id == 0:
+            treq_tx, treq_rx = self.DREQ_I2C0_TX, self.DREQ_I2C0_RX
+        else:
+            treq_tx, treq_rx = self.DREQ_I2C1_TX, self.DREQ_I2C1_RX
+        dma = rp2.DMA()
+        ctrl = dma.pack_ctrl(size=2, inc_read=True, inc_write=False, treq_sel=treq_tx, irq_quiet=False)
+        self._dma_tx = DMATransfer(self, dma, ctrl, asyncio.ThreadSafeFlag(), self.IC_DMA_CR__TDMAE)
+        dma = rp2.DMA()
+        ctrl = dma.pack_ctrl(size=0, inc_read=False, inc_write=True, treq_sel=treq_rx, irq_quiet=False)
+        self._dma_rx = DMATransfer(self, dma, ctrl, asyncio.ThreadSafeFlag(), self.IC_DMA_CR__RDMAE)
+        self.write_reg(self.IC_DMA_TDLR, tx_level)
+        self.write_reg(self.IC_DMA_RDLR, rx_level)
+
+    def dma_deinit(self):
+        """Stop any DMA transfers and release the channels."""
+        for t in (self._dma_tx, self._dma_rx):
+            if t is not None:
+                t.stop()
+                t.close()
+        self._dma_tx = self._dma_rx = None
+        self._dma_words = None
+
+    def put_read_dma(self, buf):
+        """Answer a pending I2C READ with buf, moved into the Tx FIFO by DMA.
+
+        Unlike put_read_bytes() this returns once the transfer has started, so buf may be
+        longer than the FIFO. It is copied to a word-per-byte staging buffer first, which
+        is kept for the next call and only grows.
+
+        Args:
+            buf: The bytes to send.
+        Returns:
+            The DMATransfer, to await.
+        """
+        self.clr_reg(self.IC_CLR_TX_ABRT, self.IC_CLR_TX_ABRT__CLR_TX_ABRT)
+        t = self._dma_tx
+        n = len(buf)
+        words = self._dma_words
+        if words is None or len(words) < n << 2:
+            words = self._dma_words = bytearray(n << 2)
+        _widen(buf, words, n)
+        t.start(words, self._data_cmd, n)
+        mem32[self.i2c_base | self.IC_CLR_RD_REQ]
+        if self._timer is not None:
+            self.set_reg(self.IC_INTR_MASK, self.IC_INTR__RD_REQ)
+        return t
+
+    def readinto_dma(self, buf):
+        """Receive incoming (I2C WRITE) data into buf by DMA.
+
+        The transfer ends when buf is full or, in interrupt-driven mode, when the WRITE ends
+        (see DMATransfer.nbytes). Meanwhile the data doesn't go through get_write_bytes() or
+        the irq() handler.
+
+        Args:
+            buf: A bytearray to fill.
+        Returns:
+            The DMATransfer, to await.
+        """
+        t = self._dma_rx
+        t.start(self._data_cmd, buf, len(buf))
+        return t
+
+
+class DMATransfer:
+    """DMA transfers in one direction between memory and an I2CResponder's FIFO.
+
+    Created by I2CResponder.dma_init(). Only one transfer per direction is in progress at a
+    time, and this object stands for whichever one was started last.
+    """
 
+    def __init__(self, responder, dma, ctrl, flag, dma_cr_bit):
+        self._responder = responder
+        self._dma = dma
+        self._ctrl = ctrl
+        self._flag = flag
+        self._dma_cr_bit = dma_cr_bit
+        self._len = 0
+        dma.irq(self._irq)
+
+    def _irq(self, dma):
+        self._flag.set()
+
+    def start(self, read, write, count):
+        self._flag.clear()
+        self._len = count
+        self._dma.config(read=read, write=write, count=count, ctrl=self._ctrl, trigger=count > 0)
+        self._responder.set_reg(self._responder.IC_DMA_CR, self._dma_cr_bit)
+
+    def active(self):
+        """Return True while the transfer is in progress."""
+        return self._dma.active()
+
+    @property
+    def nbytes(self):
+        """The number of bytes moved so far."""
+        return self._len - self._dma.count
+
+    def stop(self):
+        """End the transfer early, e.g. because the I2C transaction has ended."""
+        self._dma.active(False)
+        self._responder.clr_reg(self._responder.IC_DMA_CR, self._dma_cr_bit)
+        self._flag.set()
+
+    def close(self):
+        self._dma.close()
+
+    async def wait(self):
+        """Wait for the transfer to end and return the number of bytes moved."""
+        while self._dma.active():
+            await self._flag.wait()
+        return self.nbytes
@@ -46,59 +46,63 @@ def sleep(interval_s):
         print("...wakeup, reason =", reason)
     return reason
 
+prefix_reg = 0
+
+def i2c_handler(i2c, events):
+    "Process I2C register writes and reads, scheduled by the responder's interrupt"
+    global prefix_reg, ticks_base, status
+    if events & i2c.IRQ_WRITE:
+        buffer_in = i2c.get_write_bytes(max_size=16)
+        if len(buffer_in) >= 1:         # received some data
+            prefix_reg = buffer_in[0]   # first byte must be a register number
+            data = buffer_in[1:]        # copy the tail of the buffer
+            if data: # buffer tail wasn't empty
+                if do_prt:
+                    print("Received I2C WRITE: reg =", prefix_reg, "data =", data, "len =", len(data))
+    if events & i2c.IRQ_READ:
+        if prefix_reg == 1: # status register + watchdog reset
+            ticks_base = time.ticks_ms() # reset watchdog time base
+            data = status.to_bytes(1, 'little')
+            assert(len(data) == 1)
+            if do_prt:
+                print("Status")
+        elif prefix_reg == 2: # ADC value
+            data = adc.read_u16().to_bytes(2,'little')
+            assert(len(data) == 2)
+            if do_prt:
+                print("ADC")
+        elif prefix_reg == 3: # RTC date/time
+            data = pack("HBBBBBBH", *rtc.datetime())
+            assert(len(data) == 10)
+            if do_prt:
+                print("RTC")
+        elif prefix_reg == 4: # status register read and clear
+            data = status.to_bytes(1, 'little')
+            assert(len(data) == 1)
+            status = 0
+            if do_prt:
+                print("Status read and cleared")
+        else: # return a zero byte for all unrecognised regs
+            data = b'\x00'
+            assert(len(data) == 1)
+            if do_prt:
+                print("Default")
+        i2c.put_read_bytes(data)
+        if do_prt:
+            print("Sent I2C READ data for register", prefix_reg)
+        prefix_reg = 0
+        if do_prt:
+            print()
+
 try:
-    print("Polling I2C")
-    prefix_reg = 0
+    print("Serving I2C")
     # All times are in milliseconds(?)
     ticks_base = time.ticks_ms()
     ticks_timeout = 40000
     sleep_interval = 20
     sleep(1)
+    i2c_responder.irq(i2c_handler)
     while True:
-        # Poll for I2C writes
-        if i2c_responder.write_data_is_available():
-            buffer_in = i2c_responder.get_write_bytes(max_size=16)
-            if len(buffer_in) >= 1:         # received some data
-                prefix_reg = buffer_in[0]   # first byte must be a register number
-                data = buffer_in[1:]        # copy the tail of the buffer
-                if data: # buffer tail wasn't empty
-                    if do_prt:
-                        print("Received I2C WRITE: reg =", prefix_reg, "data =", data, "len =", len(data))
-        # Poll for I2C reads                
-        if i2c_responder.read_is_pending():
-            if prefix_reg == 1: # status register + watchdog reset
-                ticks_base = time.ticks_ms() # reset watchdog time base
-                data = status.to_bytes(1, 'little')
-                assert(len(data) == 1)
-                if do_prt:
-                    print("Status")
-            elif prefix_reg == 2: # ADC value
-                data = adc.read_u16().to_bytes(2,'little')
-                assert(len(data) == 2)
-                if do_prt:
-                    print("ADC")
-            elif prefix_reg == 3: # RTC date/time
-                data = pack("HBBBBBBH", *rtc.datetime())
-                assert(len(data) == 10)
-                if do_prt:
-                    print("RTC")
-            elif prefix_reg == 4: # status register read and clear
-                data = status.to_bytes(1, 'little')
-                assert(len(data) == 1)
-                status = 0
-                if do_prt:
-                    print("Status read and cleared")
-            else: # return a zero byte for all unrecognised regs
-                data = b'\x00'
-                assert(len(data) == 1)
-                if do_prt:
-                    print("Default")
-            i2c_responder.put_read_bytes(data)
-            if do_prt:
-                print("Sent I2C READ data for register", prefix_reg)
-            prefix_reg = 0
-            if do_prt:
-                print()
         # Check for watchdog timeout
         ticks_now = time.ticks_ms()
         ticks_interval = time.ticks_diff(ticks_now, ticks_base)
@@ -108,6 +112,7 @@ try:
                 print("Watchdog timeout exceeded: timeout =", ticks_timeout, "interval =", ticks_interval);
             sleep(sleep_interval)
             ticks_base = time.ticks_ms()
+        time.sleep_ms(50) # the I2C handler runs while we sleep
             
 except KeyboardInterrupt:
-    pass
+    i2c_responder.irq(None)
@@ -5,7 +5,9 @@ import gc # garbage collector
 from micropython import const
 from machine import Pin, RTC, ADC, WDT, lightsleep
 from i2c_responder import I2CResponder
-from struct import pack, unpack
+from i2c_regmap import Register, RegisterMap
+from i2c_async import AsyncI2CResponder
+import uasyncio as asyncio
 
 micropython.opt_level(0) # zero is default, i.e. assertions are enabled
 
@@ -75,89 +77,57 @@ watch_seconds = 0 # should be 4 minutes, in case Pi is hung when Pico restarts
 wake_seconds  = 30 # should be 15 minutes, so Pi doesn't stay off
 wdt = WDT(timeout=8388) # set ~8 sec (max) watchdog timeout
 
-try:
-    gc.disable() # we call garbage collection explicitly, below
-    print("Polling I2C")
-    prefix_reg = 0
-    # All times are in milliseconds(?)
-    ticks_base = time.ticks_ms() # get the start time for the watch delay
+def read_status():
+    "Status register read, which also resets the watch"
+    global ticks_base
+    ticks_base = time.ticks_ms() # reset watch time base
+    if do_prt >= 1:
+        print("Status:", status)
+    return status
 
-    while True: # main loop
-        wdt.feed()
+def read_clear_status():
+    "Status register read and clear"
+    global status
+    value = status
+    status = 0
+    if do_prt >= 1:
+        print("Status read and cleared")
+    return value
 
-        # Poll for I2C writes
-        if i2c.write_data_is_available(): # process register write
-            buffer_in = i2c.get_write_bytes(max_size=16) # ToDo: what if we're faster than the bus?
-            assert(len(buffer_in) > 0)
-            if len(buffer_in) is 1: # just a register selection, a read should follow
-                prefix_reg = buffer_in[0]   # buffer only contains a register number
-            else:  # there is data after the reg number
-                prefix_reg = buffer_in[0]   # first byte must be a register number
-                data = buffer_in[1:]        # copy the tail of the buffer
-                if data and do_prt >= 2:
-                    print("Received I2C WRITE: reg =", prefix_reg, "data =", data, "len =", len(data))
-                if prefix_reg is 5 and len(data) is 1: # watch time register (1 byte)
-                    watch_seconds = int.from_bytes(data, 'little', False)
-                    ticks_base = time.ticks_ms() # reset watch time base
-                    prefix_reg = 0
-                    if do_prt >= 1:
-                        print("WATCH set to", watch_seconds)
-                elif prefix_reg is 6 and len(data) is 2: # wake time register (2 bytes)
-                    wake_seconds = int.from_bytes(data, 'little', False) << 2 # value is in 2-sec units
-                    prefix_reg = 0
-                    if do_prt >= 1:
-                        print("WAKE set to", wake_seconds)
-                elif prefix_reg is 3 and len(data) is 10: # RTC date/time
-                    rtc.datetime(unpack("HBBBBBBH", data))
-                    prefix_reg = 0
-                elif do_prt >= 1 and len(data) > 0:
-                    prefix_reg = 0
-                    print("Unhandled reg write, reg =", prefix_reg, "buffer_in =", buffer_in)
-
-        # Poll for I2C reads                
-        if i2c.read_is_pending(): # process register read
-            if prefix_reg == 1: # status register + watch reset
-                ticks_base = time.ticks_ms() # reset watch time base
-                data = status.to_bytes(1, 'little')
-                assert(len(data) == 1)
-                if do_prt >= 1:
-                    print("Status:", status)
-            elif prefix_reg == 2: # ADC value
-                value = adc.read_u16()
-                data = value.to_bytes(2,'little')
-                assert(len(data) == 2)
-                if do_prt >= 1:
-                    print("ADC:", value)
-            elif prefix_reg == 3: # RTC date/time
-                data = pack("HBBBBBBH", *rtc.datetime())
-                assert(len(data) == 10)
-                if do_prt >= 1:
-                    print("RTC:", data)
-            elif prefix_reg == 4: # status register read and clear
-                data = status.to_bytes(1, 'little')
-                assert(len(data) == 1)
-                status = 0
-                if do_prt >= 1:
-                    print("Status read and cleared")
-            elif prefix_reg == 5: # watch time register (1 byte)
-                data = watch_seconds.to_bytes(1, 'little')
-                assert(len(data) == 1)
-                if do_prt >= 2:
-                    print("WATCH:", watch_seconds)
-            elif prefix_reg == 6: # wake time register (2 bytes)
-                data = (wake_seconds >> 2).to_bytes(2, 'little')
-                assert(len(data) == 2)
-                if do_prt >= 2:
-                    print("WAKE:", wake_seconds)
-            else: # return a zero byte for all unrecognised regs
-                data = b'\x00'
-                assert(len(data) == 1)
-                if do_prt >= 2:
-                    print("Default")
-            i2c.put_read_bytes(data) # send the register data
-            if do_prt >= 2:
-                print("Sent I2C READ data for register", prefix_reg)
-            prefix_reg = 0 # don't retain prefix
+def write_watch(value):
+    global watch_seconds, ticks_base
+    watch_seconds = value
+    ticks_base = time.ticks_ms() # reset watch time base
+    if do_prt >= 1:
+        print("WATCH set to", watch_seconds)
+
+def write_wake(value):
+    global wake_seconds
+    wake_seconds = value << 2 # value is in 2-sec units
+    if do_prt >= 1:
+        print("WAKE set to", wake_seconds)
+
+# Registers 1-3 (status, ADC, RTC) can be fetched in one 13-byte burst read
+regs = RegisterMap(i2c, [
+    Register(1, "<B", "r", read=read_status),                      # status + watch reset
+    Register(2, "<H", "r", read=adc.read_u16),                     # ADC value
+    Register(3, "<HBBBBBBH", read=rtc.datetime,                    # RTC date/time
+             write=lambda *dt: rtc.datetime(dt)),
+    Register(4, "<B", "r", read=read_clear_status, clear_on_read=True), # status read and clear
+    Register(5, "<B", read=lambda: watch_seconds, write=write_watch),   # watch time (1 byte)
+    Register(6, "<H", read=lambda: wake_seconds >> 2, write=write_wake), # wake time (2 bytes)
+])
+
+async def serve_i2c():
+    "Serve the registers, one I2C transaction at a time"
+    async for transaction in AsyncI2CResponder(i2c, irq=True):
+        regs.serve(transaction)
+
+async def housekeeping():
+    "Feed the watchdog, poll the button and power the Pi off and on"
+    global status, ticks_base
+    while True:
+        wdt.feed()
 
         # Poll the pushbutton
         if btn.value() is 0: # button is down
@@ -177,6 +147,18 @@ try:
         # At the tail of the loop we give the garbage collector its own watchdog slice to run in
         wdt.feed()
         gc.collect()
+        await asyncio.sleep_ms(50) # I2C transactions are served meanwhile
+
+async def main():
+    asyncio.create_task(serve_i2c())
+    await housekeeping()
+
+try:
+    gc.disable() # we call garbage collection explicitly, in housekeeping()
+    print("Serving I2C")
+    # All times are in milliseconds(?)
+    ticks_base = time.ticks_ms() # get the start time for the watch delay
+    asyncio.run(main())
 
 except KeyboardInterrupt:
-    pass
+    i2c.irq(None)
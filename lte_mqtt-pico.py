@@ -9,6 +9,7 @@ import asyncio
 import queue
 from machine import Pin, UART
 #import uartcobs
+from cobs import encode as cobs_encode, decode as cobs_decode
 
 from machine import UART
 import uasyncio as asyncio
@@ -17,39 +18,6 @@ hex_encode = True
 
 uart = UART(1, baudrate=57600)
 
-# -------- COBS Encoding / Decoding --------
-
-def cobs_encode(data: bytes) -> bytes:
-    output = bytearray()
-    idx = 0
-    while idx < len(data):
-        block_start = idx
-        code = 1
-        output.append(0)  # placeholder
-        while idx < len(data) and data[idx] != 0 and code < 0xFF:
-            output.append(data[idx])
-            idx += 1
-            code += 1
-        output[block_start] = code
-        if idx < len(data) and data[idx] == 0:
-            idx += 1  # skip zero byte
-    output.append(0)  # frame delimiter
-    return bytes(output)
-
-def cobs_decode(frame: bytes) -> bytes:
-    output = bytearray()
-    idx = 0
-    while idx < len(frame):
-        code = frame[idx]
-        if code == 0 or idx + code > len(frame):
-            raise ValueError("Invalid COBS frame")
-        idx += 1
-        output.extend(frame[idx:idx + code - 1])
-        idx += code - 1
-        if code < 0xFF and idx < len(frame):
-            output.append(0)
-    return bytes(output)
-
 # -------- Async UART Loops --------
 
 async def uart_rx_loop():
@@ -78,6 +46,7 @@ async def uart_send(msg: bytes):
     """COBS-encodes and writes a message to UART."""
     frame = cobs_encode(msg)
     uart.write(frame)
+    uart.write(b'\x00') # frame delimiter
     await asyncio.sleep_ms(0)  # Yield to event loop
 
 MOBILE_APN = "iot.1nce.net"
@@ -152,6 +121,7 @@ SUBSCRIBE_TOPIC = 'BWtest/mqtt_async/0/in'
 PUBLISH_TOPIC   = 'BWtest/mqtt_async/0/out'
 config.server   = 'broker.hivemq.com' # can be an IP address or a hostname
 config.subs_cb = callback
+config.subs_copy = True # callback keeps topic and msg
 config.connect_coro = conn_callback
 
 # Initialize the LTE connection
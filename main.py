@@ -6,17 +6,42 @@ import lte
 import time
 from mqtt_async import MQTTClient, config
 import asyncio
-import uaqueue
 from machine import Pin, UART
 
 from machine import UART
 import uasyncio as asyncio
 
 import sys_constants
+from uartcobs import FrameReceiver, FrameSender
+import cobs
+import payload
+import prioqueue
+import baudneg
+import uartlink
+import uartchan
 
-hex_encode = True
+tx_codec = payload.get_codec(sys_constants.PAYLOAD_CODEC)
+publish_topic = payload.topic_for(sys_constants.PUBLISH_TOPIC, tx_codec)
 
-uart = UART(1, baudrate=57600)
+uart = UART(1, baudrate=sys_constants.UART_BAUD_RATES[0])
+uart_rx = FrameReceiver(uart)
+uart_rx_msg = bytearray(512)  # decoded frame scratch buffer, as large as the receive buffer
+uart_tx = FrameSender(uart)
+baud = None
+if sys_constants.UART_BAUD_NEGOTIATE:
+    baud = baudneg.BaudNegotiator(uart, uart_tx, sys_constants.UART_BAUD_RATES)
+
+class BatchStats:
+    """Counters for the UART-to-MQTT batching stage."""
+    def __init__(self):
+        self.frames = 0   # frames published
+        self.batches = 0  # MQTT publishes made
+
+    def factor(self):
+        """Return the average number of frames per publish."""
+        return self.frames / self.batches if self.batches else 0
+
+batch_stats = BatchStats()
 
 class Netlight:
     def __init__(self, pin):
@@ -33,144 +58,117 @@ class Netlight:
             # If not overriding, set the pin to the given value
             self.pin.value(value)
 
-# -------- COBS Encoding / Decoding --------
-"""
-Consistent Overhead Byte Stuffing (COBS)
-
-This version is for Python 3.x.
-"""
-
-
-class DecodeError(Exception):
-    pass
-
-
-def _get_buffer_view(in_bytes):
-    mv = memoryview(in_bytes)
-#    if mv.ndim > 1 or mv.itemsize > 1:
-#        raise BufferError('object must be a single-dimension buffer of bytes.')
-    try:
-        if mv.format != 'B':
-            mv = mv.cast('B')
-    except AttributeError:
-        pass
-    return mv
-
-def cobs_encode(in_bytes: bytes) -> bytes:
-    """Encode a string using Consistent Overhead Byte Stuffing (COBS).
-    
-    Input is any byte string. Output is also a byte string.
-    
-    Encoding guarantees no zero bytes in the output. The output
-    string will be expanded slightly, by a predictable amount.
-    
-    An empty string is encoded to '\\x01'"""
-    if isinstance(in_bytes, str):
-        raise TypeError('Unicode-objects must be encoded as bytes first')
-    in_bytes_mv = _get_buffer_view(in_bytes)
-    final_zero = True
-    out_bytes = bytearray()
-    idx = 0
-    search_start_idx = 0
-    for in_char in in_bytes_mv:
-        if in_char == 0:
-            final_zero = True
-            out_bytes.append(idx - search_start_idx + 1)
-            out_bytes += in_bytes_mv[search_start_idx:idx]
-            search_start_idx = idx + 1
-        else:
-            if idx - search_start_idx == 0xFD:
-                final_zero = False
-                out_bytes.append(0xFF)
-                out_bytes += in_bytes_mv[search_start_idx:idx+1]
-                search_start_idx = idx + 1
-        idx += 1
-    if idx != search_start_idx or final_zero:
-        out_bytes.append(idx - search_start_idx + 1)
-        out_bytes += in_bytes_mv[search_start_idx:idx]
-    return bytes(out_bytes)
-
-
-def cobs_decode(in_bytes: bytes) -> bytes:
-    """Decode a string using Consistent Overhead Byte Stuffing (COBS).
-    
-    Input should be a byte string that has been COBS encoded. Output
-    is also a byte string.
-    
-    A cobs.DecodeError exception will be raised if the encoded data
-    is invalid."""
-    if isinstance(in_bytes, str):
-        raise TypeError('Unicode-objects are not supported; byte buffer objects only')
-    in_bytes_mv = _get_buffer_view(in_bytes)
-    out_bytes = bytearray()
-    idx = 0
-
-    if len(in_bytes_mv) > 0:
-        while True:
-            length = in_bytes_mv[idx]
-            if length == 0:
-                raise DecodeError("zero byte found in input")
-            idx += 1
-            end = idx + length - 1
-            copy_mv = in_bytes_mv[idx:end]
-            # MicroPython doesn't support 'in' for memoryview, so use a loop
-            for b in copy_mv:
-                if b == 0:
-                    raise DecodeError("zero byte found in input")
-            out_bytes += copy_mv
-            idx = end
-            if idx > len(in_bytes_mv):
-                raise DecodeError("not enough input bytes for length code")
-            if idx < len(in_bytes_mv):
-                if length < 0xFF:
-                    out_bytes.append(0)
-            else:
-                break
-    return bytes(out_bytes)
-
 # -------- Async UART Loops --------
 
 async def uart_rx_loop():
-    """COBS-based receiver using async polling."""
-    rxbuf = bytearray()
+    """COBS-based receiver, woken by the scheduler when the UART has data."""
+    overruns = 0
     while True:
-        if uart.any():
-            data = uart.read(1)
-            if data:
-                b = data[0]
-                if b == 0:
-                    if rxbuf:
-                        try:
-                            msg = cobs_decode(rxbuf)
-                            #print("Received from UART:", msg)
-                            # append the message to the UART RX queue
-                            await uart_rx_queue.put(msg)
-                        except ValueError:
-                            print("Bad frame")
-                        rxbuf = bytearray()
-                else:
-                    rxbuf.append(b)
-        await asyncio.sleep_ms(2)
-
-mqtt_rx_queue = uaqueue.Queue()
-uart_rx_queue = uaqueue.Queue()
+        frame = await uart_rx.read_frame()
+        if baud is not None and uart_rx.overruns != overruns:
+            overruns = uart_rx.overruns
+            baud.frame_error()
+        try:
+            n = cobs.decode_into(frame, uart_rx_msg)
+        except ValueError:
+            print("Bad frame")
+            if baud is not None:
+                baud.frame_error()
+            continue
+        frame = memoryview(uart_rx_msg)[:n]
+        if baud is not None:
+            if baud.is_control(frame):
+                baud.handle(frame)
+                continue
+            frame = baud.unescape(frame)
+            baud.frame_ok()
+        if uart_link is None:
+            await uart_deliver(frame)
+            continue
+        # the link layer checks the frame and calls uart_deliver for its payload(s)
+        crc_errors = uart_link.stats.crc_errors
+        await uart_link.receive(frame)
+        if baud is not None and uart_link.stats.crc_errors != crc_errors:
+            baud.frame_error()
+
+async def uart_deliver(msg):
+    """Queue a message received from the UART for publishing."""
+    if channels is not None and channels.is_control(msg):
+        channels.handle(msg)
+        return
+    prio = sys_constants.QUEUE_DEFAULT_PRIO
+    start = 0
+    if sys_constants.UART_PRIO_HEADER:
+        if len(msg) == 0 or msg[0] >= len(sys_constants.QUEUE_CLASSES):
+            print("Bad priority header")
+            return
+        prio = msg[0]
+        start = 1
+    topic = publish_topic
+    if channels is not None:
+        try:
+            topic, start = channels.decode(msg, start)
+        except ValueError as e:
+            print("Bad channel header:", e)
+            return
+    msg = bytes(memoryview(msg)[start:]) # the queue keeps the message, so it needs its own copy
+    #print("Received from UART:", msg)
+    # append the message to the UART RX queue
+    if not await uart_rx_queue.put((topic, msg), prio):
+        print("UART RX queue full, dropped a class", prio, "frame")
+
+uart_data = baud if baud is not None else uart_tx # sends data frames, escaped from baudneg's
+uart_link = None
+if sys_constants.UART_LINK:
+    uart_link = uartlink.UartLink(uart_data, uart_deliver, sys_constants.UART_LINK_WINDOW,
+                                  sys_constants.UART_LINK_RTO_MS)
+uart_out = uart_link if uart_link is not None else uart_data # where frames for the host go
+channels = None
+if sys_constants.UART_CHANNELS is not None:
+    channels = uartchan.ChannelMap(uart_out, sys_constants.UART_CHANNELS,
+                                   sys_constants.PUBLISH_TOPIC, sys_constants.SUBSCRIBE_TOPIC, tx_codec)
+
+mqtt_rx_queue = prioqueue.PriorityQueue(sys_constants.QUEUE_CLASSES)
+uart_rx_queue = prioqueue.PriorityQueue(sys_constants.QUEUE_CLASSES)
+mqtt_prio = {}
+for _t, _p in sys_constants.MQTT_PRIO_TOPICS.items():
+    mqtt_prio[_t.encode()] = _p
 
 def callback(topic, msg, retained, qos):
     """Callback function to handle incoming messages.
     This function will be called whenever a message is received on the subscribed topic.
     """
+    # topic and msg are only valid during the callback, so keep a copy of the topic
+    topic = bytes(topic)
     # Print the topic, message, retained flag, and QoS level
-    print(topic, msg, retained, qos)
-    if hex_encode:
-        # Decode the message from hex if hex_encode is True
-        try:
-            msg = bytes.fromhex(msg.decode('utf-8'))
-        except ValueError:
-            print("Error decoding hex message")
+    print(topic, bytes(msg), retained, qos)
+    # The topic suffix tells us how the payload is encoded, and with channels
+    # which one the message is for
+    hdr = None
+    if channels is not None:
+        chan = channels.lookup(topic)
+        if chan is None:
+            print("No channel for topic", topic)
             return
-    # Append the message to the MQTT RX queue
+        hdr, codec = chan
+    else:
+        codec = payload.codec_for_topic(topic, sys_constants.SUBSCRIBE_TOPIC)
+    if codec is None:
+        print("Unknown payload codec for topic", topic)
+        return
+    try:
+        frames = codec.unpack(msg)
+    except ValueError:
+        print("Error decoding", codec.name, "message")
+        return
+    # Append the message(s) to the MQTT RX queue
     # Message callbacks are non-async, so we use put_nowait to avoid blocking.
-    mqtt_rx_queue.put_nowait((topic, msg, retained, qos))
+    prio = mqtt_prio.get(topic, sys_constants.QUEUE_DEFAULT_PRIO)
+    for frame in frames:
+        if hdr is not None:
+            frame = hdr + frame
+        if not mqtt_rx_queue.put_nowait((topic, frame, retained, qos), prio):
+            print("MQTT RX queue full, dropped a class", prio, "message")
 
 async def conn_callback(client):
     """Callback function to handle MQTT connection events.
@@ -178,39 +176,102 @@ async def conn_callback(client):
     """
     netlight.override = False  # Allow the netlight to be controlled by the MQTT client
     print("MQTT connected, subscribing to", sys_constants.SUBSCRIBE_TOPIC)
-    # Subscribe to the topic with QoS level 1
+    if channels is not None:
+        # one subscription covers the base topic and all channel subtopics
+        await client.subscribe(sys_constants.SUBSCRIBE_TOPIC + '/#', 1)
+        return
+    # Subscribe to the topic with QoS level 1, both bare (legacy hex) and
+    # with a payload codec suffix
     await client.subscribe(sys_constants.SUBSCRIBE_TOPIC, 1)
+    await client.subscribe(sys_constants.SUBSCRIBE_TOPIC + '/+', 1)
 
 async def mqtt_rx_queue_reader():
     while True:
         topic, msg, retained, qos = await mqtt_rx_queue.get()
         print("Received from MQTT RX queue:", topic, msg.hex(), retained, qos)
-        frame = cobs_encode(msg)  # encode the message as COBS
-        frame += b'\x00'          # append a zero byte to frame
-        # Send the encoded message over UART in chunks of 8 bytes, so as
-        # not to over-fill the UART Tx FIFO and hence block async execution.
-        print("Sending to UART:", frame.hex())
-        for i in range(0, len(frame), 8):
-            uart.write(frame[i:i+8])
-            await asyncio.sleep(0)  # cooperative yield
+        if baud is not None:
+            await baud.ready.wait() # hold data back while the baud rate changes
+        if channels is not None:
+            await channels.ready.wait() # and until the host knows the channels
+        # Send the message as a COBS frame. If more messages are already queued
+        # the frame is held back so they all go out in a single UART write.
+        await uart_out.send(msg, flush=mqtt_rx_queue.empty())
 
 async def uart_rx_queue_reader():
+    if isinstance(tx_codec, payload.BatchCodec):
+        await uart_rx_batch_reader()
     while True:
-        msg = await uart_rx_queue.get()
-        print("Received from UART RX queue:", msg)
-        if hex_encode:
-            # Encode the message to hex if hex_encode is True
-            msg = msg.hex().encode('utf-8')
-        await client.publish(sys_constants.PUBLISH_TOPIC, msg, qos=1)
+        topic, msg = await uart_rx_queue.get()
+        print("Received from UART RX queue:", topic, msg)
+        await client.publish(topic, tx_codec.encode(msg), qos=1)
+        batch_stats.frames += 1
+        batch_stats.batches += 1
+
+async def uart_rx_batch_reader():
+    """Drain the UART RX queue into batches and publish each batch as one message."""
+    # the payload's frame count is one byte
+    max_frames = min(sys_constants.BATCH_MAX_FRAMES, tx_codec.MAX_FRAMES)
+    max_bytes = sys_constants.BATCH_MAX_BYTES
+    batch_buf = bytearray(max_bytes)
+    frames = []
+    carry = None # frame that didn't fit in the previous batch, or is for another topic
+    while True:
+        topic, msg = carry if carry is not None else await uart_rx_queue.get()
+        carry = None
+        frames.append(msg)
+        size = 1 + tx_codec.frame_size(msg)
+        deadline = time.ticks_add(time.ticks_ms(), sys_constants.BATCH_MAX_DELAY_MS)
+        while len(frames) < max_frames:
+            if uart_rx_queue.empty():
+                remaining = time.ticks_diff(deadline, time.ticks_ms())
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for_ms(uart_rx_queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = uart_rx_queue.get_nowait()
+            msg = item[1]
+            n = tx_codec.frame_size(msg)
+            if item[0] != topic or size + n > max_bytes:
+                carry = item
+                break
+            frames.append(msg)
+            size += n
+        # a single frame may be larger than batch_buf, in which case pack() allocates
+        buf = batch_buf if size <= max_bytes else None
+        await client.publish(topic, tx_codec.pack(frames, buf), qos=1)
+        batch_stats.frames += len(frames)
+        batch_stats.batches += 1
+        print("Published", len(frames), "frames, batching factor", batch_stats.factor())
+        frames.clear()
 
 async def main():
     asyncio.create_task(uart_rx_loop())
     asyncio.create_task(mqtt_rx_queue_reader())
     asyncio.create_task(uart_rx_queue_reader())
+    if baud is not None:
+        asyncio.create_task(baud.run())
+    if uart_link is not None:
+        asyncio.create_task(uart_link.start())
+    if channels is not None:
+        asyncio.create_task(channels.announce())
     await client.connect()
     print("MQTT connected!")
+    interval = sys_constants.QUEUE_STATS_INTERVAL
+    t = 0
     while True:
         await asyncio.sleep(1)
+        t += 1
+        if interval and t % interval == 0:
+            print("MQTT RX queue:", mqtt_rx_queue, "UART RX queue:", uart_rx_queue)
+            print("UART TX:", uart_tx.frames, "frames in", uart_tx.writes, "writes,",
+                  uart_tx.rate(), "bytes/s")
+            if baud is not None:
+                print("UART baud rate:", baud.rate, baud.stats)
+            if uart_link is not None:
+                print("UART link:", uart_link.stats)
 #        print("Waiting for messages...")
 
 # MQTT configuration
@@ -14,36 +14,39 @@
 VERSION = (0, 7, 4)
 
 import gc, socket, struct
+from random import getrandbits
 from binascii import hexlify
 from errno import EINPROGRESS
 from sys import platform
 
-#try:
-# imports used with Micropython
-from micropython import const
-from time import ticks_ms, ticks_diff
-import uasyncio as asyncio
-async def open_connection(addr):
-    return ( await asyncio.open_connection(addr[0], addr[1]) )[0]
-gc.collect()
-from machine import unique_id
-gc.collect()
+try:
+    # imports used with Micropython
+    from micropython import const
+    from time import ticks_ms, ticks_diff, ticks_add
+    import uasyncio as asyncio
+    async def open_connection(addr):
+        return ( await asyncio.open_connection(addr[0], addr[1]) )[0]
+    gc.collect()
+    from machine import unique_id
+    gc.collect()
 
-# Instead, define a dummy interface class for LTE/PPP:
-class DummyInterface:
-    def isconnected(self):
-        return True
-    def active(self, val=None):
-        pass
-    def disconnect(self):
-        pass
+    # Instead, define a dummy interface class for LTE/PPP:
+    class DummyInterface:
+        def isconnected(self):
+            return True
+        def active(self, val=None):
+            pass
+        def disconnect(self):
+            pass
 
-STA_IF = DummyInterface()
+    STA_IF = DummyInterface()
 
-def is_awaitable(f): return f.__class__.__name__ == 'generator'
-#except Exception(e):
+    def is_awaitable(f): return f.__class__.__name__ == 'generator'
+except ImportError:
     # Imports used with CPython (moved to another file so they don't appear on MP HW)
-#    from cpy_fix import *
+    from cpy_fix import *
+from dns_async import Resolver
+gc.collect()
 
 try:
     import logging
@@ -76,6 +79,9 @@ except:
 # Can be overridden in tests to make things go faster
 _CONN_DELAY = const(1)
 
+# Marker stored in an _unacked_pids entry when the ack timed out
+_TIMED_OUT = const(-1)
+
 # Error strings used with OSError(-1, ...) for internally raised errors.
 CONN_CLOSED = "Connection closed"
 CONN_TIMEOUT = "Connection timed out"
@@ -92,7 +98,17 @@ class MQTTConfig:
         self.password        = b''
         self.response_time   = 10  # in seconds
         self.keepalive       = 600 # in seconds, only sent if self.will != None
-        self.ssl_params      = None
+        self.ssl_params      = None # dict to enable TLS, see mqtt_tls.TLSSession for the keys
+        self.max_inflight    = 1   # max number of unacked async QoS 1 publishes
+        self.read_buf_size   = 512 # size of the receive buffer, larger packets are allocated
+        self.subs_copy       = False # pass bytes instead of memoryviews to subs_cb
+        self.protocol_version = 4  # 4 for MQTT 3.1.1, 5 for MQTT 5 (topic aliases, receive maximum)
+        self.spool           = None # mqtt_spool.Spool for messages published while disconnected
+        self.backoff_initial = 1   # in seconds, delay after the first failed reconnect attempt
+        self.backoff_max     = 300 # in seconds, the delay doubles per failed attempt up to this
+        self.tier_attempts   = 2   # failed reconnect attempts at one tier before escalating
+        self.dns_server      = None # DNS server IP address, None to use the network's
+        self.dns_cache       = "dns_cache.json" # file the resolved broker address is saved in
         self.interface       = STA_IF
         self.clean           = True
         self.will            = None             # last will message, must be MQTTMessage
@@ -142,6 +158,352 @@ class MQTTMessage:
         self.qos = qos
         self.pid = pid
 
+# MQTT 5 property identifiers used here
+_PROP_RECEIVE_MAX = const(0x21)
+_PROP_TOPIC_ALIAS_MAX = const(0x22)
+_PROP_TOPIC_ALIAS = const(0x23)
+_PROP_MAX_PACKET_SIZE = const(0x27)
+
+# Sizes of the MQTT 5 properties by identifier: 1, 2 and 4 are big-endian integers, 0 is a varint,
+# -1 is a length-prefixed string or binary blob and -2 a pair of strings.
+_PROP_SIZES = {
+    0x01: 1, 0x02: 4, 0x03: -1, 0x08: -1, 0x09: -1, 0x0B: 0, 0x11: 4, 0x12: -1, 0x13: 2,
+    0x15: -1, 0x16: -1, 0x17: 1, 0x18: 4, 0x19: 1, 0x1A: -1, 0x1C: -1, 0x1F: -1, 0x21: 2,
+    0x22: 2, 0x23: 2, 0x24: 1, 0x25: 1, 0x26: -2, 0x27: 4, 0x28: 1, 0x29: 1, 0x2A: 1,
+}
+
+# _parse_varint parses a varint at buf[i] and returns the value and the index after it
+def _parse_varint(buf, i):
+    n = 0
+    sh = 0
+    while True:
+        b = buf[i]
+        i += 1
+        n |= (b & 0x7f) << sh
+        if not b & 0x80:
+            return n, i
+        sh += 7
+
+# _parse_props skips over the MQTT 5 properties at buf[i] and returns the index after them. If a
+# props dict is passed in, the integer-valued properties are stored in it.
+def _parse_props(buf, i, props=None):
+    n, i = _parse_varint(buf, i)
+    end = i + n
+    while i < end:
+        pid = buf[i]
+        i += 1
+        size = _PROP_SIZES.get(pid)
+        if size is None:
+            raise OSError(-1, PROTO_ERROR, "bad property", pid)
+        if size > 0:
+            v = 0
+            for k in range(size):
+                v = v << 8 | buf[i+k]
+            i += size
+        elif size == 0:
+            v, i = _parse_varint(buf, i)
+        else:
+            v = None
+            for _ in range(-size):
+                i += 2 + (buf[i] << 8 | buf[i+1])
+        if props is not None and v is not None:
+            props[pid] = v
+    if i != end:
+        raise OSError(-1, PROTO_ERROR, "bad properties")
+    return end
+
+# TopicTrie maps subscription topic filters, which may contain the '+' and '#' wildcards, to
+# handlers. Each node is a list [children, handler] where children is a dict keyed by topic level.
+# Matching a topic walks the trie one level at a time, so its cost depends on the depth of the
+# topic and not on the number of filters.
+class TopicTrie:
+    def __init__(self):
+        self._root = [{}, None]
+        self.count = 0 # number of filters
+
+    # add sets the handler for a topic filter, replacing any previous handler for the same filter
+    def add(self, topic_filter, handler):
+        if isinstance(topic_filter, str): topic_filter = topic_filter.encode()
+        levels = topic_filter.split(b'/')
+        for i, level in enumerate(levels):
+            if (level == b'#' and i != len(levels)-1) or \
+                    (len(level) > 1 and (b'#' in level or b'+' in level)):
+                raise ValueError('invalid topic filter')
+        node = self._root
+        for level in levels:
+            child = node[0].get(level)
+            if child is None:
+                child = node[0][level] = [{}, None]
+            node = child
+        if node[1] is None:
+            self.count += 1
+        node[1] = handler
+
+    # match returns the handlers of all filters matching the topic
+    def match(self, topic):
+        out = []
+        if self.count:
+            self._match(self._root, bytes(topic).split(b'/'), 0, out)
+        return out
+
+    def _match(self, node, levels, i, out):
+        children = node[0]
+        if i == len(levels):
+            if node[1] is not None:
+                out.append(node[1])
+            # 'a/#' also matches 'a'
+            child = children.get(b'#')
+            if child is not None:
+                out.append(child[1])
+            return
+        # wildcards at the first level don't match topics starting with '$'
+        if i or levels[0][:1] != b'$':
+            child = children.get(b'#')
+            if child is not None:
+                out.append(child[1])
+            child = children.get(b'+')
+            if child is not None:
+                self._match(child, levels, i+1, out)
+        child = children.get(levels[i])
+        if child is not None:
+            self._match(child, levels, i+1, out)
+
+# PacketBuilder constructs outgoing PUBLISH and PUBACK packets in preallocated buffers so steady-state
+# publishing and acking doesn't allocate. For each topic it caches the precomputed 16-bit length and
+# topic bytes, so only the fixed header and the pid have to be filled in per packet. PUBLISH
+# packets are handed out as memoryviews of the start of the buffer, cached by length, so once a
+# packet length has been seen building and writing a packet of that length allocates nothing.
+# The packets returned are memoryviews into the builder's buffers and must be written to the socket
+# before the next packet is built, i.e. without an intervening await. The uasyncio stream copies
+# what it can't send straight away, so the buffers can be reused as soon as the write returns.
+class PacketBuilder:
+    MAX_TOPICS = 16 # size of the topic cache, it is flushed when full
+    MAX_VIEWS = 16  # size of the packet view cache, it is flushed when full
+
+    def __init__(self, size=1440): # slightly conservative MSS
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._puback = bytearray(b"\x40\x02\0\0")
+        self._topics = {}
+        self._views = {}  # packet length -> memoryview of that many bytes of _buf
+
+    # topic_prefix returns the length-prefixed topic as it appears in a PUBLISH packet
+    def topic_prefix(self, topic):
+        if not isinstance(topic, bytes):
+            topic = bytes(topic)
+        prefix = self._topics.get(topic)
+        if prefix is None:
+            if len(self._topics) >= self.MAX_TOPICS:
+                self._topics.clear()
+            prefix = bytearray(2 + len(topic))
+            struct.pack_into("!H", prefix, 0, len(topic))
+            prefix[2:] = topic
+            self._topics[topic] = prefix
+        return prefix
+
+    # _remaining returns the remaining length of the PUBLISH packet publish() builds for msg
+    @staticmethod
+    def _remaining(msg, v5, alias, with_topic):
+        sz = 2 + (len(msg.topic) if with_topic else 0) + len(msg.message)
+        if msg.qos > 0:
+            sz += 2 # account for pid
+        if v5:
+            sz += 4 if alias else 1 # account for properties
+        return sz
+
+    # publish_size returns the total length of the PUBLISH packet publish() builds for msg
+    def publish_size(self, msg, v5=False, alias=0, with_topic=True):
+        sz = self._remaining(msg, v5, alias, with_topic)
+        n = 2 # fixed header byte and the last byte of the remaining length
+        v = sz
+        while v > 0x7f:
+            v >>= 7
+            n += 1
+        return n + sz
+
+    # packet returns the first n bytes of the PUBLISH buffer
+    def packet(self, n):
+        v = self._views.get(n)
+        if v is None:
+            if len(self._views) >= self.MAX_VIEWS:
+                self._views.clear()
+            v = self._mv[:n]
+            self._views[n] = v
+        return v
+
+    # publish builds a PUBLISH packet for msg and returns its length n, to be fetched with
+    # packet(n). If the message doesn't fit into the buffer only the header is built, -n is
+    # returned and the message has to be written separately after packet(n).
+    # For MQTT 5 (v5=True) a properties section is added, holding the topic alias if one is given.
+    # If with_topic is False the topic is left empty so the broker uses the alias instead.
+    def publish(self, msg, dup=0, v5=False, alias=0, with_topic=True):
+        prefix = self.topic_prefix(msg.topic) if with_topic else b"\0\0"
+        mlen = len(msg.message)
+        sz = self._remaining(msg, v5, alias, with_topic)
+        if sz >= 2097152:
+            raise ValueError('message too long')
+        pkt = self._buf
+        pkt[0] = 0x30 | msg.qos << 1 | msg.retain | dup << 3
+        l = 1
+        v = sz
+        while v > 0x7f:
+            pkt[l] = (v & 0x7f) | 0x80
+            v >>= 7
+            l += 1
+        pkt[l] = v
+        l += 1
+        pkt[l:l+len(prefix)] = prefix
+        l += len(prefix)
+        if msg.qos > 0:
+            pkt[l] = msg.pid >> 8
+            pkt[l+1] = msg.pid & 0xff
+            l += 2
+        if v5:
+            if alias:
+                pkt[l] = 3
+                pkt[l+1] = _PROP_TOPIC_ALIAS
+                pkt[l+2] = alias >> 8
+                pkt[l+3] = alias & 0xff
+                l += 4
+            else:
+                pkt[l] = 0
+                l += 1
+        if l + mlen > len(pkt):
+            return -l
+        self._mv[l:l+mlen] = msg.message
+        return l + mlen
+
+    # puback builds a PUBACK packet for pid
+    def puback(self, pid):
+        self._puback[2] = pid >> 8
+        self._puback[3] = pid & 0xff
+        return self._puback
+
+# Timers runs all of MQTTClient's timed events (keepalive pings, ack time-outs and reconnect delays)
+# from a single coroutine that sleeps until the earliest deadline. This way the event loop isn't woken
+# up periodically just to find that nothing needs doing, which lets the chip stay in lightsleep.
+# The deadlines are kept in a list sorted by time, which is cheap for the handful of timers in use.
+# Callbacks are plain functions called with a single argument, they must not block.
+class Timers:
+    def __init__(self):
+        self._q = []     # [deadline, cb, arg] entries, earliest first
+        self._ev = asyncio.Event() # set to make the runner re-evaluate the earliest deadline
+        self._task = None
+        self.wakeups = 0 # number of times the runner woke up
+
+    # schedule calls cb(arg) after delay_ms milliseconds and returns a handle for cancel()
+    def schedule(self, delay_ms, cb, arg=None):
+        t = [ticks_add(ticks_ms(), int(delay_ms)), cb, arg]
+        q = self._q
+        i = 0
+        while i < len(q) and ticks_diff(q[i][0], t[0]) <= 0:
+            i += 1
+        q.insert(i, t)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        elif i == 0:
+            self._ev.set() # new earliest deadline
+        return t
+
+    # cancel removes a timer that hasn't fired yet
+    def cancel(self, t):
+        q = self._q
+        for i in range(len(q)):
+            if q[i] is t:
+                q.pop(i)
+                return
+
+    # sleep_ms is like asyncio.sleep_ms but goes through the timers
+    async def sleep_ms(self, delay_ms):
+        ev = asyncio.Event()
+        self.schedule(delay_ms, _set_event, ev)
+        await ev.wait()
+
+    # stop cancels all timers and the runner; coroutines waiting in sleep_ms() return straight away
+    # so they can notice they've been stopped
+    def stop(self):
+        for _, cb, arg in self._q:
+            if cb is _set_event:
+                arg.set()
+        self._q.clear()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        q = self._q
+        while True:
+            self.wakeups += 1
+            now = ticks_ms()
+            while q and ticks_diff(q[0][0], now) <= 0:
+                _, cb, arg = q.pop(0)
+                cb(arg)
+            self._ev.clear()
+            if not q:
+                await self._ev.wait()
+                continue
+            try:
+                await asyncio.wait_for_ms(self._ev.wait(), ticks_diff(q[0][0], ticks_ms()))
+            except asyncio.TimeoutError:
+                pass
+
+def _set_event(ev): ev.set()
+
+# Reconnect tiers, from least to most disruptive: reconnect TCP to the known broker address,
+# re-resolve the broker's name first, or take the network link down and back up first.
+TIER_TCP = const(0)
+TIER_DNS = const(1)
+TIER_LINK = const(2)
+TIER_NAMES = ("tcp", "dns", "link")
+
+# Backoff produces jittered exponentially increasing delays: each delay is picked at random from
+# the upper half of the current backoff interval, which doubles up to max_ms.
+class Backoff:
+    def __init__(self, initial_ms, max_ms):
+        self._initial = initial_ms
+        self._max = max_ms
+        self.reset()
+
+    def reset(self):
+        self._cur = self._initial
+
+    def next_ms(self):
+        d = self._cur
+        self._cur = min(d * 2, self._max)
+        half = d // 2
+        return half + getrandbits(16) * (d - half) // 65536
+
+# ReconnectStats records how reconnections went, available as MQTTClient.reconnect_stats.
+class ReconnectStats:
+    # Upper bounds in ms of the time-to-reconnect histogram buckets, the last bucket counts the rest
+    HIST_MS = (1000, 5000, 15000, 60000, 300000)
+
+    def __init__(self):
+        self.outages = 0          # number of times the connection was lost
+        self.attempts = [0, 0, 0] # reconnect attempts per tier
+        self.successes = [0, 0, 0] # successful reconnects per tier
+        self.histogram = [0] * (len(self.HIST_MS) + 1) # time from connection loss to reconnect
+        self.last_ms = None       # time to reconnect after the most recent outage
+
+    def record(self, tier, ms):
+        self.successes[tier] += 1
+        self.last_ms = ms
+        i = 0
+        while i < len(self.HIST_MS) and ms > self.HIST_MS[i]:
+            i += 1
+        self.histogram[i] += 1
+
+    def __str__(self):
+        return "outages=%d attempts=%s successes=%s hist=%s" % (self.outages,
+            dict(zip(TIER_NAMES, self.attempts)), dict(zip(TIER_NAMES, self.successes)),
+            self.histogram)
+
+# _await_all awaits the awaitable results of several handlers
+async def _await_all(results):
+    for r in results:
+        if is_awaitable(r):
+            await r
+
 # MQTTproto implements the MQTT protocol on the basis of a good connection on a single connection.
 # A new class instance is required for each new connection.
 # Connection failures and EOF cause an OSError exception to be raised.
@@ -152,25 +514,44 @@ class MQTTProto:
     # __init__ creates a new connection based on the config.
     # The list of init params is lengthy but it clearly spells out the dependencies/inputs.
     # The _cb parameters are for publish, puback, and suback packets.
-    def __init__(self, subs_cb, puback_cb, suback_cb, pingresp_cb, sock_cb=None):
+    # The topic and message passed to subs_cb are memoryviews into the receive buffer that are only
+    # valid until the callback returns, unless subs_copy is set, in which case they are bytes.
+    # The packet builder may be shared by successive connections so its topic cache survives.
+    # Version is the MQTT protocol level: 4 for MQTT 3.1.1 or 5 for MQTT 5.
+    def __init__(self, subs_cb, puback_cb, suback_cb, pingresp_cb, sock_cb=None,
+            read_buf_size=512, subs_copy=False, pkts=None, version=4):
         # Store init params
         self._subs_cb = subs_cb
         self._puback_cb = puback_cb
         self._suback_cb = suback_cb
         self._pingresp_cb = pingresp_cb
         self._sock_cb = sock_cb
+        self._subs_copy = subs_copy
+        self._pkts = pkts if pkts is not None else PacketBuilder()
+        self._v5 = version == 5
+        # Limits announced by an MQTT 5 broker in CONNACK, the defaults apply to MQTT 3.1.1
+        self.receive_max = 65535  # max number of unacked QoS 1 publishes the broker accepts
+        self.topic_alias_max = 0  # max number of topic aliases the broker accepts
+        self.max_packet_size = 0  # largest packet the broker accepts, 0 if it sets no limit
+        self._aliases = {}        # topic -> alias assigned on this connection
         # Init key instance vars
         self._sock = None
         self._lock = asyncio.Lock()
         self.last_ack = 0 # last ACK received from broker
+        # Receive buffer: bytes in _read_buf[_read_pos:_read_end] have been received but not consumed
+        self._read_buf = bytearray(read_buf_size)
+        self._read_mv = memoryview(self._read_buf)
+        self._read_pos = 0
+        self._read_end = 0
 
     # connect initiates a connection to the broker at addr.
     # Addr should be the result of a gethostbyname (typ. an ip-address and port tuple).
     # The clean parameter corresponds to the MQTT clean connection attribute.
+    # If tls is a mqtt_tls.TLSSession the connection is wrapped in TLS.
     # Connect waits for the connection to get established and for the broker to ACK the connect packet.
     # It raises an OSError if the connection cannot be made.
     # Reusing an MQTTProto for a second connection is not recommended.
-    async def connect(self, addr, client_id, clean, user=None, pwd=None, ssl_params=None,
+    async def connect(self, addr, client_id, clean, user=None, pwd=None, tls=None,
             keepalive=0, lw=None):
         if lw is None:
             keepalive = 0
@@ -186,17 +567,19 @@ class MQTTProto:
         await asyncio.sleep_ms(10) # sure sure this is needed...
         #if self._sock_cb is not None: # st socket event for mqrepl's use
         #    self._sock.setsockopt(socket.SOL_SOCKET, 20, self._sock_cb)
-        assert ssl_params is None, "TLS not yet supported" # :-(
-        #if ssl_params is not None:
-        #    log.debug("Wrapping SSL")
-        #    import ssl
-        #    self._sock = ssl.wrap_socket(self._sock, **ssl_params)
+        if tls is not None:
+            log.debug("Wrapping SSL")
+            if tls.wrap(self._sock):
+                log.warning("TLS session resumption not supported by ssl, doing full handshakes")
         # Construct connect packet
         premsg = bytearray(b"\x10\0\0\0\0")   # Connect message header
-        msg = bytearray(b"\0\x04MQTT\x04\0\0\0")  # Protocol 3.1.1
+        if self._v5:
+            msg = bytearray(b"\0\x04MQTT\x05\0\0\0\0")  # Protocol 5, no properties
+        else:
+            msg = bytearray(b"\0\x04MQTT\x04\0\0\0")  # Protocol 3.1.1
         if isinstance(client_id, str):
             client_id = client_id.encode()
-        sz = 10 + 2 + len(client_id)
+        sz = len(msg) + 2 + len(client_id)
         msg[7] = (clean&1) << 1
         if user is not None:
             if isinstance(user, str): user = user.encode()
@@ -207,7 +590,7 @@ class MQTTProto:
             msg[8] |= (keepalive >> 8) & 0x00FF
             msg[9] |= keepalive & 0x00FF
         if lw is not None:
-            sz += 2 + len(lw.topic) + 2 + len(lw.message)
+            sz += 2 + len(lw.topic) + 2 + len(lw.message) + self._v5 # v5: will properties
             msg[7] |= 0x4 | (lw.qos & 0x1) << 3 | (lw.qos & 0x2) << 3
             msg[7] |= lw.retain << 5
         i = self._write_varint(premsg, 1, sz)
@@ -217,6 +600,8 @@ class MQTTProto:
         await self._as_write(msg, drain=False)
         await self._send_str(client_id, drain=False)
         if lw is not None:
+            if self._v5:
+                await self._as_write(b"\0", drain=False) # no will properties
             await self._send_str(lw.topic) # let it drain in case message is long
             await self._send_str(lw.message)
         if user is not None:
@@ -225,41 +610,84 @@ class MQTTProto:
         await self._as_write(b'') # cause drain
         # Await CONNACK
         # read causes ECONNABORTED if broker is out
-        resp = await self._as_read(4)
-        if resp[3] != 0 or resp[0] != 0x20 or resp[1] != 0x02:
-            raise OSError(-1)  # Bad CONNACK e.g. authentication fail.
+        if self._v5:
+            if await self._read_byte() != 0x20:
+                raise OSError(-1)  # Bad CONNACK
+            sz = await self._read_varint()
+            resp = await self._as_read(sz)
+            if sz < 3 or resp[1] != 0:
+                raise OSError(-1)  # Bad CONNACK e.g. authentication fail.
+            props = {}
+            _parse_props(resp, 2, props)
+            self.receive_max = props.get(_PROP_RECEIVE_MAX, 65535)
+            self.topic_alias_max = props.get(_PROP_TOPIC_ALIAS_MAX, 0)
+            self.max_packet_size = props.get(_PROP_MAX_PACKET_SIZE, 0)
+            log.debug('CONNACK props %s', props)
+        else:
+            resp = await self._as_read(4)
+            if resp[3] != 0 or resp[0] != 0x20 or resp[1] != 0x02:
+                raise OSError(-1)  # Bad CONNACK e.g. authentication fail.
+        if tls is not None:
+            tls.connected()
         self.last_ack = ticks_ms()
         log.debug('Connected')  # Got CONNACK
 
     # ===== Helpers
 
+    # _fill makes sure that at least n bytes are buffered contiguously at the read cursor, n must
+    # not exceed the size of the receive buffer. Bytes are read straight into the buffer using
+    # readinto, asking for as much as fits because calling self._sock.readinto takes 4-5ms minimum
+    # and read_msg does a good number of very short reads. On error *and on EOF* it raises an
+    # OSError. There is no time-out, instead, _fill relies on the socket being closed by a watchdog.
+    async def _fill(self, n):
+        avail = self._read_end - self._read_pos
+        if avail >= n:
+            return
+        buf = self._read_mv
+        if self._read_pos + n > len(buf):
+            # not enough room after the cursor: move what we have to the start of the buffer
+            if avail:
+                buf[0:avail] = buf[self._read_pos:self._read_end]
+            self._read_pos = 0
+            self._read_end = avail
+        while self._read_end - self._read_pos < n:
+            if self._sock is None:
+                raise OSError(-1, CONN_CLOSED)
+            # Note: uasyncio.Stream.readinto returns short reads
+            got = await self._sock.readinto(buf[self._read_end:])
+            if not got:
+                raise OSError(-1, CONN_CLOSED)
+            self._read_end += got
+
     # _as_read reads n bytes from the socket in a blocking manner using asyncio and returns them as
-    # bytes. On error *and on EOF* it raises an OSError.
-    # There is no time-out, instead, as_read relies on the socket being closed by a watchdog.
-    # _as_read buffers a bunch of bytes because calling self.sock._read takes 4-5ms minumum and
-    # _read_msg does a good number of very short reads.
+    # a memoryview, which is only valid until the next read. If n exceeds the size of the receive
+    # buffer a new buffer is allocated for the result. On error *and on EOF* it raises an OSError.
     async def _as_read(self, n):
-        # Note: uasyncio.Stream.read returns short reads
-        #t0 = ticks_ms()
-        while self._sock:
-            # read missing amt
-            missing = n - len(self._read_buf)
-            if missing > 0:
-                if missing < 128:
-                    missing = 128
-                got = await self._sock.read(missing)
-                if len(got) == 0:
-                    raise OSError(-1, CONN_CLOSED)
-                self._read_buf += got
-                missing = n - len(self._read_buf)
-            # got enough?
-            if missing <= 0:
-                res = self._read_buf[:n]
-                self._read_buf = self._read_buf[n:]
-                #print("rd", len(res), "in", ticks_diff(ticks_ms(), t0))
-                return res
-        raise OSError(-1, CONN_CLOSED)
-    _read_buf = b''
+        if n <= len(self._read_buf):
+            await self._fill(n)
+            pos = self._read_pos
+            self._read_pos = pos + n
+            return self._read_mv[pos:pos+n]
+        # too large for the receive buffer: take what's buffered and read the rest directly
+        res = memoryview(bytearray(n))
+        got = self._read_end - self._read_pos
+        res[0:got] = self._read_mv[self._read_pos:self._read_end]
+        self._read_pos = self._read_end = 0
+        while got < n:
+            if self._sock is None:
+                raise OSError(-1, CONN_CLOSED)
+            k = await self._sock.readinto(res[got:])
+            if not k:
+                raise OSError(-1, CONN_CLOSED)
+            got += k
+        return res
+
+    # _read_byte reads a single byte and returns it as an int
+    async def _read_byte(self):
+        await self._fill(1)
+        b = self._read_buf[self._read_pos]
+        self._read_pos += 1
+        return b
 
     # _as_write writes n bytes to the socket in a blocking manner using asyncio. On error or EOF
     # it raises an OSError.
@@ -267,7 +695,7 @@ class MQTTProto:
     async def _as_write(self, bytes_wr, drain=True):
         if self._sock is None:
             raise OSError(-1, CONN_CLOSED)
-        if bytes_wr != b'':
+        if len(bytes_wr):
             self._sock.write(bytes_wr)
         if drain:
             await self._sock.drain()
@@ -283,8 +711,7 @@ class MQTTProto:
         n = 0
         sh = 0
         while 1:
-            res = await self._as_read(1)
-            b = res[0]
+            b = await self._read_byte()
             n |= (b & 0x7f) << sh
             if not b & 0x80:
                 return n
@@ -324,52 +751,45 @@ class MQTTProto:
             await self._sock.wait_closed()
         self._sock = None
 
-    def isconnected(self): self._sock is not None
+    def isconnected(self): return self._sock is not None
 
-    # publish writes a publish message onto the current socket. It raises an OSError on failure.
+    # publish writes a publish message onto the current socket. It raises an OSError on failure,
+    # and a ValueError if the packet is longer than the broker's maximum packet size.
     # If qos==1 then a pid must be provided.
     # msg.topic and msg.message must be byte arrays, or equiv.
     async def publish(self, msg, dup=0):
-        # calculate message length
-        mlen = len(msg.message)
-        sz = 2 + len(msg.topic) + mlen
-        if msg.qos > 0:
-            sz += 2 # account for pid
-        if sz >= 2097152:
-            raise ValueError('message too long')
-        # construct packet: if possible, put everything into a single large bytearray so a single
-        # socket send call can be made resulting in a single packet.
-        hdrlen = 4+2+len(msg.topic)+2
-        single = hdrlen + mlen <= 1440 # slightly conservative MSS
-        if single:
-            pkt = bytearray(hdrlen+mlen)
-        else:
-            pkt = bytearray(hdrlen)
-        pkt[0] = 0x30 | msg.qos << 1 | msg.retain | dup << 3
-        l = self._write_varint(pkt, 1, sz)
-        struct.pack_into("!H", pkt, l, len(msg.topic))
-        l += 2
-        pkt[l:l+len(msg.topic)] = msg.topic
-        l += len(msg.topic)
-        if msg.qos > 0:
-            struct.pack_into("!H", pkt, l, msg.pid)
-            l += 2
-        # send header and body
+        # construct packet: if possible, put everything into a single packet so a single socket
+        # send call can be made resulting in a single TCP segment.
         async with self._lock:
-            if single:
-                pkt[l:] = msg.message
-                await self._as_write(pkt)
+            alias = 0
+            with_topic = True
+            if self.topic_alias_max:
+                # MQTT 5: the first publish to a topic assigns it an alias, later ones only send that
+                topic = msg.topic if isinstance(msg.topic, bytes) else bytes(msg.topic)
+                alias = self._aliases.get(topic, 0)
+                if alias:
+                    with_topic = False
+                elif len(self._aliases) < self.topic_alias_max:
+                    alias = len(self._aliases) + 1
+            limit = self.max_packet_size
+            if limit and self._pkts.publish_size(msg, self._v5, alias, with_topic) > limit:
+                raise ValueError('message too long for broker')
+            if alias and with_topic:
+                self._aliases[topic] = alias
+            n = self._pkts.publish(msg, dup, self._v5, alias, with_topic)
+            if n > 0:
+                await self._as_write(self._pkts.packet(n))
             else:
-                await self._as_write(pkt[:l])
+                await self._as_write(self._pkts.packet(-n), drain=False)
                 await self._as_write(msg.message)
 
     # subscribe sends a subscription message.
     async def subscribe(self, topic, qos, pid):
         if (qos & 1) != qos:
             raise ValueError("invalid qos")
-        pkt = bytearray(b"\x82\0\0\0")
+        pkt = bytearray(b"\x82\0\0\0\0" if self._v5 else b"\x82\0\0\0") # v5: no properties
         if isinstance(topic, str): topic = topic.encode()
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, pid)
+        struct.pack_into("!BH", pkt, 1, len(pkt) - 2 + 2 + len(topic) + 1, pid)
         async with self._lock:
             await self._as_write(pkt, drain=False)
             await self._send_str(topic, drain=False)
@@ -381,44 +801,55 @@ class MQTTProto:
     # Called from ._handle_msg().
     async def read_msg(self):
         #t0 = ticks_ms()
-        res = await self._as_read(1)
+        op = await self._read_byte()
         # We got something, dispatch based on message type
-        op = res[0]
         if op == 0xd0:  # PINGRESP
-            await self._as_read(1)
+            await self._read_byte()
             self.last_ack = ticks_ms()
             self._pingresp_cb()
         elif op == 0x40:  # PUBACK: remove pid from unacked_pids
-            sz = await self._as_read(1)
-            if sz != b"\x02":
+            sz = await self._read_varint()
+            if sz < 2 or (sz > 2 and not self._v5): # v5 may add a reason code and properties
                 raise OSError(-1, PROTO_ERROR, "puback", sz)
-            rcv_pid = await self._as_read(2)
-            pid = rcv_pid[0] << 8 | rcv_pid[1]
+            resp = await self._as_read(sz)
+            pid = resp[0] << 8 | resp[1]
             self.last_ack = ticks_ms()
-            self._puback_cb(pid)
+            self._puback_cb(pid, resp[2] if sz > 2 else 0)
         elif op == 0x90:  # SUBACK: flag pending subscribe to end
-            resp = await self._as_read(4)
-            pid = resp[2] | (resp[1] << 8)
-            #print("suback", resp[3])
+            sz = await self._read_varint()
+            resp = await self._as_read(sz)
+            pid = resp[1] | (resp[0] << 8)
+            i = _parse_props(resp, 2) if self._v5 else 2
+            if i >= sz:
+                raise OSError(-1, PROTO_ERROR, "suback", sz)
+            #print("suback", resp[i])
             self.last_ack = ticks_ms()
-            self._suback_cb(pid, resp[3])
+            self._suback_cb(pid, resp[i])
         elif (op & 0xf0) == 0x30:  # PUB: dispatch to user handler
             sz = await self._read_varint()
-            topic_len = await self._as_read(2)
-            topic_len = (topic_len[0] << 8) | topic_len[1]
-            topic = await self._as_read(topic_len)
-            sz -= topic_len + 2
+            # read the whole variable header and payload in one go and parse it in place
+            body = await self._as_read(sz)
+            if sz < 2:
+                raise OSError(-1, PROTO_ERROR, "pub sz", sz)
+            topic_len = (body[0] << 8) | body[1]
+            i = 2 + topic_len
             retained = op & 0x01
             qos = (op>>1) & 3
+            if i + (2 if qos else 0) > sz:
+                raise OSError(-1, PROTO_ERROR, "pub sz", sz)
+            topic = body[2:i]
             pid = None
             if qos: # not QoS=0 -> got pid
-                pid = await self._as_read(2)
-                pid = pid[0] << 8 | pid[1]
-                sz -= 2
-            if sz < 0:
-                raise OSError(-1, PROTO_ERROR, "pub sz", sz)
-            else:
-                msg = await self._as_read(sz)
+                pid = body[i] << 8 | body[i+1]
+                i += 2
+            if self._v5: # we don't allow the broker to use topic aliases, so skip all properties
+                if i >= sz:
+                    raise OSError(-1, PROTO_ERROR, "pub sz", sz)
+                i = _parse_props(body, i)
+            msg = body[i:]
+            if self._subs_copy:
+                topic = bytes(topic)
+                msg = bytes(msg)
             # Dispatch to user's callback handler
             log.debug("dispatch pub %s pid=%s qos=%d", topic, pid, qos)
             #t1 = ticks_ms()
@@ -428,14 +859,16 @@ class MQTTProto:
             #t2 = ticks_ms()
             # Send PUBACK for QoS 1 messages
             if qos == 1:
-                pkt = bytearray(b"\x40\x02\0\0")
-                struct.pack_into("!H", pkt, 2, pid)
                 async with self._lock:
-                    await self._as_write(pkt)
+                    await self._as_write(self._pkts.puback(pid))
             elif qos == 2:
                 raise OSError(-1, "QoS=2 not supported")
             #log.debug("read_msg: read:{} handle:{} ack:{}".format(ticks_diff(t1, t0),
             #    ticks_diff(t2, t1), ticks_diff(ticks_ms(), t2)))
+        elif op == 0xe0 and self._v5:  # DISCONNECT from broker
+            sz = await self._read_varint()
+            resp = await self._as_read(sz)
+            raise OSError(-1, CONN_CLOSED, "disconnect", resp[0] if sz else 0)
         else:
             raise OSError(-1, PROTO_ERROR, "bad op", op)
         return op>>4
@@ -459,6 +892,10 @@ class MQTTClient():
             raise ValueError('invalid keepalive')
         if self._c.keepalive > 0 and self._c.keepalive < self._c.response_time * 2:
             raise ValueError("keepalive <2x response_time")
+        if self._c.max_inflight < 1:
+            raise ValueError("max_inflight <1")
+        if self._c.protocol_version not in (4, 5):
+            raise ValueError("unsupported protocol_version")
         # config server and port
         if config.port == 0:
             self._c.port = 8883 if config.ssl_params else 1883
@@ -468,12 +905,33 @@ class MQTTClient():
         self._proto = None
         self._MQTTProto = MQTTProto # reference to class, override for testing
         self._addr = None
+        self._resolver = Resolver(self._c.dns_server, self._c.dns_cache)
+        self._dns_task = None       # handle to the background DNS refresh coro
         self._lastpid = 0
         self._unacked_pids = {}     # PUBACK and SUBACK pids awaiting ACK response
         self._state = 0             # 0=init, 1=has-connected, 2=disconnected=dead
         self._conn_keeper = None    # handle to persistent keep-connection coro
-        self._prev_pub = None       # MQTTMessage of as yet unacked async pub
-        self._prev_pub_proto = None # self._proto used for as yet unacked async pub
+        self._inflight = []         # MQTTMessages of as yet unacked async pubs, oldest first
+        self._inflight_proto = None # self._proto the in-flight pubs were last sent on
+        self._subs = TopicTrie()    # handlers passed to subscribe(), by topic filter
+        self._pkts = PacketBuilder() # outgoing packet buffers, shared by all connections
+        self._drainer = None        # handle to the spool drain coro
+        self._spooled = []          # pids (None for QoS 0) of spooled messages not yet acked
+        self._spool_ev = asyncio.Event() # set when a message is added to the spool
+        self._timers = Timers()     # pings, ack time-outs and reconnect delays
+        self._connected = asyncio.Event() # set while self._proto is not None
+        self._conn_lost = asyncio.Event() # set when a connection is dropped
+        self._backoff = Backoff(self._c.backoff_initial*1000, self._c.backoff_max*1000)
+        self.reconnect_stats = ReconnectStats()
+        self.pub_refused = 0        # QoS 1 publishes refused by an MQTT 5 broker
+        # TLS context and session, kept across connections so the session can be resumed
+        self._tls = None
+        self.tls_stats = None
+        if self._c.ssl_params is not None:
+            from mqtt_tls import TLSSession
+            self._tls = TLSSession(self._c.ssl_params, self._c.server)
+            self.tls_stats = self._tls.stats
+        self._t_lost = 0            # ticks_ms when the connection was last lost
         # misc
         if platform == "esp8266":
             import esp
@@ -516,12 +974,20 @@ class MQTTClient():
             log.warning("Wifi failed to connect")
             raise OSError(-1, "Wifi failed to connect")
 
-    def _dns_lookup(self):
-        new_addr = socket.getaddrinfo(self._c.server, self._c.port)
-        if len(new_addr) > 0 and len(new_addr[0]) > 1:
-            self._addr = new_addr[0][-1]
+    # _dns_lookup resolves the broker's address, answering from the cache if it is fresh unless
+    # force is set
+    async def _dns_lookup(self, force=False):
+        ip = await self._resolver.resolve(self._c.server, force)
+        self._addr = (ip, self._c.port)
         log.debug("DNS %s->%s", self._c.server, self._addr)
 
+    async def _dns_refresh(self):
+        try:
+            await self._dns_lookup(True)
+        except OSError as e:
+            log.warning("DNS refresh failed: %s", e)
+        self._dns_task = None
+
     async def connect(self):
         if self._state > 1:
             raise ValueError("cannot reuse")
@@ -529,15 +995,24 @@ class MQTTClient():
         # deal with wifi and dns
         if not self._c.interface.isconnected():
             await self.wifi_connect()
+        # use a cached address if there is one, only wait for DNS if there isn't; a stale address
+        # (e.g. one saved before a reboot) is used while it's re-resolved in the background
+        ip, fresh = self._resolver.cached(self._c.server)
+        if ip is None:
+            await self._dns_lookup()
+        else:
+            self._addr = (ip, self._c.port)
+            if not fresh and self._dns_task is None:
+                self._dns_task = asyncio.get_event_loop().create_task(self._dns_refresh())
         if self._state == 0:
-            self._dns_lookup() # DNS is blocking, do it only the first time around
             clean = self._c.clean
         # actually open a socket and connect
-        proto = self._MQTTProto(self._c.subs_cb, self._got_puback, self._got_suback,
-                self._got_pingresp)
+        proto = self._MQTTProto(self._dispatch, self._got_puback, self._got_suback,
+                self._got_pingresp, read_buf_size=self._c.read_buf_size,
+                subs_copy=self._c.subs_copy, pkts=self._pkts, version=self._c.protocol_version)
         # FIXME: need to use a timeout here!
         await proto.connect(self._addr, self._c.client_id, clean,
-                user=self._c.user, pwd=self._c.password, ssl_params=self._c.ssl_params,
+                user=self._c.user, pwd=self._c.password, tls=self._tls,
                 keepalive=self._c.keepalive,
                 lw=self._c.will) # raises on error
         self._proto = proto
@@ -555,6 +1030,7 @@ class MQTTClient():
             await self.disconnect() # whoops, someone called disconnect() while we were connecting
             raise OSError(-1, "disconnect while connecting")
         # If we get here without error broker/LAN must be up.
+        self._connected.set()
         loop = asyncio.get_event_loop()
         # Notify app that Wifi is up
         if self._c.wifi_coro is not None:
@@ -562,9 +1038,13 @@ class MQTTClient():
         # Start background coroutines that run until the user calls disconnect
         if self._conn_keeper is None:
             self._conn_keeper = loop.create_task(self._keep_connected())
+        if self._c.spool is not None and self._drainer is None:
+            self._drainer = loop.create_task(self._drain_spool())
         # Start background coroutines that quit on connection fail
         loop.create_task(self._handle_msgs(self._proto))
-        loop.create_task(self._keep_alive(self._proto))
+        if self._inflight:
+            loop.create_task(self._resend_on(self._proto))
+        self._timers.schedule(self._c.response_time*1000, self._keep_alive, self._proto)
         # Notify app that we're connceted and ready to roll
         if self._c.connect_coro is not None:
             loop.create_task(self._c.connect_coro(self))
@@ -572,9 +1052,15 @@ class MQTTClient():
 
     async def disconnect(self):
         self._state = 2 # dead - do not reconnect
+        if self._c.spool is not None:
+            self._c.spool.sync()
+            self._spool_ev.set() # let the drain coro exit
+        self._conn_lost.set() # let the keep-connected coro exit
+        self._timers.stop()
         if self._proto is not None:
             await self._proto.disconnect() # should we do a create_task here?
         self._proto = None
+        self._connected.clear()
 
     #===== Manage PIDs and ACKs
     # self._unacked_pids is a hash that contains unacked pids. Each hash value is a list, the first
@@ -586,10 +1072,31 @@ class MQTTClient():
         if self._lastpid > 65535: self._lastpid = 1
         return self._lastpid
 
-    # _got_puback handles a puback by removing the pid from those we're waiting for
-    def _got_puback(self, pid):
-        if pid in self._unacked_pids:
-            self._unacked_pids[pid][0].set()
+    # _got_puback handles a puback by removing the pid from those we're waiting for. An MQTT 5
+    # reason code of 0x80 or more means the broker refused the message: it is counted in
+    # pub_refused and left in the pid's entry for a sync publish to raise.
+    def _got_puback(self, pid, reason=0):
+        if reason >= 0x80:
+            self.pub_refused += 1
+            log.warning("pub pid=%d refused by broker, reason 0x%02x", pid, reason)
+        ent = self._unacked_pids.get(pid)
+        if ent is not None:
+            if reason >= 0x80:
+                ent[1] = reason
+            ent[0].set()
+        if self._spooled:
+            self._ack_spooled()
+
+    # _ack_spooled acks the spooled messages whose PUBACK has come in (QoS 0 ones once sent) to the
+    # spool, oldest first, so the spool only forgets messages the broker has. Refused ones are acked
+    # too, as sending them again would only get them refused again.
+    def _ack_spooled(self):
+        while self._spooled:
+            ent = self._unacked_pids.get(self._spooled[0])
+            if ent is not None and (not ent[0].is_set() or ent[1] == _TIMED_OUT):
+                break
+            self._spooled.pop(0)
+            self._c.spool.ack()
 
     def _got_pingresp(self): self._got_puback(PING_PID)
 
@@ -600,21 +1107,42 @@ class MQTTClient():
             self._unacked_pids[pid][1] = actual_qos
             self._unacked_pids[pid][0].set()
 
+    # _pid_timeout is the timer callback for an ack that didn't come in time
+    def _pid_timeout(self, pid):
+        ent = self._unacked_pids.get(pid)
+        if ent is not None and not ent[0].is_set():
+            ent[1] = _TIMED_OUT
+            ent[0].set()
+
     # _await_pid waits until the broker ACKs a pub or sub message, or it times out.
     # It returns the second element of the self._unacked_pids list (may be None).
     async def _await_pid(self, pid):
-        if pid not in self._unacked_pids:
+        ent = self._unacked_pids.get(pid)
+        if ent is None:
             return None
         # wait for ACK to come in with a timeout # TODO: calculate timeout based on time sent
-        try:
-            if not self._unacked_pids[pid][0].is_set():
-                await asyncio.wait_for(self._unacked_pids[pid][0].wait(), self._c.response_time)
-        except asyncio.TimeoutError:
+        if not ent[0].is_set():
+            t = self._timers.schedule(self._c.response_time*1000, self._pid_timeout, pid)
+            await ent[0].wait()
+            self._timers.cancel(t)
+        if ent[1] == _TIMED_OUT:
+            # leave the pid in place so a late ack or a retransmission can still complete it
+            ent[0].clear()
+            ent[1] = None
             raise OSError(-1, CONN_TIMEOUT)
         # return second list element
-        ret = self._unacked_pids[pid][1]
-        del self._unacked_pids[pid]
-        return ret
+        self._unacked_pids.pop(pid, None)
+        return ent[1]
+
+    # _dispatch passes an incoming message to the handlers of all subscriptions whose topic filter
+    # matches, or to config.subs_cb if there are none. It returns whatever needs to be awaited.
+    def _dispatch(self, topic, msg, retained, qos):
+        handlers = self._subs.match(topic)
+        if not handlers:
+            return self._c.subs_cb(topic, msg, retained, qos)
+        if len(handlers) == 1:
+            return handlers[0](topic, msg, retained, qos)
+        return _await_all([h(topic, msg, retained, qos) for h in handlers])
 
     #===== Background coroutines
 
@@ -627,29 +1155,65 @@ class MQTTClient():
         except OSError as e:
             await self._reconnect(proto, 'read_msg', e)
 
-    # ping and wait for response, wrapped in a coroutine to be used in asyncio.wait_for()
-    async def _ping_n_wait(self, proto):
-        await proto.ping()
-        await self._await_pid(PING_PID)
+    # Launched by connect when there are in-flight publishes to retransmit on the new connection,
+    # so they don't have to wait for the next call to publish.
+    async def _resend_on(self, proto):
+        try:
+            await self._resend_inflight(proto)
+        except OSError as e:
+            await self._reconnect(proto, 'repub', e)
+
+    # Launched by connect when a spool is configured. Runs until disconnect() and publishes the
+    # spooled messages in order, as fast as the in-flight window allows. A message stays in the
+    # spool until its PUBACK comes in: until then the in-flight window retransmits it on each new
+    # connection, and after a reset the spool hands it out again.
+    async def _drain_spool(self):
+        spool = self._c.spool
+        while self._state == 1:
+            rec = spool.peek()
+            if rec is None:
+                self._spool_ev.clear()
+                await self._spool_ev.wait()
+                continue
+            topic, msg, retain, qos = rec
+            try:
+                pid = await self._publish(topic, msg, retain, qos, sync=False)
+            except ValueError as e:
+                log.warning("dropping spooled message to %s: %s", topic, e)
+                pid = None
+            spool.pop()
+            self._spooled.append(pid)
+            self._ack_spooled() # QoS 0, or acked already
+        self._drainer = None
+
+    # ping sends a ping, wrapped in a coroutine so it can be launched from a timer
+    async def _ping(self, proto):
+        try:
+            await proto.ping()
+        except OSError as e:
+            await self._reconnect(proto, 'ping', e)
 
     # Keep connection alive MQTT spec 3.1.2.10 Keep Alive.
-    # Runs until ping failure or no response in keepalive period.
-    async def _keep_alive(self, proto):
+    # Timer callback that runs response_time after the last ack from the broker. If nothing came in
+    # since then it sends a ping, and if the ping isn't answered within another response_time the
+    # connection is deemed dead. It reschedules itself until the connection fails.
+    def _keep_alive(self, proto):
+        if proto is not self._proto or not proto.isconnected():
+            return
         rt_ms = self._c.response_time*1000
-        try:
-            while proto.isconnected():
-                dt = ticks_diff(ticks_ms(), proto.last_ack)
-                if dt > rt_ms:
-                    # it's time for another ping...
-                    self._unacked_pids[PING_PID] = [ asyncio.Event(), None ]
-                    await asyncio.wait_for(self._ping_n_wait(proto), self._c.response_time)
-                    dt = ticks_diff(ticks_ms(), proto.last_ack)
-                sleep_time = rt_ms - dt
-                if sleep_time < rt_ms/4: # avoid sending pings too frequently
-                    sleep_time = rt_ms/4
-                await asyncio.sleep_ms(sleep_time)
-        except Exception as e:
-            await self._reconnect(proto, 'keepalive')
+        dt = ticks_diff(ticks_ms(), proto.last_ack)
+        if dt < rt_ms:
+            self._timers.schedule(rt_ms - dt, self._keep_alive, proto)
+            return
+        ping = self._unacked_pids.get(PING_PID)
+        if ping is not None and not ping[0].is_set():
+            # the ping we sent didn't get a response
+            asyncio.create_task(self._reconnect(proto, 'keepalive'))
+            return
+        # it's time for another ping...
+        self._unacked_pids[PING_PID] = [ asyncio.Event(), None ]
+        asyncio.create_task(self._ping(proto))
+        self._timers.schedule(rt_ms, self._keep_alive, proto)
 
     # _reconnect schedules a reconnection if not underway.
     # the proto passed in must be the one that caused the error in order to avoid closing a newly
@@ -659,62 +1223,77 @@ class MQTTClient():
             log.debug("dead socket: %s failed (%s)", why, detail)
             await self._proto.disconnect() # should this be in a create_task() ?
             self._proto = None
+            self._connected.clear()
+            self._conn_lost.set()
+            self._unacked_pids.pop(PING_PID, None)
+            if why != "reconnect failed":
+                self.reconnect_stats.outages += 1
+                self._t_lost = ticks_ms()
             loop = asyncio.get_event_loop()
             if self._c.wifi_coro is not None:
                 loop.create_task(self._c.wifi_coro(False))  # Notify application
 
     # _keep_connected runs until disconnect() and ensures that there's always a connection.
-    # It's strategy is to wait for the current connection to die and then to first reconnect at the
-    # MQTT/TCP level. If that fails then it disconnects and reconnects wifi.
+    # Its strategy is to wait for the current connection to die and then to escalate through the
+    # reconnect tiers: first reconnect at the MQTT/TCP level, then re-resolve DNS and reconnect, then
+    # take the network link down and back up and reconnect. Each tier gets config.tier_attempts tries
+    # before moving on to the next, after the last tier it starts over with the first. Failed attempts
+    # are separated by jittered exponential backoff delays.
     # TODO:
-    # - collect stats about which measures lead to success
     # - check whether first connection after wifi reconnect has to be delayed
-    # - as an additional step, try to re-resolve dns
     async def _keep_connected(self):
+        stats = self.reconnect_stats
+        failures = 0
         while self._state == 1:
             if self._proto is not None:
-                # We're connected, pause for 1 second
-                await asyncio.sleep(_CONN_DELAY)
+                # We're connected, sleep until the connection is dropped
+                await self._conn_lost.wait()
+                self._conn_lost.clear()
                 continue
             # we have a problem, need some form of reconnection
-            if self._c.interface.isconnected():
-                # wifi thinks it's connected, be optimistic and reconnect to broker
-                try:
-                    await self.connect()
-                    log.debug('reconnect OK!')
-                    continue
-                except OSError as e:
-                    log.warning('error in MQTT reconnect.', e)
-                    # Can get ECONNABORTED or -1. The latter signifies no or bad CONNACK received.
-                # connecting to broker didn't work, disconnect Wifi
-                if self._proto is not None: # defensive coding -- not sure this can be triggered
-                    await self._reconnect(self._proto, "reconnect failed")
-                self._c.interface.disconnect()
-                await asyncio.sleep(_CONN_DELAY)
-                continue # not falling through to force recheck of while condition
-            # reconnect to Wifi
+            tier = (failures // self._c.tier_attempts) % 3
+            stats.attempts[tier] += 1
             try:
-                await self.wifi_connect()
+                if tier == TIER_DNS:
+                    await self._dns_lookup(True)
+                elif tier == TIER_LINK:
+                    self._c.interface.disconnect()
+                if not self._c.interface.isconnected():
+                    await self.wifi_connect()
+                await self.connect()
+                stats.record(tier, ticks_diff(ticks_ms(), self._t_lost))
+                failures = 0
+                self._backoff.reset()
+                log.debug('reconnect OK via %s!', TIER_NAMES[tier])
+                continue
             except OSError as e:
-                log.warning('error in Wifi reconnect.', e)
-                await asyncio.sleep(_CONN_DELAY)
+                # Can get ECONNABORTED or -1. The latter signifies no or bad CONNACK received.
+                log.warning('error in %s reconnect: %s', TIER_NAMES[tier], e)
+            if self._proto is not None: # defensive coding -- not sure this can be triggered
+                await self._reconnect(self._proto, "reconnect failed")
+            failures += 1
+            await self._timers.sleep_ms(self._backoff.next_ms())
         #log.debug('Disconnected, exited _keep_connected')
         self._conn_keeper = None
 
-    async def subscribe(self, topic, qos=0):
+    # subscribe subscribes to a topic filter. If cb is given, messages matching the filter are passed
+    # to it instead of config.subs_cb. It has the same signature as config.subs_cb.
+    async def subscribe(self, topic, qos=0, cb=None):
         qos_check(qos)
+        if cb is not None:
+            self._subs.add(topic, cb) # before subscribing, so retained messages find it
         pid = self._newpid()
         self._unacked_pids[pid] = [ asyncio.Event(), None ]
         while True:
             while self._proto is None:
-                await asyncio.sleep(_CONN_DELAY)
+                await self._connected.wait()
             try:
                 proto = self._proto
                 await self._proto.subscribe(topic, qos, pid)
                 actual_qos = await self._await_pid(pid)
                 if actual_qos == qos:
                     return
-                elif actual_qos == 0x80:
+                elif actual_qos is None or actual_qos >= 0x80:
                     raise OSError(-2, "refused")
                 else:
                     raise OSError(-2, "qos mismatch")
@@ -723,20 +1302,72 @@ class MQTTClient():
                     raise OSError(-1, "subscribe failed: " + e.args[1])
             await self._reconnect(proto, 'sub')
 
+    # _prune_inflight drops acked messages from the in-flight window. A timed-out one has its event
+    # set too until _await_pid clears it, so it is kept.
+    def _prune_inflight(self):
+        i = 0
+        while i < len(self._inflight):
+            pid = self._inflight[i].pid
+            ent = self._unacked_pids.get(pid)
+            if ent is None or (ent[0].is_set() and ent[1] != _TIMED_OUT):
+                self._unacked_pids.pop(pid, None)
+                self._inflight.pop(i)
+            else:
+                i += 1
+
+    # _resend_inflight retransmits all in-flight messages with DUP set if they were last sent on a
+    # different connection. It raises an OSError on failure.
+    async def _resend_inflight(self, proto):
+        if self._inflight_proto == proto:
+            return
+        self._prune_inflight()
+        self._inflight_proto = proto
+        for m in self._inflight:
+            log.warning("repub->%s qos=%d pid=%d", m.topic, m.qos, m.pid)
+            try:
+                await proto.publish(m, dup=1)
+            except ValueError as e:
+                # the new connection's broker takes smaller packets: give up on this one
+                log.warning("dropping pid=%d: %s", m.pid, e)
+                self._got_puback(m.pid)
+
+    # _wait_window waits until fewer than max_inflight async publishes are outstanding, or fewer
+    # than the receive maximum announced by an MQTT 5 broker if that is lower.
+    # It raises an OSError if the oldest one is not acked in time.
+    async def _wait_window(self, proto):
+        self._prune_inflight()
+        window = min(self._c.max_inflight, proto.receive_max)
+        while len(self._inflight) >= window:
+            await self._await_pid(self._inflight[0].pid)
+            self._prune_inflight()
+
     # publish with support for async, meaning that the packet is published but an ack (if qos 1) is
-    # not awaited. Instead the ack is awaited after the next packet is published.
+    # not awaited. Instead, up to config.max_inflight async packets may be outstanding, and a
+    # publish that would exceed that window first waits for the oldest one to be acked.
     # Algorithm:
-    # 1. If prev packet was async:
-    #   a. if got ACK go to step 2
-    #   b. if still on same socket, go to step 2
-    #   c. (no ACK and new socket) retransmit prev packet
-    # 2. Transmit new packet
-    # 3. If prev packet was async:
-    #   a. wait for ACK with timeout, if got ACK go to step 4
-    #   b. reconnect, retransmit prev packet, go to step 2
-    # 3. If new packet is QoS=0 or async, return success
-    # 4. (new packet is QoS=1 and sync) wait for ACK
+    # 1. If the in-flight packets were sent on a previous connection, retransmit all of them
+    # 2. Wait for the window to have room, reconnecting and going to step 1 on timeout
+    # 3. Transmit new packet
+    # 4. If new packet is QoS=0 return success, if async add it to the window and return success
+    # 5. (new packet is QoS=1 and sync) wait for ACK, reconnecting and going to step 1 on timeout
+    # If a spool is configured, messages published while there is no connection, or while older
+    # spooled messages are still waiting to be sent, are appended to the spool and publish returns
+    # straight away. The drain coro then publishes them once the connection is back.
+    # A sync publish the broker refuses with an MQTT 5 reason code raises an OSError, and one
+    # longer than the broker's maximum packet size raises a ValueError.
     async def publish(self, topic, msg, retain=False, qos=0, sync=True):
+        spool = self._c.spool
+        if spool is not None and (self._proto is None or not spool.empty()):
+            qos_check(qos)
+            if isinstance(topic, str): topic = topic.encode()
+            if isinstance(msg, str): msg = msg.encode()
+            spool.append(topic, msg, retain, qos)
+            self._spool_ev.set()
+            return
+        await self._publish(topic, msg, retain, qos, sync)
+
+    # _publish returns the pid the message was sent with, None for QoS 0
+    async def _publish(self, topic, msg, retain, qos, sync):
         dup = 0
         pid = self._newpid() if qos else None
         message = MQTTMessage(topic, msg, retain, qos, pid)
@@ -746,44 +1377,34 @@ class MQTTClient():
             log.debug("pub begin for pid=%s", pid)
             # first we need a connection
             while self._proto is None:
-                await asyncio.sleep(_CONN_DELAY)
-            # if there is an async packet outstanding and it has not been acked, and a new connection
-            # has been established then begin by retransmitting that packet.
+                await self._connected.wait()
             proto = self._proto
-            if self._prev_pub is not None and pid in self._unacked_pids and self._prev_pub_proto != proto:
-                m = self._prev_pub
-                log.warning("repub->%s qos=%d pid=%d", m.topic, m.qos, m.pid)
-                self._prev_pub_proto = proto
-                try:
-                    await proto.publish(m, dup=1)
-                except OSError as e:
-                    await self._reconnect(proto, 'pub')
-                    continue
-            # now publish the new packet on the same connection
-            log.debug("pub->%s qos=%d pid=%d", message.topic, message.qos, message.pid)
             try:
+                # if a new connection has been established then begin by retransmitting the
+                # outstanding async packets, then apply backpressure if the window is full
+                await self._resend_inflight(proto)
+                await self._wait_window(proto)
+                # now publish the new packet on the same connection
+                log.debug("pub->%s qos=%d pid=%s", message.topic, message.qos, message.pid)
                 await proto.publish(message, dup)
             except OSError as e:
                 await self._reconnect(proto, 'pub')
                 continue
-            # if there is an async packet outstanding wait for an ack
-            if self._prev_pub is not None:
-                try:
-                    await self._await_pid(self._prev_pub.pid)
-                except OSError as e:
-                    await self._reconnect(proto, 'pub')
-                    continue
-                self._prev_pub = None
-                self._prev_pub_proto = None
-            # new packet one becomes prev if qos>0 and async, or gotta wait for new one's ack if sync
+            except ValueError:
+                self._unacked_pids.pop(pid, None) # too long, it will never be sent
+                raise
+            # new packet joins the window if qos>0 and async, or gotta wait for its ack if sync
             if qos == 0:
-                return
+                return None
             if not sync:
-                self._prev_pub = message
-                self._prev_pub_proto = proto
-                return
+                self._inflight.append(message)
+                return pid
             try:
-                await self._await_pid(message.pid)
-                return
+                reason = await self._await_pid(message.pid)
             except OSError as e:
+                dup = 1 # it may have got through, so the retransmission is a duplicate
                 await self._reconnect(proto, 'pub')
+                continue
+            if reason is not None:
+                raise OSError(-1, "publish failed: refused", reason)
+            return pid
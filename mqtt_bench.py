@@ -0,0 +1,384 @@
+# mqtt_bench.py host-side throughput benchmark for mqtt_async.
+#
+# Runs MQTTClient under CPython (through cpy_fix) against BrokerSim, an in-process stand-in for an
+# MQTT broker whose link to the client has configurable latency, loss and bandwidth. For QoS 0 and 1
+# publishes in sync and async mode it reports publishes/sec, the 50th and 99th percentile of the
+# time from sending a QoS 1 publish to receiving its PUBACK, and memory use as traced by tracemalloc
+# (peak growth during the run and what was still allocated afterwards). The memory figures include
+# the simulator, which runs in the same process, so they are mostly useful for comparing runs.
+# QoS 0 publishes are done as soon as they're written to the socket, so their rate doesn't depend
+# on the link.
+# Before that it times the subscription dispatch on its own: routing topics through a TopicTrie of
+# FILTERS topic filters, some with '+' and '#' wildcards, against matching each topic against each
+# filter in turn, as a subs_cb would have, and checks that both find the same filters; if they
+# don't it exits with status 1. And it measures the memory allocated per ALLOC PUBLISH and PUBACK
+# packets built with PacketBuilder and, for comparison, with a new bytearray per packet as
+# MQTTProto used to: by the change in gc.mem_alloc() with the GC disabled where the gc module has
+# it, as on MicroPython, otherwise by tracemalloc, keeping each packet so that it stays counted.
+# PacketBuilder hands out cached views of its buffer, so once the packet length has been seen it
+# should allocate nothing.
+#
+# Usage: python3 mqtt_bench.py [-n COUNT] [-s SIZE] [--latency MS] [--loss FRACTION]
+#                              [--bandwidth BYTES_PER_SEC] [--inflight N] [--v5] [--filters FILTERS]
+#                              [--alloc ALLOC]
+#
+# BrokerSim only implements what the client needs to run: CONNECT, PUBLISH, SUBSCRIBE, PINGREQ and
+# DISCONNECT are answered, published messages are not forwarded to subscribers. As the connection is
+# TCP, packet loss doesn't lose MQTT packets but delays them: a lost packet is sent again after a
+# retransmission time-out, holding up the packets behind it. For tests it can also log the PUBLISHes
+# it receives and drop the connection after a given number of them (see mqtt_spool_bench.py).
+
+import sys, gc, time, random, struct, argparse, tracemalloc
+from cpy_fix import asyncio
+import mqtt_async
+
+# _Link models one direction of the connection: each packet occupies the link for len/bandwidth
+# seconds, after the packets queued before it, and then takes latency seconds to arrive. With
+# probability loss the packet is lost and occupies the link for another retransmission time-out.
+class _Link:
+
+    def __init__(self, sim):
+        self._sim = sim
+        self._latency = sim.latency_ms / 1000
+        self._rto = max(0.2, 4 * self._latency) # roughly what TCP would use
+        self._free = 0.0 # loop time at which the link is next idle
+
+    # arrival returns the loop time at which a packet of n bytes sent now arrives
+    def arrival(self, n):
+        sim = self._sim
+        now = asyncio.get_event_loop().time()
+        start = max(now, self._free)
+        t = n / sim.bandwidth if sim.bandwidth else 0
+        while sim._rand.random() < sim.loss:
+            sim.retransmits += 1
+            start += t + self._rto
+        self._free = start + t
+        return self._free + self._latency
+
+# BrokerSim is a minimal MQTT 3.1.1/5 broker listening on localhost.
+class BrokerSim:
+
+    def __init__(self, latency_ms=0, loss=0.0, bandwidth=0, seed=1):
+        self.latency_ms = latency_ms
+        self.loss = loss
+        self.bandwidth = bandwidth  # in bytes/sec, 0 for unlimited
+        self._rand = random.Random(seed)
+        self._server = None
+        self.port = None
+        self.packets = 0     # packets sent in either direction
+        self.retransmits = 0 # packets lost and sent again
+        self.log = None      # list to append (topic, message, dup) of each PUBLISH received to
+        self.drop_after = 0  # PUBLISHes after which to drop the connection (once), 0 for never
+
+    # start listens for connections, with TLS if ssl is an ssl.SSLContext
+    async def start(self, host="127.0.0.1", port=0, ssl=None):
+        self._server = await asyncio.start_server(self._handle, host, port, ssl=ssl)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        rx = _Link(self)
+        tx = _Link(self)
+        state = { "v5": False, "open": True, "writer": writer, "tx": tx }
+
+        def send(data):
+            self.packets += 1
+            def write():
+                if not writer.is_closing():
+                    writer.write(data)
+            loop.call_at(tx.arrival(len(data)), write)
+
+        try:
+            while state["open"]:
+                hdr = await reader.readexactly(1)
+                n = 0
+                sh = 0
+                while True:
+                    b = (await reader.readexactly(1))[0]
+                    n |= (b & 0x7f) << sh
+                    sh += 7
+                    if not b & 0x80:
+                        break
+                body = await reader.readexactly(n) if n else b""
+                self.packets += 1
+                loop.call_at(rx.arrival(n + 2), self._process, hdr[0], body, state, send)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        state["open"] = False
+        writer.close()
+
+    # _drop closes a connection as if the link went down once the packets already sent on it have
+    # arrived: packets received but not yet processed are lost.
+    def _drop(self, state):
+        state["open"] = False
+        loop = asyncio.get_event_loop()
+        loop.call_at(state["tx"].arrival(0) + 0.001, state["writer"].close)
+
+    def _process(self, op, body, state, send):
+        if not state["open"]:
+            return
+        typ = op & 0xf0
+        if typ == 0x10: # CONNECT
+            state["v5"] = body[6] == 5
+            send(b"\x20\x03\0\0\0" if state["v5"] else b"\x20\x02\0\0")
+        elif typ == 0x30: # PUBLISH
+            tlen = body[0] << 8 | body[1]
+            i = 2 + tlen
+            if op & 0x06:
+                send(b"\x40\x02" + body[i:i+2])
+                i += 2
+            if self.log is not None:
+                if state["v5"]:
+                    i += 1 + body[i] # properties, assumed to be shorter than 128 bytes
+                self.log.append((bytes(body[2:2+tlen]), bytes(body[i:]), op >> 3 & 1))
+            if self.drop_after:
+                self.drop_after -= 1
+                if not self.drop_after:
+                    self._drop(state)
+        elif typ == 0x80: # SUBSCRIBE
+            pid = body[0:2]
+            i = 2
+            if state["v5"]:
+                i += 1 + body[2] # properties, assumed to be shorter than 128 bytes
+            granted = bytearray()
+            while i < len(body):
+                tlen = body[i] << 8 | body[i+1]
+                granted.append(body[i+2+tlen] & 3)
+                i += 3 + tlen
+            send(bytes((0x90, 2 + state["v5"] + len(granted))) + pid +
+                    (b"\0" if state["v5"] else b"") + granted)
+        elif typ == 0xc0: # PINGREQ
+            send(b"\xd0\0")
+        elif typ == 0xe0: # DISCONNECT
+            state["open"] = False
+
+# _TimedProto records the time from sending each QoS 1 publish to receiving its PUBACK.
+class _TimedProto(mqtt_async.MQTTProto):
+    sent = {}
+    latencies = []
+
+    def __init__(self, subs_cb, puback_cb, *args, **kw):
+        def acked(pid, reason=0):
+            t = _TimedProto.sent.pop(pid, None)
+            if t is not None:
+                _TimedProto.latencies.append(time.perf_counter() - t)
+            puback_cb(pid, reason)
+        super().__init__(subs_cb, acked, *args, **kw)
+
+    async def publish(self, msg, dup=0):
+        if msg.qos and not dup:
+            _TimedProto.sent[msg.pid] = time.perf_counter()
+        await super().publish(msg, dup)
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+async def bench(sim, qos, sync, count, size, inflight, version):
+    c = mqtt_async.MQTTConfig()
+    c.server = "127.0.0.1"
+    c.port = sim.port
+    c.response_time = 2
+    c.max_inflight = inflight
+    c.protocol_version = version
+    cl = mqtt_async.MQTTClient(c)
+    cl._MQTTProto = _TimedProto
+    _TimedProto.sent.clear()
+    _TimedProto.latencies.clear()
+    await cl.connect()
+    msg = bytes(size)
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    t0 = time.perf_counter()
+    for _ in range(count):
+        await cl.publish("bench/topic", msg, qos=qos, sync=sync)
+    if qos:
+        # async publishes are done once they have all been acked
+        while len(_TimedProto.latencies) < count:
+            await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - t0
+    cur, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await cl.disconnect()
+    lat = _TimedProto.latencies
+    return { "rate": count / elapsed, "p50": _percentile(lat, 50), "p99": _percentile(lat, 99),
+        "peak": peak - base, "held": cur - base }
+
+# _linear_match returns the indexes of the filters in filters, each a list of levels, that match
+# topic, as a subs_cb comparing topics against its filters one by one would.
+def _linear_match(filters, topic):
+    levels = topic.split(b"/")
+    out = []
+    for n, f in enumerate(filters):
+        for i, level in enumerate(f):
+            if level == b"#":
+                if i or levels[0][:1] != b"$":
+                    out.append(n)
+                break
+            if i == len(levels) or level != levels[i] and (level != b"+" or
+                    not i and levels[0][:1] == b"$"):
+                break
+        else:
+            if len(f) == len(levels):
+                out.append(n)
+    return out
+
+def dispatch_bench(nfilters, ntopics, seed=1):
+    rand = random.Random(seed)
+    words = [b"w%d" % i for i in range(8)]
+    def level():
+        return rand.choice(words)
+    def root():
+        return rand.choice((b"site0", b"site1", b"site2", b"site3", b"$SYS"))
+    # filters three or four levels deep under a few roots, with one in ten levels a '+' and one in
+    # twenty filters ending in '#', plus '#' on its own, which must not match the '$SYS' topics
+    filters = {b"#"}
+    while len(filters) < nfilters:
+        f = [b"+" if rand.random() < 0.01 else root()] + [b"+" if rand.random() < 0.1 else level()
+            for _ in range(rand.randint(2, 3))]
+        if rand.random() < 0.05:
+            f[rand.randint(1, len(f) - 1):] = [b"#"]
+        filters.add(b"/".join(f))
+    filters = sorted(filters)
+    trie = mqtt_async.TopicTrie()
+    for n, f in enumerate(filters):
+        trie.add(f, n)
+    split = [f.split(b"/") for f in filters]
+    topics = [b"/".join([root()] + [level() for _ in range(rand.randint(2, 4))])
+        for _ in range(ntopics)]
+    t0 = time.perf_counter()
+    trie_out = [trie.match(t) for t in topics]
+    trie_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    linear_out = [_linear_match(split, t) for t in topics]
+    linear_s = time.perf_counter() - t0
+    same = all(sorted(a) == b for a, b in zip(trie_out, linear_out))
+    return { "rate_trie": ntopics / trie_s, "rate_linear": ntopics / linear_s, "same": same,
+        "matches": sum(len(m) for m in linear_out) / ntopics }
+
+# _legacy_publish and _legacy_puback build packets the way MQTTProto did before PacketBuilder
+def _legacy_publish(msg, dup=0):
+    mlen = len(msg.message)
+    sz = 2 + len(msg.topic) + mlen
+    if msg.qos > 0:
+        sz += 2 # account for pid
+    hdrlen = 4+2+len(msg.topic)+2
+    single = hdrlen + mlen <= 1440
+    pkt = bytearray(hdrlen+mlen) if single else bytearray(hdrlen)
+    pkt[0] = 0x30 | msg.qos << 1 | msg.retain | dup << 3
+    l = 1
+    while sz > 0x7f:
+        pkt[l] = (sz & 0x7f) | 0x80
+        sz >>= 7
+        l += 1
+    pkt[l] = sz
+    l += 1
+    struct.pack_into("!H", pkt, l, len(msg.topic))
+    l += 2
+    pkt[l:l+len(msg.topic)] = msg.topic
+    l += len(msg.topic)
+    if msg.qos > 0:
+        struct.pack_into("!H", pkt, l, msg.pid)
+        l += 2
+    if single:
+        pkt[l:] = msg.message
+        return pkt
+    return pkt[:l]
+
+def _legacy_puback(pid):
+    pkt = bytearray(b"\x40\x02\0\0")
+    struct.pack_into("!H", pkt, 2, pid)
+    return pkt
+
+# _allocated returns the bytes allocated by fn(i) for i in range(count)
+def _allocated(fn, count):
+    keep = [None] * count
+    if hasattr(gc, "mem_alloc"):
+        gc.collect()
+        gc.disable()
+        base = gc.mem_alloc()
+        for i in range(count):
+            keep[i] = fn(i)
+        n = gc.mem_alloc() - base
+        gc.enable()
+        return n
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for i in range(count):
+        keep[i] = fn(i)
+    n = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return n
+
+def alloc_bench(count, size):
+    msg = mqtt_async.MQTTMessage("bench/topic", bytes(size), qos=1, pid=1)
+    pkts = mqtt_async.PacketBuilder()
+    pkts.publish(msg) # caches the topic
+    def publish(i):
+        msg.pid = i + 1
+        return pkts.packet(abs(pkts.publish(msg)))
+    def legacy_publish(i):
+        msg.pid = i + 1
+        return _legacy_publish(msg)
+    if bytes(publish(0)) != legacy_publish(0):
+        raise AssertionError("PUBLISH packets differ")
+    return { "publish": _allocated(publish, count), "puback": _allocated(pkts.puback, count),
+        "legacy_publish": _allocated(legacy_publish, count),
+        "legacy_puback": _allocated(_legacy_puback, count) }
+
+def _ms(v):
+    return "-" if v is None else "%.2f" % (v * 1000)
+
+async def main(args):
+    failed = False
+    if args.filters:
+        r = dispatch_bench(args.filters, 20000)
+        print("dispatch to %d filters, %.1f matches per topic: trie %.0f/s, linear %.0f/s%s" % (
+            args.filters, r["matches"], r["rate_trie"], r["rate_linear"], "" if r["same"] else
+            ", RESULTS DIFFER"))
+        failed = not r["same"]
+    if args.alloc:
+        r = alloc_bench(args.alloc, args.size)
+        print("bytes allocated per %d %dB PUBLISH and PUBACK (%s): PacketBuilder %d and %d, "
+            "bytearray per packet %d and %d" % (args.alloc, args.size, "gc.mem_alloc" if
+            hasattr(gc, "mem_alloc") else "tracemalloc", r["publish"], r["puback"],
+            r["legacy_publish"], r["legacy_puback"]))
+    sim = BrokerSim(args.latency, args.loss, args.bandwidth)
+    await sim.start()
+    print("%d x %dB publishes, latency=%dms loss=%.1f%% bandwidth=%s inflight=%d MQTT %s" % (
+        args.count, args.size, args.latency, args.loss * 100, args.bandwidth or "unlimited",
+        args.inflight, "5" if args.v5 else "3.1.1"))
+    print("%-10s %10s %9s %9s %9s %9s" % ("mode", "pubs/s", "p50 ms", "p99 ms", "peak KB",
+        "held KB"))
+    for qos in (0, 1):
+        for sync in (True, False):
+            r = await bench(sim, qos, sync, args.count, args.size, args.inflight,
+                5 if args.v5 else 4)
+            print("%-10s %10.0f %9s %9s %9.1f %9.1f" % ("qos%d %s" % (qos, "sync" if sync else
+                "async"), r["rate"], _ms(r["p50"]), _ms(r["p99"]), r["peak"] / 1024,
+                r["held"] / 1024))
+    if sim.retransmits:
+        print("%d of %d packets retransmitted" % (sim.retransmits, sim.packets))
+    await sim.stop()
+    return failed
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="mqtt_async throughput benchmark")
+    p.add_argument("-n", "--count", type=int, default=1000, help="publishes per run")
+    p.add_argument("-s", "--size", type=int, default=64, help="message size in bytes")
+    p.add_argument("--latency", type=int, default=0, help="one-way link latency in ms")
+    p.add_argument("--loss", type=float, default=0.0, help="fraction of packets lost")
+    p.add_argument("--bandwidth", type=int, default=0, help="link bandwidth in bytes/sec")
+    p.add_argument("--inflight", type=int, default=8, help="config.max_inflight")
+    p.add_argument("--v5", action="store_true", help="use MQTT 5")
+    p.add_argument("--filters", type=int, default=300,
+        help="topic filters for the dispatch benchmark, 0 to skip it")
+    p.add_argument("--alloc", type=int, default=1000,
+        help="packets for the allocation benchmark, 0 to skip it")
+    sys.exit(1 if asyncio.run(main(p.parse_args())) else 0)
@@ -0,0 +1,198 @@
+# mqtt_spool.py flash-backed outbound message spool for mqtt_async.
+#
+# MQTTClient.publish() appends messages to the spool instead of waiting while the connection is
+# down, and a drain task publishes them when it comes back. Because the spool lives in the flash
+# file system, messages that were not yet sent survive a watchdog reset.
+#
+# Messages are appended to segment files <path>/<n>.seg, each holding up to segment_size bytes of
+# records. A record is a 5-byte header (flags, topic length, message length) followed by the topic
+# and the message. The drain task takes records from a send position with peek() and pop(), and
+# calls ack() for each, in the same order, once the broker has acknowledged it (QoS 1) or it has
+# been sent (QoS 0). The read position (segment number and offset) is the oldest record not yet
+# acked; it is kept in <path>/index and is saved every sync_every acks, so after a reset the
+# records that were sent but not acked are sent again, as are at most sync_every that were, which
+# is fine for QoS 1's at-least-once semantics.
+# At most max_segments segments are kept: when a new one is needed the oldest is deleted, dropping
+# any messages in it that had not been sent yet.
+# On open, empty segments are deleted and appending continues in the last segment, unless a reset
+# cut its last record short: then a fresh segment is started so nothing follows the broken record.
+
+import os, struct
+
+_HDR = "!BHH"   # flags (qos << 1 | retain), topic length, message length
+_HDR_LEN = 5
+
+class Spool:
+
+    def __init__(self, path="spool", segment_size=8192, max_segments=8, sync_every=16):
+        if max_segments < 2:
+            raise ValueError("max_segments <2")
+        self._path = path
+        self._segment_size = segment_size
+        self._max_segments = max_segments
+        self._sync_every = sync_every
+        self.evicted = 0 # number of segments deleted before they were fully sent
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass # already exists
+        segs = sorted(int(n[:-4]) for n in os.listdir(path) if n.endswith(".seg"))
+        # restore the read position, dropping segments that were already sent and empty ones
+        self._rseg, self._roff = self._load_index(segs)
+        for n in segs[:]:
+            if n < self._rseg or not self._seg_size(n):
+                os.remove(self._seg_name(n))
+                segs.remove(n)
+        if not segs or segs[0] != self._rseg:
+            self._rseg = segs[0] if segs else 0
+            self._roff = 0
+        self._segs = segs
+        self._sseg = self._rseg # send position: the next record for peek()
+        self._soff = self._roff
+        self._sent = []     # (segment, end offset) of the records popped but not acked
+        self._rf = None     # file being read, if open
+        self._peeked = 0    # length of the record returned by peek()
+        self._unsynced = 0  # records acked since the index was saved
+        # append to a fresh segment if the last one ends in a record cut short by a reset, so it is
+        # never followed by new ones; peek() skips over it when it moves on to the next segment
+        self._wf = None
+        end = self._seg_end(segs[-1]) if segs else None
+        if end is None:
+            self._new_segment()
+        else:
+            self._wf = open(self._seg_name(segs[-1]), "ab")
+            self._wsize = end
+        self._save_index()
+
+    def _seg_name(self, n):
+        return "%s/%d.seg" % (self._path, n)
+
+    def _seg_size(self, n):
+        try:
+            return os.stat(self._seg_name(n))[6]
+        except OSError:
+            return 0
+
+    # _seg_end returns the size of segment n, or None if its last record is incomplete
+    def _seg_end(self, n):
+        size = self._seg_size(n)
+        off = 0
+        with open(self._seg_name(n), "rb") as f:
+            while off < size:
+                f.seek(off)
+                hdr = f.read(_HDR_LEN)
+                if len(hdr) < _HDR_LEN:
+                    return None
+                _, tlen, mlen = struct.unpack(_HDR, hdr)
+                off += _HDR_LEN + tlen + mlen
+        return off if off == size else None
+
+    def _load_index(self, segs):
+        try:
+            with open(self._path + "/index", "rb") as f:
+                return struct.unpack("!II", f.read(8))
+        except (OSError, ValueError):
+            return (segs[0] if segs else 0), 0
+
+    def _save_index(self):
+        tmp = self._path + "/index.tmp"
+        with open(tmp, "wb") as f:
+            f.write(struct.pack("!II", self._rseg, self._roff))
+        os.rename(tmp, self._path + "/index")
+        self._unsynced = 0
+
+    def _new_segment(self):
+        if self._wf is not None:
+            self._wf.close()
+        n = self._segs[-1] + 1 if self._segs else self._rseg
+        self._segs.append(n)
+        self._wf = open(self._seg_name(n), "ab")
+        self._wsize = 0
+        # evict the oldest segments to bound disk usage
+        while len(self._segs) > self._max_segments:
+            old = self._segs.pop(0)
+            if old == self._rseg:
+                if self._seg_size(old) > self._roff:
+                    self.evicted += 1
+                self._rseg = self._segs[0]
+                self._roff = 0
+                self._save_index()
+            if old == self._sseg:
+                self._close_reader()
+                self._sseg = self._segs[0]
+                self._soff = 0
+            os.remove(self._seg_name(old))
+
+    def _close_reader(self):
+        if self._rf is not None:
+            self._rf.close()
+            self._rf = None
+
+    # empty returns True if there is nothing left to send
+    def empty(self):
+        return self._sseg == self._segs[-1] and self._soff >= self._wsize
+
+    # append adds a message to the end of the spool
+    def append(self, topic, msg, retain=False, qos=0):
+        if len(topic) > 65535 or len(msg) > 65535:
+            raise ValueError("message too long")
+        rec_len = _HDR_LEN + len(topic) + len(msg)
+        if self._wsize and self._wsize + rec_len > self._segment_size:
+            self._new_segment()
+        self._wf.write(struct.pack(_HDR, qos << 1 | retain, len(topic), len(msg)))
+        self._wf.write(topic)
+        self._wf.write(msg)
+        self._wf.flush()
+        self._wsize += rec_len
+
+    # peek returns the next message to send as a (topic, msg, retain, qos) tuple without removing
+    # it, or None if there is none.
+    def peek(self):
+        while True:
+            if self._rf is None:
+                self._rf = open(self._seg_name(self._sseg), "rb")
+            self._rf.seek(self._soff)
+            hdr = self._rf.read(_HDR_LEN)
+            if len(hdr) == _HDR_LEN:
+                flags, tlen, mlen = struct.unpack(_HDR, hdr)
+                topic = self._rf.read(tlen)
+                msg = self._rf.read(mlen)
+                if len(topic) == tlen and len(msg) == mlen:
+                    self._peeked = _HDR_LEN + tlen + mlen
+                    return topic, msg, bool(flags & 1), flags >> 1
+            if self._sseg == self._segs[-1]:
+                # caught up with the writer, reopen next time to see what it has appended since
+                self._close_reader()
+                return None
+            # done with this segment (possibly ending in a record cut short by a reset), ack()
+            # deletes it once its records have been acked
+            self._close_reader()
+            self._sseg = self._segs[self._segs.index(self._sseg) + 1]
+            self._soff = 0
+
+    # pop moves past the message returned by the last call to peek, it is kept until acked
+    def pop(self):
+        self._soff += self._peeked
+        self._peeked = 0
+        self._sent.append((self._sseg, self._soff))
+
+    # ack forgets the oldest message popped and not yet acked
+    def ack(self):
+        seg, off = self._sent.pop(0)
+        if seg < self._rseg:
+            return # its segment was evicted meanwhile
+        self._unsynced += 1
+        while self._rseg != seg:
+            # done with this segment
+            os.remove(self._seg_name(self._segs.pop(0)))
+            self._rseg = self._segs[0]
+            self._unsynced = self._sync_every
+        self._roff = off
+        if self._unsynced >= self._sync_every:
+            self._save_index()
+
+    # sync saves the read position, to be called before a controlled shutdown
+    def sync(self):
+        if self._unsynced:
+            self._save_index()
+        self._wf.flush()
@@ -0,0 +1,135 @@
+# mqtt_spool_bench.py host-side test of mqtt_spool with mqtt_async.
+#
+# Publishes COUNT numbered QoS 1 messages through an MQTTClient with a Spool to BrokerSim (from
+# mqtt_bench), which drops the connection a third of the way through the stream. Then the broker
+# goes away altogether while the last third of the messages is spooled, and the Pico is "reset":
+# the client is abandoned and a new Spool is opened on the same directory, without a sync(), as
+# after a watchdog reset, for a new client talking to a new broker. It checks that the broker got
+# every message exactly once; the spool saves its index on every ack (sync_every=1), so no message
+# the broker acked is sent again after the reset.
+# Then it appends far more messages than max_segments segments hold to a spool that isn't being
+# drained, and checks that evicted counts the segments deleted, that reopening the spool a few
+# times neither adds segments nor evicts any, and that what is left are the newest messages.
+# Exits with status 1 if any check fails.
+#
+# Usage: python3 mqtt_spool_bench.py [-n COUNT] [--dir DIR]
+
+import sys, os, shutil, tempfile, argparse
+from cpy_fix import asyncio
+import mqtt_async
+from mqtt_bench import BrokerSim
+from mqtt_spool import Spool
+
+_TOPIC = b"spool/test"
+
+def _client(port, spool):
+    c = mqtt_async.MQTTConfig()
+    c.server = "127.0.0.1"
+    c.port = port
+    c.response_time = 2
+    c.max_inflight = 4
+    c.spool = spool
+    c.backoff_initial = 0.05
+    c.backoff_max = 0.2
+    return mqtt_async.MQTTClient(c)
+
+async def _until(cond, secs=10):
+    for _ in range(int(secs * 100)):
+        if cond():
+            return True
+        await asyncio.sleep(0.01)
+    return False
+
+# _drained returns a condition that is true once everything published has been acked
+def _drained(cl, spool):
+    def done():
+        cl._prune_inflight()
+        return cl._proto is not None and spool.empty() and not cl._spooled and not cl._inflight
+    return done
+
+async def link_loss(count, path):
+    log = []
+    spool = Spool(path, segment_size=512, sync_every=1)
+    sim = BrokerSim()
+    sim.log = log
+    sim.drop_after = count // 3
+    await sim.start()
+    cl = _client(sim.port, spool)
+    await cl.connect()
+    n = 2 * count // 3
+    for i in range(n):
+        await cl.publish(_TOPIC, b"m%05d" % i, qos=1, sync=False)
+    ok = await _until(_drained(cl, spool))
+    # the broker goes away after one more message, the rest stay in the spool
+    await sim.stop()
+    sim.drop_after = 1
+    await cl.publish(_TOPIC, b"m%05d" % n, qos=1, sync=False)
+    ok = await _until(lambda: cl._proto is None) and ok
+    for i in range(n + 1, count):
+        await cl.publish(_TOPIC, b"m%05d" % i, qos=1, sync=False)
+    outages = cl.reconnect_stats.outages
+    await cl.disconnect()
+    before = len(log)
+    # reset: a new spool on the same files, a new client and broker
+    spool = Spool(path, segment_size=512, sync_every=1)
+    sim = BrokerSim()
+    sim.log = log
+    await sim.start()
+    cl = _client(sim.port, spool)
+    await cl.connect()
+    ok = await _until(_drained(cl, spool)) and ok
+    await cl.disconnect()
+    await sim.stop()
+    got = {}
+    for topic, msg, dup in log:
+        got[msg] = got.get(msg, 0) + 1
+    lost = sum(1 for i in range(count) if b"m%05d" % i not in got)
+    dups = sum(n - 1 for n in got.values())
+    return { "ok": ok and not lost and not dups and len(got) == count, "received": len(log),
+        "lost": lost, "duplicates": dups, "outages": outages, "after_reset": len(log) - before }
+
+def evict(path):
+    segs, size = 4, 256
+    spool = Spool(path, segment_size=size, max_segments=segs, sync_every=1)
+    msgs = [b"m%05d" % i for i in range(200)]
+    for m in msgs:
+        spool.append(_TOPIC, m, False, 1)
+    created = spool._segs[-1] + 1
+    evicted = spool.evicted
+    per_seg = size // (5 + len(_TOPIC) + len(msgs[0])) # records per full segment
+    ok = evicted == created - segs
+    for _ in range(3):
+        spool = Spool(path, segment_size=size, max_segments=segs, sync_every=1)
+        ok = ok and len(spool._segs) == segs and spool.evicted == 0
+    left = []
+    while True:
+        rec = spool.peek()
+        if rec is None:
+            break
+        left.append(rec[1])
+        spool.pop()
+        spool.ack()
+    ok = ok and left == msgs[evicted * per_seg:] and spool.empty()
+    return { "ok": ok, "created": created, "evicted": evicted, "left": len(left),
+        "appended": len(msgs) }
+
+def main(args):
+    base = args.dir or tempfile.mkdtemp()
+    try:
+        r = asyncio.run(link_loss(args.count, os.path.join(base, "spool")))
+        e = evict(os.path.join(base, "evict"))
+    finally:
+        if args.dir is None:
+            shutil.rmtree(base)
+    print("%d QoS 1 messages, %d outages and a reset: %d received (%d after the reset), %d lost, "
+        "%d duplicates  %s" % (args.count, r["outages"], r["received"], r["after_reset"], r["lost"],
+        r["duplicates"], "ok" if r["ok"] else "FAILED"))
+    print("eviction: %d messages in %d segments, %d evicted, %d left  %s" % (e["appended"],
+        e["created"], e["evicted"], e["left"], "ok" if e["ok"] else "FAILED"))
+    return not (r["ok"] and e["ok"])
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="mqtt_spool link loss and reset test")
+    p.add_argument("-n", "--count", type=int, default=300, help="messages to publish")
+    p.add_argument("--dir", help="directory for the spool files, default a temporary one")
+    sys.exit(1 if main(p.parse_args()) else 0)
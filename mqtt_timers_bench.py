@@ -0,0 +1,102 @@
+# mqtt_timers_bench.py host-side fake-clock test of mqtt_async's timers.
+#
+# Runs MQTTClient against BrokerSim (from mqtt_bench) on an event loop whose clock only moves when
+# the loop would otherwise sleep: it then jumps straight to the next deadline, so an hour of idle
+# connection takes a moment, and each jump is one time the chip would have woken from lightsleep.
+# ticks_ms in mqtt_async is driven by the same clock. It reports the wakeups per hour of an idle
+# connection, against the one ping per response_time a keepalive needs, and then checks that
+# disconnect() stops the reconnect loop while it is backing off after the broker went away.
+# Exits with status 1 if there are more than twice as many wakeups as pings, or the reconnect loop
+# is left running.
+#
+# Usage: python3 mqtt_timers_bench.py [--hours H] [--response-time S]
+
+import sys, argparse, selectors
+from cpy_fix import asyncio
+import mqtt_async
+from mqtt_bench import BrokerSim
+
+_TICKS_PERIOD = 1 << 30
+
+# _FakeClockSelector makes the loop's time jump ahead by the timeout of each select() that finds
+# nothing ready; a moment of real time is allowed for data in flight on the local sockets.
+class _FakeClockSelector(selectors.DefaultSelector):
+    now = 1000.0
+    jumps = 0
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if ready or timeout == 0:
+            return ready
+        ready = super().select(0.002)
+        if ready or timeout is None:
+            return ready
+        self.now += timeout
+        self.jumps += 1
+        return []
+
+class _FakeClockLoop(asyncio.SelectorEventLoop):
+
+    def __init__(self):
+        self.clock = _FakeClockSelector()
+        super().__init__(self.clock)
+
+    def time(self):
+        return self.clock.now
+
+async def _settle(clock, secs):
+    # let secs of fake time pass
+    end = clock.now + secs
+    while clock.now < end:
+        await asyncio.sleep(end - clock.now)
+
+async def run(hours, response_time):
+    loop = asyncio.get_running_loop()
+    clock = loop.clock
+    mqtt_async.ticks_ms = lambda: int(clock.now * 1000) & (_TICKS_PERIOD - 1)
+    sim = BrokerSim()
+    await sim.start()
+    c = mqtt_async.MQTTConfig()
+    c.server = "127.0.0.1"
+    c.port = sim.port
+    c.response_time = response_time
+    cl = mqtt_async.MQTTClient(c)
+    await cl.connect()
+    await _settle(clock, 1)
+    # idle connection: only the keepalive should wake the loop
+    jumps = clock.jumps
+    timer_wakeups = cl._timers.wakeups
+    pings = sim.packets
+    await _settle(clock, hours * 3600)
+    r = { "jumps": (clock.jumps - jumps) / hours,
+        "timer_wakeups": (cl._timers.wakeups - timer_wakeups) / hours,
+        "pings": (sim.packets - pings) / 2 / hours, # PINGREQ and PINGRESP
+        "needed": 3600 / response_time }
+    # broker gone: the reconnect loop backs off between attempts until disconnect() stops it
+    await sim.stop()
+    await cl._reconnect(cl._proto, "test")
+    await _settle(clock, 30)
+    r["backing_off"] = cl._conn_keeper is not None
+    await cl.disconnect()
+    await _settle(clock, 1)
+    r["orphaned"] = cl._conn_keeper is not None
+    return r
+
+def main(args):
+    loop = _FakeClockLoop()
+    try:
+        r = loop.run_until_complete(run(args.hours, args.response_time))
+    finally:
+        loop.close()
+    print("idle connection, response_time=%ds: %.0f wakeups/h (%.0f by the timers), %.0f pings/h, "
+        "%.0f needed" % (args.response_time, r["jumps"], r["timer_wakeups"], r["pings"],
+        r["needed"]))
+    print("disconnect() while backing off: reconnect loop %s" % ("LEFT RUNNING" if r["orphaned"]
+        else "stopped" if r["backing_off"] else "NOT RUNNING BEFORE"))
+    return r["jumps"] > 2 * r["needed"] or r["orphaned"] or not r["backing_off"]
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="mqtt_async fake-clock timer test")
+    p.add_argument("--hours", type=float, default=1, help="fake hours of idle connection")
+    p.add_argument("--response-time", type=int, default=10, help="config.response_time in seconds")
+    sys.exit(1 if main(p.parse_args()) else 0)
@@ -0,0 +1,157 @@
+# mqtt_tls.py TLS with session resumption for mqtt_async.
+#
+# A full TLS handshake costs several KB and a few round trips, which adds up over LTE when the
+# connection drops regularly. TLSSession keeps one SSLContext for the lifetime of the client and
+# remembers the session of the last successful connection, offering it to the broker on the next
+# connect so that the handshake can be abbreviated. If the broker doesn't resume it simply performs
+# a full handshake. MicroPython's ssl module has no sessions (no ssl.SSLSession, and wrap_socket
+# takes no session argument): there TLSStats.resumption says "unsupported", wrap() tells the
+# caller so on the first connect, and every handshake is a full one.
+#
+# The raw socket is wrapped in a byte counter before it's handed to ssl, so the cost of each
+# connection setup can be reported in TLSStats. Under CPython the cpy_fix stream does TLS itself,
+# counting the bytes, and supports sessions (see mqtt_tls_bench.py). The handshake itself happens
+# lazily when the CONNECT packet is sent, so the figures cover everything up to the CONNACK: the
+# TLS handshake plus the (small) MQTT CONNECT/CONNACK exchange.
+
+import io, select, ssl
+try:
+    from micropython import const
+except ImportError:
+    from cpy_fix import const
+from time import ticks_ms, ticks_diff
+
+# True if the ssl module can resume sessions
+_SESSIONS = hasattr(ssl, "SSLSession")
+
+_MP_STREAM_POLL = const(3)
+_MP_STREAM_CLOSE = const(4)
+
+# _CountingSocket passes a socket's stream operations through and counts the bytes transferred.
+class _CountingSocket(io.IOBase):
+
+    def __init__(self, sock):
+        self._s = sock
+        self._poll = select.poll()
+        self._poll.register(sock, 0)
+        self.rx = 0
+        self.tx = 0
+
+    def readinto(self, buf):
+        n = self._s.readinto(buf)
+        if n:
+            self.rx += n
+        return n
+
+    def write(self, buf):
+        n = self._s.write(buf)
+        if n:
+            self.tx += n
+        return n
+
+    def ioctl(self, req, arg):
+        if req == _MP_STREAM_POLL:
+            # the stream poll flags are the same as select's POLLIN/POLLOUT/POLLERR/POLLHUP
+            self._poll.modify(self._s, arg)
+            ret = 0
+            for _, ev in self._poll.poll(0):
+                ret |= ev
+            return ret
+        if req == _MP_STREAM_CLOSE:
+            self._s.close()
+        return 0
+
+# TLSStats records the cost of TLS connection setup, available as MQTTClient.tls_stats.
+class TLSStats:
+
+    def __init__(self):
+        self.resumption = "on" # "on", "off" (ssl_params resume=False) or "unsupported" by ssl
+        self.handshakes = 0  # number of completed handshakes
+        self.resumed = 0     # number of those that resumed a previous session
+        self.last_ms = None  # connection setup time of the most recent handshake
+        self.last_bytes = None # bytes sent+received during the most recent handshake
+        self.full_bytes = 0  # total bytes of full handshakes
+        self.resumed_bytes = 0 # total bytes of resumed handshakes
+
+    def __str__(self):
+        return "resumption=%s handshakes=%d resumed=%d last=%sms/%sB full=%dB resumed=%dB" % (
+            self.resumption, self.handshakes, self.resumed, self.last_ms, self.last_bytes,
+            self.full_bytes, self.resumed_bytes)
+
+# TLSSession holds the TLS configuration and the session to resume.
+# ssl_params is a dict that may contain: server_hostname (defaults to the hostname passed in),
+# cadata or cafile with the CA certificate(s) to verify the broker with, certfile and keyfile for
+# client authentication, cert_reqs (ssl.CERT_NONE to skip verification, defaults to
+# ssl.CERT_REQUIRED if a CA is given), resume (set to False to always do a full handshake), and
+# context to supply a ready-made ssl.SSLContext instead.
+class TLSSession:
+
+    def __init__(self, ssl_params, hostname=None):
+        p = ssl_params
+        self._hostname = p.get("server_hostname", hostname)
+        ctx = p.get("context")
+        if ctx is None:
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            ca = "cadata" in p or "cafile" in p
+            ctx.verify_mode = p.get("cert_reqs", ssl.CERT_REQUIRED if ca else ssl.CERT_NONE)
+            if ca:
+                ctx.load_verify_locations(cafile=p.get("cafile"), cadata=p.get("cadata"))
+            if "certfile" in p:
+                ctx.load_cert_chain(p["certfile"], p.get("keyfile"))
+        self._ctx = ctx
+        self._session = None  # session of the last successful connection
+        self._sock = None     # counting socket of the connection being set up
+        self._sslsock = None
+        self._t0 = 0
+        self._reported = False # whether wrap() has reported that sessions are unsupported
+        self.stats = TLSStats()
+        if not p.get("resume", True):
+            self.stats.resumption = "off"
+        elif not _SESSIONS:
+            self.stats.resumption = "unsupported"
+
+    # wrap replaces the raw socket of a connected uasyncio stream by a TLS socket. The handshake
+    # takes place when the stream is first written to. It returns True the first time it finds
+    # that the ssl module can't resume sessions, so the caller can report that once.
+    def wrap(self, stream):
+        self._t0 = ticks_ms()
+        s = self.stats
+        if not hasattr(stream, "s"):
+            # cpy_fix stream: it does TLS itself and counts the bytes
+            self._sock = stream
+            self._sslsock = stream.start_tls(self._ctx, self._hostname,
+                self._session if s.resumption == "on" else None)
+            return False
+        self._sock = _CountingSocket(stream.s)
+        kw = { "server_hostname": self._hostname, "do_handshake_on_connect": False }
+        self._sslsock = None
+        if s.resumption == "on" and self._session is not None:
+            try:
+                self._sslsock = self._ctx.wrap_socket(self._sock, session=self._session, **kw)
+            except TypeError:
+                # SSLSession exists but wrap_socket doesn't take it
+                s.resumption = "unsupported"
+                self._session = None
+        if self._sslsock is None:
+            self._sslsock = self._ctx.wrap_socket(self._sock, **kw)
+        stream.s = self._sslsock
+        if s.resumption != "unsupported" or self._reported:
+            return False
+        self._reported = True
+        return True
+
+    # connected is called once the broker has responded to CONNECT, it records the handshake
+    # stats and saves the session for the next connection.
+    def connected(self):
+        s = self.stats
+        s.handshakes += 1
+        s.last_ms = ticks_diff(ticks_ms(), self._t0)
+        s.last_bytes = self._sock.rx + self._sock.tx
+        if s.resumption == "on" and self._sslsock.session_reused:
+            s.resumed += 1
+            s.resumed_bytes += s.last_bytes
+        else:
+            s.full_bytes += s.last_bytes
+        if s.resumption == "on":
+            self._session = self._sslsock.session
+        self._sock = self._sslsock = None
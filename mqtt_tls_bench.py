@@ -0,0 +1,65 @@
+# mqtt_tls_bench.py host-side test of TLS session resumption in mqtt_tls.
+#
+# Runs BrokerSim (from mqtt_bench) behind a TLS server with a throw-away self-signed certificate
+# made by the openssl command, and connects to it COUNT times with one TLSSession per run, as
+# MQTTClient does across reconnects. For each TLS version, with resumption on and off, it reports
+# how many handshakes were resumed and the average bytes and time per connection setup (TLS
+# handshake plus CONNECT/CONNACK). It exits with status 1 if resumption is on but no later
+# connection resumed the session.
+#
+# Usage: python3 mqtt_tls_bench.py [-n COUNT] [--latency MS]
+
+import os, sys, ssl, subprocess, tempfile, argparse
+from cpy_fix import asyncio
+import mqtt_async
+from mqtt_bench import BrokerSim
+from mqtt_tls import TLSSession
+
+def _make_cert(d):
+    cert = os.path.join(d, "cert.pem")
+    key = os.path.join(d, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+        "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost", "-keyout", key,
+        "-out", cert], check=True, capture_output=True)
+    return cert, key
+
+async def run(cert, key, version, resume, count, latency_ms):
+    server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_ctx.load_cert_chain(cert, key)
+    server_ctx.minimum_version = server_ctx.maximum_version = version
+    sim = BrokerSim(latency_ms)
+    await sim.start(ssl=server_ctx)
+    tls = TLSSession({ "cafile": cert, "resume": resume }, "localhost")
+    nop = lambda *_: None
+    ms = 0
+    for _ in range(count):
+        proto = mqtt_async.MQTTProto(nop, nop, nop, nop)
+        await proto.connect(("127.0.0.1", sim.port), b"tls-bench", True, tls=tls)
+        ms += tls.stats.last_ms
+        await proto.disconnect()
+    await sim.stop()
+    return tls.stats, ms / count
+
+async def main(args):
+    print("%d connections per run, latency=%dms" % (args.count, args.latency))
+    print("%-8s %-7s %8s %10s %10s %9s" % ("TLS", "resume", "resumed", "full B", "resumed B",
+        "avg ms"))
+    failed = False
+    with tempfile.TemporaryDirectory() as d:
+        cert, key = _make_cert(d)
+        for version in (ssl.TLSVersion.TLSv1_2, ssl.TLSVersion.TLSv1_3):
+            for resume in (False, True):
+                s, ms = await run(cert, key, version, resume, args.count, args.latency)
+                full = s.handshakes - s.resumed
+                print("%-8s %-7s %4d/%-3d %10s %10s %9s" % (version.name, s.resumption,
+                    s.resumed, s.handshakes, s.full_bytes // full if full else "-",
+                    s.resumed_bytes // s.resumed if s.resumed else "-", "%.1f" % ms))
+                if resume and args.count > 1 and not s.resumed:
+                    failed = True
+    return failed
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="TLS session resumption test")
+    p.add_argument("-n", "--count", type=int, default=5, help="connections per run")
+    p.add_argument("--latency", type=int, default=0, help="one-way latency in ms")
+    sys.exit(1 if asyncio.run(main(p.parse_args())) else 0)
@@ -0,0 +1,167 @@
+"""
+Payload codecs for the MQTT leg of the UART bridge.
+
+Each codec is identified by a short name, which is also used as a topic suffix
+so the two ends can tell how a payload is encoded: a message published on
+'<topic>/raw' carries raw binary, '<topic>/b64' carries base64 and so on.
+Messages on the bare '<topic>' are hex, which is what the bridge has always
+sent, so legacy consumers keep working.
+
+unpack() returns the frames carried by one MQTT payload. For the single-frame
+codecs that is a 1-tuple; the batch codec can carry many frames. The frames
+never share memory with the payload, so the payload may be a memoryview into
+a receive buffer that is reused afterwards.
+"""
+
+from binascii import hexlify, unhexlify, a2b_base64, b2a_base64
+
+
+class RawCodec:
+    name = 'raw'
+
+    def encode(self, msg):
+        return msg
+
+    def unpack(self, payload):
+        return (bytes(payload),)
+
+
+class HexCodec:
+    name = 'hex'
+
+    def encode(self, msg):
+        return hexlify(msg)
+
+    def unpack(self, payload):
+        return (unhexlify(payload),)
+
+
+class Base64Codec:
+    name = 'b64'
+
+    def encode(self, msg):
+        return b2a_base64(msg)[:-1] # strip the trailing newline
+
+    def unpack(self, payload):
+        return (a2b_base64(payload),)
+
+
+class BatchCodec:
+    """Several frames in one payload.
+
+    The payload starts with a one-byte frame count, followed by each frame
+    prefixed with its length as an MQTT-style varint (one byte for frames of
+    up to 127 bytes).
+    """
+    name = 'batch'
+    MAX_FRAMES = 255
+
+    def encode(self, msg):
+        return self.pack((msg,))
+
+    def frame_size(self, msg):
+        """Return the number of bytes msg adds to a packed payload."""
+        n = len(msg)
+        size = n + 1
+        while n > 0x7f:
+            n >>= 7
+            size += 1
+        return size
+
+    def packed_size(self, msgs):
+        """Return the size of the payload pack(msgs) would produce."""
+        size = 1
+        for msg in msgs:
+            size += self.frame_size(msg)
+        return size
+
+    def pack(self, msgs, buf=None):
+        """Pack a sequence of frames into one payload.
+
+        Returns a memoryview of the payload. If buf is given the payload is
+        written into it, otherwise a new buffer is allocated."""
+        if len(msgs) > self.MAX_FRAMES:
+            raise ValueError('too many frames')
+        size = self.packed_size(msgs)
+        if buf is None:
+            buf = bytearray(size)
+        elif len(buf) < size:
+            raise ValueError('output buffer too small')
+        buf[0] = len(msgs)
+        i = 1
+        for msg in msgs:
+            n = len(msg)
+            while n > 0x7f:
+                buf[i] = (n & 0x7f) | 0x80
+                n >>= 7
+                i += 1
+            buf[i] = n
+            i += 1
+            buf[i:i+len(msg)] = msg
+            i += len(msg)
+        return memoryview(buf)[:size]
+
+    def unpack(self, payload):
+        mv = memoryview(payload)
+        if len(mv) == 0:
+            raise ValueError('empty batch')
+        frames = []
+        i = 1
+        for _ in range(mv[0]):
+            n = 0
+            sh = 0
+            while True:
+                if i >= len(mv):
+                    raise ValueError('truncated batch')
+                b = mv[i]
+                i += 1
+                n |= (b & 0x7f) << sh
+                if not b & 0x80:
+                    break
+                sh += 7
+            if i + n > len(mv):
+                raise ValueError('truncated batch')
+            frames.append(bytes(mv[i:i+n]))
+            i += n
+        return frames
+
+
+CODECS = {}
+for _c in (RawCodec(), HexCodec(), Base64Codec(), BatchCodec()):
+    CODECS[_c.name] = _c
+
+# Codec of messages on the bare topic, i.e. without a suffix
+LEGACY = CODECS['hex']
+
+
+def get_codec(name):
+    """Return the codec with the given name, raising ValueError if unknown."""
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError('unknown payload codec ' + name)
+
+
+def topic_for(base, codec):
+    """Return the topic to publish on for base topic and codec."""
+    if codec is LEGACY:
+        return base
+    return base + '/' + codec.name
+
+
+def codec_for_topic(topic, base):
+    """Return the codec for a message received on topic, a subtopic of base.
+
+    Returns None if the topic does not name a known codec."""
+    if isinstance(topic, str):
+        topic = topic.encode()
+    if isinstance(base, str):
+        base = base.encode()
+    if topic == base:
+        return LEGACY
+    if len(topic) <= len(base) + 1 or not topic.startswith(base + b'/'):
+        return None
+    try:
+        return CODECS.get(topic[len(base)+1:].decode())
+    except UnicodeError:
+        return None
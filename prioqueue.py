@@ -0,0 +1,120 @@
+"""
+Bounded multi-priority queue for uasyncio.
+
+Items are put into one of several priority classes, class 0 being the most
+urgent. get() always returns the oldest item of the most urgent non-empty
+class, so a burst of bulk traffic can't hold up urgent frames queued behind
+it.
+
+Each class has its own capacity and a policy for when it is full:
+
+  DROP_OLDEST  discard the oldest item of the class to make room
+  DROP_NEWEST  discard the item being put
+  BLOCK        put() waits until there is room; put_nowait(), which can't
+               wait, discards the new item instead
+
+Per-class depth, high-water mark and drop counters are kept so queue sizes
+can be tuned to the actual load.
+"""
+
+import uasyncio as asyncio
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+
+class QueueEmpty(Exception):
+    pass
+
+
+class PriorityQueue:
+    """Bounded queue with one FIFO per priority class.
+
+    classes is a sequence of (maxsize, policy) tuples, one per class.
+    """
+
+    def __init__(self, classes):
+        self._q = []
+        self._maxsize = []
+        self._policy = []
+        for maxsize, policy in classes:
+            if maxsize < 1:
+                raise ValueError('maxsize <1')
+            if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+                raise ValueError('unknown policy ' + policy)
+            self._q.append([])
+            self._maxsize.append(maxsize)
+            self._policy.append(policy)
+        self._evput = asyncio.Event()  # triggered by put, tested by get
+        self._evget = asyncio.Event()  # triggered by get, tested by put
+        self.drops = [0] * len(self._q)     # items discarded, per class
+        self.high_water = [0] * len(self._q) # maximum depth seen, per class
+
+    def _put(self, item, prio):
+        q = self._q[prio]
+        q.append(item)
+        if len(q) > self.high_water[prio]:
+            self.high_water[prio] = len(q)
+        self._evput.set()
+        self._evput.clear()
+
+    def put_nowait(self, item, prio):
+        """Queue item in class prio without waiting.
+
+        Returns False if an item had to be dropped: the new one or, for a
+        DROP_OLDEST class, the oldest one."""
+        q = self._q[prio]
+        if len(q) < self._maxsize[prio]:
+            self._put(item, prio)
+            return True
+        self.drops[prio] += 1
+        if self._policy[prio] == DROP_OLDEST:
+            q.pop(0)
+            self._put(item, prio)
+        return False
+
+    async def put(self, item, prio):
+        """Queue item in class prio, waiting for room if the class blocks."""
+        if self._policy[prio] == BLOCK:
+            while len(self._q[prio]) >= self._maxsize[prio]:
+                await self._evget.wait()
+        return self.put_nowait(item, prio)
+
+    def get_nowait(self):
+        """Remove and return the most urgent item, raising QueueEmpty if there
+        is none."""
+        for q in self._q:
+            if q:
+                item = q.pop(0)
+                self._evget.set()
+                self._evget.clear()
+                return item
+        raise QueueEmpty()
+
+    async def get(self):
+        """Remove and return the most urgent item, waiting if the queue is
+        empty."""
+        while self.empty():
+            await self._evput.wait()
+        return self.get_nowait()
+
+    def empty(self):
+        for q in self._q:
+            if q:
+                return False
+        return True
+
+    def qsize(self):
+        n = 0
+        for q in self._q:
+            n += len(q)
+        return n
+
+    def depth(self, prio):
+        """Return the number of items queued in class prio."""
+        return len(self._q[prio])
+
+    def __str__(self):
+        return 'depth=%s high=%s drops=%s' % ([len(q) for q in self._q],
+            self.high_water, self.drops)
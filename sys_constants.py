@@ -2,3 +2,60 @@ MOBILE_APN      = "iot.1nce.net"
 BROKER_ADDR     = 'broker.hivemq.com' # can be an IP address or a hostname
 SUBSCRIBE_TOPIC = 'BWtest/mqtt_async/1/in'
 PUBLISH_TOPIC   = 'BWtest/mqtt_async/1/out'
+
+# Payload codec used for messages published to MQTT: 'raw', 'hex', 'b64' or 'batch'.
+# Anything other than 'hex' is published on PUBLISH_TOPIC + '/' + codec name.
+PAYLOAD_CODEC   = 'hex'
+
+# Batching of UART frames into one MQTT publish, used when PAYLOAD_CODEC is 'batch'.
+# A batch is published when it holds BATCH_MAX_FRAMES frames, when adding another frame
+# would exceed BATCH_MAX_BYTES, or BATCH_MAX_DELAY_MS after its first frame arrived.
+# A batch holds at most 255 frames, larger values of BATCH_MAX_FRAMES act as 255.
+BATCH_MAX_FRAMES   = 32
+BATCH_MAX_BYTES    = 1024
+BATCH_MAX_DELAY_MS = 200
+
+# Priority classes of the queues between the UART and MQTT, class 0 being the most urgent.
+# Each entry is (max frames, policy when full): 'drop_oldest', 'drop_newest' or 'block'
+# (the producer waits; messages from MQTT can't wait, so they are dropped instead).
+QUEUE_CLASSES = (
+    (8,  'block'),       # 0: control
+    (32, 'drop_oldest'), # 1: normal
+    (64, 'drop_oldest'), # 2: bulk telemetry
+)
+QUEUE_DEFAULT_PRIO = 1
+
+# If True, the first byte of each frame from the UART is its priority class and is removed
+# before the frame is published. Otherwise all UART frames go in QUEUE_DEFAULT_PRIO.
+UART_PRIO_HEADER = False
+
+# Priority class of messages from MQTT by topic, others go in QUEUE_DEFAULT_PRIO.
+MQTT_PRIO_TOPICS = {
+    # SUBSCRIBE_TOPIC + '/raw': 0,
+}
+
+# How often to print queue depths and drop counts, in seconds (0 to never).
+QUEUE_STATS_INTERVAL = 60
+
+# Baud rates of the host UART link, in increasing order. The link starts at the first one; if
+# UART_BAUD_NEGOTIATE is True the bridge steps up to the fastest rate that carries probe frames
+# without errors, and back down if frame errors pile up (see baudneg.py, the host must support it).
+# Negotiation frames start with 0xFF, so while it is on, data frames whose first byte is 0xFF
+# are sent with that byte doubled, in both directions. The host must do the same, or its data
+# frames that start with 0xFF 0xFF lose a byte and those that start with b'\xffBN' are taken for
+# negotiation frames.
+UART_BAUD_RATES     = (57600, 115200, 230400, 460800, 921600)
+UART_BAUD_NEGOTIATE = False
+
+# Reliable link layer on the host UART (see uartlink.py, the host must support it): frames carry
+# a CRC-16 and a sequence number, and are acknowledged and retransmitted over the UART hop.
+UART_LINK           = False
+UART_LINK_WINDOW    = 8   # frames that may be awaiting an ACK, at most 32
+UART_LINK_RTO_MS    = 200 # retransmission time-out
+
+# Logical channels on the host UART (see uartchan.py, the host must support it), or None for
+# none. Frames start with a 1-2 byte channel index (after the priority byte from the UART, if
+# UART_PRIO_HEADER is set); channel i carries PUBLISH_TOPIC + '/' + name and SUBSCRIBE_TOPIC +
+# '/' + name, the empty name standing for the base topics. The table of names is sent to the
+# host at startup. Names can't be payload codec names.
+UART_CHANNELS = None # e.g. ('', 'status', 'log')
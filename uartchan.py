@@ -0,0 +1,141 @@
+"""
+Logical channels on the host UART link, each bound to a pair of MQTT topics.
+
+Channels are named, and channel i carries the frames published on
+'<publish topic>/<name i>' and those received on '<subscribe topic>/<name i>'
+(the payload codec suffix, if any, follows the name). The empty name stands
+for the base topics themselves. A data frame starts with its channel index:
+
+  0xxxxxxx            index 0..127, one byte
+  1xxxxxxx xxxxxxxx   index 128..32511, two bytes, high bits first
+
+The first byte of a data frame is never 0xFF, which is left for control
+frames: MAGIC, an op byte, the op's body and a CRC-16 over everything before
+it, like the frames of baudneg.
+
+  TABLE      count (u16), then per channel: name length (u8), name
+  TABLE_ACK  crc (u16) of the TABLE frame being acknowledged
+  TABLE_REQ  (empty)  host asks for the table again, e.g. after a restart
+
+The bridge sends TABLE at startup, and again on TABLE_REQ, until the host
+answers with TABLE_ACK, and holds back frames for the host until then. After
+that the topic strings never cross the UART: the header is looked up from
+the topic of each MQTT message, and the publish topic from the header of each
+UART frame, in tables built once.
+"""
+
+import struct
+import uasyncio as asyncio
+from crc16 import crc16
+import payload
+
+MAGIC = b'\xffCH'
+
+OP_TABLE = 1
+OP_TABLE_ACK = 2
+OP_TABLE_REQ = 3
+
+MAX_CHANNELS = 0x7F00
+
+
+def header(index):
+    """Return the frame header for channel index."""
+    if index < 0x80:
+        return bytes((index,))
+    return bytes((0x80 | index >> 8, index & 0xFF))
+
+
+class ChannelMap:
+    """Channel table of the host UART link.
+
+    names lists the channel names, in index order. pub_base and sub_base are
+    the base topics frames are published on and received from, codec is the
+    codec frames from the UART are published with. Control frames are sent
+    with sender (a uartcobs.FrameSender or uartlink.UartLink), and received
+    ones must be passed to handle() (use is_control() to pick them out).
+    """
+
+    def __init__(self, sender, names, pub_base, sub_base, codec, timeout_ms=1000):
+        if not 1 <= len(names) <= MAX_CHANNELS:
+            raise ValueError('1..%d channels' % MAX_CHANNELS)
+        self._sender = sender
+        self._timeout_ms = timeout_ms
+        self.names = names
+        self._pub = []      # index -> publish topic
+        self._sub = {}      # topic (bytes) -> (header, codec)
+        table = bytearray(MAGIC)
+        table.append(OP_TABLE)
+        table += struct.pack('>H', len(names))
+        for i, name in enumerate(names):
+            if name in payload.CODECS or '/' in name or '+' in name or '#' in name:
+                raise ValueError('bad channel name ' + name)
+            if name in names[:i]:
+                raise ValueError('duplicate channel name ' + name)
+            pub = pub_base + '/' + name if name else pub_base
+            sub = sub_base + '/' + name if name else sub_base
+            self._pub.append(payload.topic_for(pub, codec))
+            hdr = header(i)
+            for c in payload.CODECS.values():
+                self._sub[payload.topic_for(sub, c).encode()] = (hdr, c)
+            n = name.encode()
+            table.append(len(n))
+            table += n
+        table += struct.pack('>H', crc16(table))
+        self._table = table
+        self.ready = asyncio.Event()  # set once the host has the table
+
+    # ===== control frames
+
+    @staticmethod
+    def is_control(frame):
+        """Return True if the decoded frame is a channel control frame."""
+        return len(frame) >= len(MAGIC) + 3 and bytes(frame[:len(MAGIC)]) == MAGIC
+
+    async def announce(self):
+        """Send the table, retrying until the host acknowledges it."""
+        self.ready.clear()
+        while not self.ready.is_set():
+            await self._sender.send(self._table)
+            try:
+                await asyncio.wait_for_ms(self.ready.wait(), self._timeout_ms)
+            except asyncio.TimeoutError:
+                pass
+
+    def handle(self, frame):
+        """Process a received control frame."""
+        n = len(frame)
+        if crc16(memoryview(frame)[:n-2]) != struct.unpack('>H', frame[n-2:n])[0]:
+            print("Bad channel control frame")
+            return
+        op = frame[len(MAGIC)]
+        body = bytes(frame[len(MAGIC)+1:n-2])
+        if op == OP_TABLE_ACK:
+            if body == self._table[-2:]:
+                self.ready.set()
+        elif op == OP_TABLE_REQ:
+            if self.ready.is_set():
+                asyncio.create_task(self.announce())
+
+    # ===== data frames
+
+    def decode(self, msg, start=0):
+        """Return (publish topic, payload offset) for a frame from the UART
+        whose channel header starts at msg[start]. Raises ValueError if the
+        header is truncated or names an unknown channel."""
+        if len(msg) <= start:
+            raise ValueError('no channel header')
+        index = msg[start]
+        start += 1
+        if index & 0x80:
+            if len(msg) <= start:
+                raise ValueError('truncated channel header')
+            index = (index & 0x7F) << 8 | msg[start]
+            start += 1
+        if index >= len(self._pub):
+            raise ValueError('unknown channel %d' % index)
+        return self._pub[index], start
+
+    def lookup(self, topic):
+        """Return (header, codec) for a message received on topic (bytes),
+        or None if the topic isn't one of the channels'."""
+        return self._sub.get(topic)
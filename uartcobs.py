@@ -0,0 +1,152 @@
+"""
+Streaming COBS frame receiver and sender for a UART.
+
+Bytes are drained from the UART in bulk into a single preallocated buffer
+using readinto(), then scanned for the 0x00 frame delimiter with
+cobs.find_zero() (a viper loop on the Pico). Complete
+(still COBS-encoded) frames are handed back as memoryview slices of that
+buffer, so no per-byte or per-frame allocation takes place.
+
+The receiver runs on top of uasyncio.StreamReader, so the task sleeps in the
+scheduler's poll until the UART has data rather than polling with sleep_ms().
+Likewise the sender writes through uasyncio.StreamWriter, which puts as much
+into the TX FIFO as it accepts and then waits in the poll until there is room
+again.
+"""
+
+import uasyncio as asyncio
+from time import ticks_ms, ticks_diff
+import cobs
+
+
+class FrameReceiver:
+    """Split a UART byte stream into COBS frames.
+
+    The buffer is used linearly: new data is appended at self._end, complete
+    frames are consumed from self._start, and any partial frame is moved back
+    to the start of the buffer when the tail runs out of room. A frame that
+    does not fit in the buffer at all is discarded up to the next delimiter
+    and counted in self.overruns.
+    """
+
+    def __init__(self, uart, bufsize=512):
+        self._stream = asyncio.StreamReader(uart)
+        self._buf = bytearray(bufsize)
+        self._mv = memoryview(self._buf)
+        self._start = 0     # first byte of the frame being assembled
+        self._scan = 0      # first byte not yet checked for a delimiter
+        self._end = 0       # one past the last valid byte
+        self._discard = False # True while skipping the rest of an oversized frame
+        self.frames = 0     # number of frames returned
+        self.overruns = 0   # number of frames dropped because they were too long
+
+    def _compact(self):
+        """Move the partial frame to the start of the buffer."""
+        n = self._end - self._start
+        if self._start and n:
+            self._mv[0:n] = self._mv[self._start:self._end]
+        self._scan -= self._start
+        self._start = 0
+        self._end = n
+
+    async def read_frame(self):
+        """Return the next non-empty COBS frame, without its delimiter.
+
+        The returned memoryview refers to the receive buffer and is only valid
+        until the next call to read_frame(); copy it if it must be retained.
+        """
+        buf = self._buf
+        while True:
+            # look for a delimiter in the data we already have
+            idx = cobs.find_zero(buf, self._scan, self._end)
+            if idx >= 0:
+                start = self._start
+                self._start = self._scan = idx + 1
+                if self._discard:
+                    self._discard = False
+                    continue
+                if idx == start:
+                    continue # empty frame, i.e. back-to-back delimiters
+                self.frames += 1
+                return self._mv[start:idx]
+            self._scan = self._end
+            # out of data, make room for more
+            if self._start == self._end:
+                self._start = self._scan = self._end = 0
+            elif self._end == len(buf):
+                if self._start == 0:
+                    # the frame fills the whole buffer: drop it
+                    if not self._discard:
+                        self.overruns += 1
+                        self._discard = True
+                    self._start = self._scan = self._end = 0
+                else:
+                    self._compact()
+            # wait for the UART and drain whatever it has into the free space
+            n = await self._stream.readinto(self._mv[self._end:])
+            if n:
+                self._end += n
+
+
+class FrameSender:
+    """COBS-encode frames and write them to a UART.
+
+    Encoded frames, each followed by a delimiter, are collected in a
+    preallocated buffer and written out together by flush(), so consecutive
+    frames cost a single write and drain. A frame too large for the buffer is
+    encoded into a temporary one.
+
+    Throughput is counted in self.bytes, self.frames and self.writes, with
+    self.busy_ms the time spent waiting for the UART to take the data.
+    """
+
+    def __init__(self, uart, bufsize=512):
+        self._stream = asyncio.StreamWriter(uart, {})
+        self._buf = bytearray(bufsize)
+        self._mv = memoryview(self._buf)
+        self._len = 0       # number of bytes waiting in the buffer
+        self.bytes = 0      # number of bytes written
+        self.frames = 0     # number of frames written
+        self.writes = 0     # number of writes, i.e. flushes with data
+        self.busy_ms = 0    # time spent writing
+
+    async def send(self, msg, flush=True):
+        """Queue msg as a frame and, unless flush is False, write it out.
+
+        With flush=False the frame is held back to be coalesced with the ones
+        that follow; it is written out when the buffer fills up or on the next
+        call with flush=True (or to flush())."""
+        size = cobs.max_encoded_length(len(msg)) + 1
+        if self._len + size > len(self._buf):
+            await self.flush()
+        if size > len(self._buf):
+            buf = bytearray(size)
+            n = cobs.encode_into(msg, buf)
+            buf[n] = 0
+            await self._write(memoryview(buf)[:n+1])
+        else:
+            n = cobs.encode_into(msg, self._mv[self._len:])
+            self._buf[self._len+n] = 0
+            self._len += n + 1
+        self.frames += 1
+        if flush:
+            await self.flush()
+
+    async def flush(self):
+        """Write out the frames held in the buffer."""
+        if self._len:
+            n = self._len
+            self._len = 0
+            await self._write(self._mv[:n])
+
+    async def _write(self, data):
+        t0 = ticks_ms()
+        self._stream.write(data)
+        await self._stream.drain()
+        self.busy_ms += ticks_diff(ticks_ms(), t0)
+        self.bytes += len(data)
+        self.writes += 1
+
+    def rate(self):
+        """Return the achieved throughput in bytes per second of busy time."""
+        return self.bytes * 1000 // self.busy_ms if self.busy_ms else 0
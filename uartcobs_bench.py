@@ -0,0 +1,144 @@
+# uartcobs_bench.py host-side replay test and benchmark for uartcobs.
+#
+# Feeds a byte stream through a fake UART into FrameReceiver and checks the frames that come out.
+# The fake hands the stream over in chunks of random size, as readinto() on a real UART returns
+# whatever the FIFO and the ring buffer happen to hold, so frames and delimiters get split at every
+# possible place. By default the stream is made by FrameSender writing COUNT random frames (with
+# zero bytes, empty ones and some too long for the receive buffer) into a second fake UART, so the
+# sender is checked as well; with --file a raw capture from a real UART is replayed instead and the
+# frames that decode are counted. It reports host time per byte for the receive and send paths,
+# and exits with status 1 if any frame was lost, corrupted or made up.
+#
+# Usage: python3 uartcobs_bench.py [-n COUNT] [-s MAXSIZE] [--bufsize N] [--chunk N] [--seed N]
+#                                  [--file CAPTURE]
+
+import sys, time, random, argparse
+from cpy_fix import asyncio
+import cobs
+from uartcobs import FrameReceiver, FrameSender
+
+# _ReplayUART plays back data in chunks of 1..chunk bytes per readinto(), returning None once it
+# has all been read, like a non-blocking machine.UART with nothing waiting. Written data is
+# collected in out.
+class _ReplayUART:
+
+    def __init__(self, data=b"", chunk=64, rand=None):
+        self._data = memoryview(data)
+        self._pos = 0
+        self._chunk = chunk
+        self._rand = rand or random.Random(1)
+        self.out = bytearray()
+
+    def readinto(self, buf):
+        left = len(self._data) - self._pos
+        if not left:
+            return None
+        n = min(len(buf), left, self._rand.randint(1, self._chunk))
+        buf[:n] = self._data[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def write(self, buf):
+        self.out += buf
+        return len(buf)
+
+    def done(self):
+        return self._pos == len(self._data)
+
+def _frames(count, maxsize, bufsize, rand):
+    # random payloads, one in ten with zero bytes only and one in fifty too long to receive
+    frames = []
+    for i in range(count):
+        r = rand.random()
+        if r < 0.02:
+            size = bufsize + rand.randint(1, bufsize)
+        else:
+            size = rand.randint(0, maxsize)
+        if r > 0.9:
+            frames.append(bytes(size))
+        else:
+            frames.append(rand.randbytes(size))
+    return frames
+
+async def _receive(uart, bufsize, stop):
+    rx = FrameReceiver(uart, bufsize)
+    got = []
+    async def read():
+        while True:
+            got.append(bytes(await rx.read_frame()))
+    task = asyncio.create_task(read())
+    while not stop():
+        await asyncio.sleep(0)
+    await asyncio.sleep(0) # let it take the last frame
+    task.cancel()
+    return rx, got
+
+async def run(count, maxsize, bufsize, chunk, seed):
+    rand = random.Random(seed)
+    frames = _frames(count, maxsize, bufsize, rand)
+    # send: encode all the frames through FrameSender, coalescing runs of them
+    out = _ReplayUART()
+    tx = FrameSender(out, bufsize)
+    t0 = time.perf_counter()
+    for f in frames:
+        await tx.send(f, flush=rand.random() < 0.3)
+    await tx.flush()
+    tx_s = time.perf_counter() - t0
+    stream = bytes(out.out)
+    # receive: replay the stream in random chunks
+    uart = _ReplayUART(stream, chunk, rand)
+    t0 = time.perf_counter()
+    rx, got = await _receive(uart, bufsize, uart.done)
+    rx_s = time.perf_counter() - t0
+    # a frame whose encoding, with its delimiter, fills the buffer is dropped as an overrun
+    expect = [f for f in frames if cobs.max_encoded_length(len(f)) < bufsize]
+    decoded = []
+    bad = 0
+    for g in got:
+        try:
+            decoded.append(cobs.decode(g))
+        except cobs.DecodeError:
+            bad += 1
+    # an empty frame encodes to a lone 0x01, which comes through as a frame like any other
+    ok = decoded == expect and not bad and rx.overruns == len(frames) - len(expect)
+    return { "ok": ok, "bytes": len(stream), "frames": len(frames), "got": len(decoded),
+        "expected": len(expect), "bad": bad, "overruns": rx.overruns, "rx_s": rx_s, "tx_s": tx_s,
+        "writes": tx.writes }
+
+async def replay(path, bufsize, chunk, seed):
+    with open(path, "rb") as f:
+        stream = f.read()
+    uart = _ReplayUART(stream, chunk, random.Random(seed))
+    rx, got = await _receive(uart, bufsize, uart.done)
+    bad = 0
+    for g in got:
+        try:
+            cobs.decode(g)
+        except cobs.DecodeError:
+            bad += 1
+    print("%s: %d bytes, %d frames, %d don't decode, %d overruns" % (path, len(stream), len(got),
+        bad, rx.overruns))
+
+async def main(args):
+    if args.file:
+        await replay(args.file, args.bufsize, args.chunk, args.seed)
+        return False
+    r = await run(args.count, args.size, args.bufsize, args.chunk, args.seed)
+    print("%d frames of up to %dB, %dB receive buffer, reads of up to %dB" % (r["frames"],
+        args.size, args.bufsize, args.chunk))
+    print("send     %8d B in %5d writes  %7.0f ns/B" % (r["bytes"], r["writes"],
+        r["tx_s"] * 1e9 / r["bytes"]))
+    print("receive  %8d frames of %d, %d overruns, %d bad  %7.0f ns/B  %s" % (r["got"],
+        r["expected"], r["overruns"], r["bad"], r["rx_s"] * 1e9 / r["bytes"],
+        "intact" if r["ok"] else "MISMATCH"))
+    return not r["ok"]
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="uartcobs replay test")
+    p.add_argument("-n", "--count", type=int, default=2000, help="frames to send")
+    p.add_argument("-s", "--size", type=int, default=200, help="largest regular payload")
+    p.add_argument("--bufsize", type=int, default=512, help="FrameReceiver/FrameSender buffer size")
+    p.add_argument("--chunk", type=int, default=64, help="largest UART read")
+    p.add_argument("--seed", type=int, default=1, help="random seed")
+    p.add_argument("--file", help="raw UART capture to replay instead")
+    sys.exit(1 if asyncio.run(main(p.parse_args())) else 0)
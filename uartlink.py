@@ -0,0 +1,311 @@
+"""
+Reliable frame layer on top of the COBS UART link.
+
+Every frame carries a type byte and ends with a CRC-16, and data frames are
+numbered, so corrupted frames are detected and lost ones are sent again
+over the UART hop instead of being forwarded or silently missing:
+
+  DATA       0x01, epoch, seq, payload..., crc
+  ACK        0x02, epoch, base, bitmap (u32), crc
+  RESET      0x03, epoch, flags, crc
+  RESET_ACK  0x04, epoch, old epoch, old base, crc
+
+Each direction is numbered by its sender. Sequence numbers count modulo 256
+and up to `window` (at most 32) data frames may be unacknowledged. The
+receiver delivers payloads in order and answers every data frame with an
+ACK: base is the next sequence number it expects, i.e. everything before it
+has arrived, and bit i of bitmap says that frame base+1+i has arrived out of
+order and is being held. When a frame's retransmission time-out expires the
+sender resends only that frame (selective repeat), and not at all if the
+bitmap has reported it; it keeps every frame until base has passed it,
+though, since the receiver may still have to drop what it holds. An ACK
+with bits set in its bitmap shows that frame base was lost while later ones
+got through, so base is resent straight away, once per transmission,
+without waiting for its time-out.
+
+RESET restarts the sender's direction at sequence number 0 in a new epoch.
+The receiver drops the frames it holds and answers RESET_ACK with the epoch
+it had before and the base it had reached in it; the sender forgets the
+frames before that base, which were delivered, and renumbers the rest, held
+ones included, to send them again. DATA and ACK frames carry the epoch they
+were sent in and are dropped in any other, so that an ACK sent before a
+reset can't release frames numbered after it. A link starts with a RESET
+flagged RESET_BOTH, which asks the other end to reset its direction too, so
+that both ends agree on the sequence numbers after either one restarts; a
+direction is reset on its own when a frame is given up on after max_tries,
+so that the receiver doesn't wait for it forever. Only one reset of a
+direction runs at a time, and nothing is sent on it until it is over.
+"""
+
+import os, struct
+import uasyncio as asyncio
+from time import ticks_ms, ticks_diff, ticks_add
+from crc16 import crc16
+
+DATA = 0x01
+ACK = 0x02
+RESET = 0x03
+RESET_ACK = 0x04
+
+RESET_BOTH = 0x01 # RESET flag: reset your direction too
+
+MAX_WINDOW = 32
+
+
+class LinkStats:
+    """Counters for a UartLink."""
+    def __init__(self):
+        self.tx_frames = 0      # data frames sent for the first time
+        self.retransmits = 0    # data frames sent again
+        self.tx_failed = 0      # data frames given up on after max_tries
+        self.rx_frames = 0      # data frames delivered
+        self.crc_errors = 0     # frames dropped because of a bad CRC
+        self.duplicates = 0     # data frames received again
+        self.out_of_order = 0   # data frames held until a gap was filled
+        self.stale = 0          # DATA and ACK frames dropped from an old epoch
+        self.resets = 0         # resets of the send direction
+
+    def __repr__(self):
+        return ('tx=%d retx=%d failed=%d rx=%d crc=%d dup=%d ooo=%d stale=%d resets=%d' % (
+            self.tx_frames, self.retransmits, self.tx_failed, self.rx_frames,
+            self.crc_errors, self.duplicates, self.out_of_order, self.stale,
+            self.resets))
+
+
+class UartLink:
+    """Sequence-numbered, acknowledged frames over a uartcobs.FrameSender.
+
+    Received (COBS-decoded) frames must be passed to receive(); in-order
+    payloads are handed to the deliver coroutine function. Call start()
+    once before sending.
+    """
+
+    def __init__(self, sender, deliver, window=8, rto_ms=200, max_tries=8):
+        if not 1 <= window <= MAX_WINDOW:
+            raise ValueError('window must be 1..%d' % MAX_WINDOW)
+        self._sender = sender
+        self._deliver = deliver
+        self._window = window
+        self._rto_ms = rto_ms
+        self._max_tries = max_tries
+        # send side
+        self._epoch = os.urandom(1)[0] # so a restart doesn't reuse the last one
+        self._old_epoch = self._epoch
+        self._next = 0          # sequence number of the next new frame
+        self._una = 0           # oldest unacknowledged sequence number
+        self._slots = {}        # seq -> [frame, deadline, tries, fast, held] awaiting ACK
+        self._space = asyncio.Event() # set when an ACK frees window space
+        self._retx = None       # handle to the retransmit coro
+        self._synced = asyncio.Event() # set once RESET has been acked
+        self._resetting = False # a start() is waiting for RESET_ACK
+        # receive side
+        self._rx_epoch = None   # epoch of the other end's direction
+        self._reset_ack = None  # body of the RESET_ACK for that epoch
+        self._expected = 0      # next sequence number to deliver
+        self._held = {}         # seq -> payload received out of order
+        self._ack = bytearray(9)
+        self.stats = LinkStats()
+
+    # ===== sending
+
+    async def _send_ctl(self, typ, *body):
+        frame = bytearray(len(body) + 3)
+        frame[0] = typ
+        frame[1:-2] = bytes(body)
+        struct.pack_into('>H', frame, len(frame) - 2, crc16(memoryview(frame)[:-2]))
+        await self._sender.send(frame)
+
+    def _renumber(self, base):
+        # forget the frames before the receiver's base in the old epoch and
+        # renumber the rest from 0 in the new one
+        if base is not None:
+            for seq in list(self._slots):
+                if 0 < ((base - seq) & 0xFF) <= MAX_WINDOW:
+                    self._release(seq)
+        pending = []
+        for i in range((self._next - self._una) & 0xFF):
+            slot = self._slots.get((self._una + i) & 0xFF)
+            if slot is not None:
+                pending.append(slot)
+        self._slots.clear()
+        self._next = self._una = 0
+        now = ticks_ms()
+        for slot in pending:
+            frame = slot[0]
+            frame[1] = self._epoch
+            frame[2] = self._next
+            struct.pack_into('>H', frame, len(frame) - 2, crc16(memoryview(frame)[:-2]))
+            slot[1] = now # due for retransmission
+            slot[2] = 0
+            slot[3] = slot[4] = False
+            self._slots[self._next] = slot
+            self._next += 1
+        if pending and self._retx is None:
+            self._retx = asyncio.create_task(self._retransmit())
+
+    async def start(self, both=True):
+        """Reset the send direction, retrying until the other end answers.
+        With both=True, as when the link starts, the other end is asked to
+        reset its direction too. If a reset is already under way this just
+        waits for it to finish."""
+        if self._resetting:
+            await self._synced.wait()
+            return
+        self._resetting = True
+        self._synced.clear()
+        self._old_epoch = self._epoch
+        self._epoch = (self._epoch + 1) & 0xFF
+        self.stats.resets += 1
+        try:
+            while not self._synced.is_set():
+                await self._send_ctl(RESET, self._epoch, RESET_BOTH if both else 0)
+                try:
+                    await asyncio.wait_for_ms(self._synced.wait(), self._rto_ms)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._resetting = False
+
+    async def send(self, payload, flush=True):
+        """Send payload as a data frame, waiting for the link to be up and for
+        window space first. With flush=False the frame may be coalesced with
+        the ones that follow, as in FrameSender.send()."""
+        while True:
+            await self._synced.wait()
+            if ((self._next - self._una) & 0xFF) < self._window:
+                break
+            self._space.clear()
+            await self._space.wait()
+        seq = self._next
+        self._next = (seq + 1) & 0xFF
+        frame = bytearray(len(payload) + 5)
+        frame[0] = DATA
+        frame[1] = self._epoch
+        frame[2] = seq
+        frame[3:-2] = payload
+        struct.pack_into('>H', frame, len(frame) - 2, crc16(memoryview(frame)[:-2]))
+        self._slots[seq] = [frame, ticks_add(ticks_ms(), self._rto_ms), 1, False, False]
+        self.stats.tx_frames += 1
+        if self._retx is None:
+            self._retx = asyncio.create_task(self._retransmit())
+        await self._sender.send(frame, flush)
+
+    def pending(self):
+        """Return the number of data frames awaiting an ACK."""
+        return len(self._slots)
+
+    def _release(self, seq):
+        if self._slots.pop(seq, None) is not None:
+            while self._una != self._next and self._una not in self._slots:
+                self._una = (self._una + 1) & 0xFF
+            self._space.set()
+
+    async def _retransmit(self):
+        # resend each frame whose time-out has expired, until none are left
+        while self._slots:
+            await self._synced.wait() # nothing is resent during a reset
+            now = ticks_ms()
+            wait = self._rto_ms
+            for seq in list(self._slots):
+                slot = self._slots.get(seq)
+                if slot is None or slot[4]:
+                    continue
+                dt = ticks_diff(slot[1], now)
+                if dt > 0:
+                    wait = min(wait, dt)
+                    continue
+                if slot[2] >= self._max_tries:
+                    self.stats.tx_failed += 1
+                    self._release(seq)
+                    # the rest are renumbered, so this pass is over
+                    await self.start(False)
+                    wait = 0
+                    break
+                await self._resend(slot)
+                if not self._synced.is_set():
+                    break # reset meanwhile, the slots have been renumbered
+            await asyncio.sleep_ms(wait)
+        self._retx = None
+
+    async def _resend(self, slot, fast=False):
+        slot[1] = ticks_add(ticks_ms(), self._rto_ms)
+        slot[2] += 1
+        slot[3] = fast
+        self.stats.retransmits += 1
+        await self._sender.send(slot[0])
+
+    # ===== receiving
+
+    async def _send_ack(self):
+        ack = self._ack
+        ack[0] = ACK
+        ack[1] = self._rx_epoch
+        ack[2] = self._expected
+        bitmap = 0
+        for i in range(MAX_WINDOW):
+            if ((self._expected + 1 + i) & 0xFF) in self._held:
+                bitmap |= 1 << i
+        struct.pack_into('>I', ack, 3, bitmap)
+        struct.pack_into('>H', ack, 7, crc16(memoryview(ack)[:7]))
+        await self._sender.send(ack)
+
+    async def receive(self, frame):
+        """Process a received frame (COBS-decoded, may be a memoryview)."""
+        n = len(frame)
+        if n < 3 or crc16(memoryview(frame)[:n-2]) != (frame[n-2] << 8 | frame[n-1]):
+            self.stats.crc_errors += 1
+            return
+        typ = frame[0]
+        if typ == DATA and n >= 5:
+            if frame[1] != self._rx_epoch:
+                self.stats.stale += 1
+                return
+            seq = frame[2]
+            d = (seq - self._expected) & 0xFF
+            if d >= MAX_WINDOW or seq in self._held:
+                self.stats.duplicates += 1
+            else:
+                self._held[seq] = bytes(frame[3:n-2])
+                if d:
+                    self.stats.out_of_order += 1
+            await self._send_ack()
+            # deliver what has become contiguous
+            while self._expected in self._held:
+                payload = self._held.pop(self._expected)
+                self._expected = (self._expected + 1) & 0xFF
+                self.stats.rx_frames += 1
+                await self._deliver(payload)
+        elif typ == ACK and n == 9:
+            if frame[1] != self._epoch:
+                self.stats.stale += 1
+                return
+            base = frame[2]
+            bitmap = struct.unpack_from('>I', frame, 3)[0]
+            for seq in list(self._slots):
+                if 0 < ((base - seq) & 0xFF) <= MAX_WINDOW:
+                    self._release(seq)
+                elif bitmap and 0 < ((seq - base) & 0xFF) <= MAX_WINDOW and \
+                        bitmap >> (((seq - base) & 0xFF) - 1) & 1:
+                    self._slots[seq][4] = True # held by the receiver, don't resend
+            # later frames got through but base didn't: resend it now
+            slot = self._slots.get(base)
+            if bitmap and slot is not None and not slot[3] and not slot[4]:
+                await self._resend(slot, True)
+        elif typ == RESET and n == 5:
+            # the other end's direction restarts: what's held will be sent again
+            epoch = frame[1]
+            if epoch != self._rx_epoch:
+                # an old epoch equal to the new one says there was none
+                old = epoch if self._rx_epoch is None else self._rx_epoch
+                self._reset_ack = (epoch, old, self._expected)
+                self._rx_epoch = epoch
+                self._expected = 0
+                self._held.clear()
+                if frame[2] & RESET_BOTH:
+                    asyncio.create_task(self.start(False))
+            await self._send_ctl(RESET_ACK, *self._reset_ack)
+        elif typ == RESET_ACK and n == 6:
+            if self._resetting and frame[1] == self._epoch:
+                self._renumber(frame[3] if frame[2] == self._old_epoch else None)
+                self._synced.set()
+                self._space.set()
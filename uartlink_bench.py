@@ -0,0 +1,133 @@
+# uartlink_bench.py host-side loopback test and benchmark for uartlink.
+#
+# Connects two UartLink endpoints through a simulated serial line with a given baud rate and bit
+# error rate, sends a stream of frames from one to the other and checks that every payload arrives
+# intact and in order. The line carries COBS-encoded bytes and flips random bits, so errors hit the
+# framing as well as the contents. For each bit error rate it reports goodput (payload bytes
+# delivered per second of simulated line time), the payloads lost without the sender counting them
+# as failed, and the link's counters. A run that hasn't finished after TIMEOUT seconds is reported
+# as stuck, and the exit status is 1 if any run was stuck or lost or reordered data.
+#
+# Usage: python3 uartlink_bench.py [-n COUNT] [-s SIZE] [--baud RATE] [--window N] [--rto MS]
+#                                  [--seed N] [--timeout S]
+
+import sys, random, argparse
+from cpy_fix import asyncio
+import cobs
+from uartlink import UartLink
+
+# _Line is one direction of a serial line: bytes take 10 bit times each (8N1) and are delivered to
+# the receiving end's splitter after they have been clocked out, with bits flipped at random.
+class _Line:
+
+    def __init__(self, baud, ber, rand):
+        self._byte_s = 10 / baud
+        self._ber = ber
+        self._rand = rand
+        self._free = 0.0
+        self.rx = None # the _Splitter at the other end
+        self.bit_errors = 0
+
+    # send is a uartcobs.FrameSender stand-in
+    async def send(self, msg, flush=True):
+        data = bytearray(cobs.encode(bytes(msg)))
+        data.append(0)
+        if self._ber:
+            nbits = len(data) * 8
+            pos = int(self._rand.expovariate(self._ber))
+            while pos < nbits:
+                data[pos >> 3] ^= 1 << (pos & 7)
+                self.bit_errors += 1
+                pos += 1 + int(self._rand.expovariate(self._ber))
+        loop = asyncio.get_event_loop()
+        start = max(loop.time(), self._free)
+        self._free = start + len(data) * self._byte_s
+        loop.call_at(self._free, self.rx.feed, bytes(data))
+
+# _Splitter splits the received byte stream into COBS frames and passes them to the link.
+class _Splitter:
+
+    def __init__(self):
+        self.link = None
+        self._buf = bytearray()
+        self.bad_frames = 0
+
+    def feed(self, data):
+        for b in data:
+            if b:
+                self._buf.append(b)
+            elif self._buf:
+                try:
+                    frame = cobs.decode(bytes(self._buf))
+                except cobs.DecodeError:
+                    self.bad_frames += 1
+                else:
+                    asyncio.get_event_loop().create_task(self.link.receive(frame))
+                self._buf = bytearray()
+
+async def run(count, size, baud, ber, window, rto_ms, seed=1, timeout=60):
+    rand = random.Random(seed)
+    got = []
+    async def deliver(payload):
+        got.append(payload)
+    async def ignore(payload):
+        pass
+    a_to_b = _Line(baud, ber, rand)
+    b_to_a = _Line(baud, ber, rand)
+    a = UartLink(a_to_b, ignore, window, rto_ms)
+    b = UartLink(b_to_a, deliver, window, rto_ms)
+    a_to_b.rx = _Splitter()
+    a_to_b.rx.link = b
+    b_to_a.rx = _Splitter()
+    b_to_a.rx.link = a
+    loop = asyncio.get_event_loop()
+    sent = [rand.randbytes(size) for _ in range(count)]
+    t0 = loop.time()
+    async def transfer():
+        await a.start()
+        for p in sent:
+            await a.send(p)
+        # done once nothing awaits an ACK and every payload is delivered or given up on
+        while a.pending() or len(got) + a.stats.tx_failed < count:
+            await asyncio.sleep(0.01)
+    try:
+        await asyncio.wait_for(transfer(), timeout)
+        stuck = False
+    except asyncio.TimeoutError:
+        stuck = True
+    elapsed = loop.time() - t0
+    # what was delivered must be what was sent, in order, less the payloads given up on
+    it = iter(sent)
+    ordered = all(p in it for p in got) and len(set(got)) == len(got)
+    return { "goodput": len(got) * size / elapsed, "stuck": stuck, "ordered": ordered,
+        "lost": max(0, count - len(got) - a.stats.tx_failed), "a": a.stats, "b": b.stats,
+        "bit_errors": a_to_b.bit_errors + b_to_a.bit_errors,
+        "bad_frames": a_to_b.rx.bad_frames + b_to_a.rx.bad_frames }
+
+async def main(args):
+    print("%d x %dB frames at %d baud, window=%d rto=%dms seed=%d" % (args.count, args.size,
+        args.baud, args.window, args.rto, args.seed))
+    print("%-8s %9s %8s %7s %5s %6s %6s  %s" % ("BER", "goodput", "% line", "intact", "lost",
+        "bits", "badfr", "sender / receiver counters"))
+    failed = False
+    for ber in (0, 1e-6, 1e-5, 1e-4, 3e-4, 1e-3):
+        r = await run(args.count, args.size, args.baud, ber, args.window, args.rto, args.seed,
+            args.timeout)
+        line = args.baud / 10
+        intact = "STUCK" if r["stuck"] else "yes" if r["ordered"] and not r["lost"] else "NO"
+        failed |= intact != "yes"
+        print("%-8g %8.0fB %7.1f%% %7s %5d %6d %6d  %s / %s" % (ber, r["goodput"],
+            r["goodput"] * 100 / line, intact, r["lost"], r["bit_errors"], r["bad_frames"],
+            r["a"], r["b"]))
+    return failed
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="uartlink loopback benchmark")
+    p.add_argument("-n", "--count", type=int, default=500, help="frames per run")
+    p.add_argument("-s", "--size", type=int, default=64, help="payload size in bytes")
+    p.add_argument("--baud", type=int, default=115200, help="line rate")
+    p.add_argument("--window", type=int, default=8, help="UartLink window")
+    p.add_argument("--rto", type=int, default=200, help="retransmission time-out in ms")
+    p.add_argument("--seed", type=int, default=1, help="random seed")
+    p.add_argument("--timeout", type=float, default=60, help="seconds before a run counts as stuck")
+    sys.exit(1 if asyncio.run(main(p.parse_args())) else 0)